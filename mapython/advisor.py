@@ -0,0 +1,181 @@
+# coding: utf-8
+import math
+import json
+from sqlalchemy import and_, or_
+from mapython import projection
+from mapython.database import engine, session, generalized_name, \
+    generalized_class
+from mapython.render import GEOM_TYPES, BBOX_QUERY_COND, PROJECTED_SRIDS, \
+    style_conditions, table_srid
+
+
+#: metres per degree of longitude of the spherical projections
+METRES_PER_DEGREE = 2 * math.pi * projection.EARTH_RADIUS / 360
+
+
+def level_predicate(stylesheet, level, geom_type):
+    '''
+    Returns SQL condition which selects all features of the styles of a
+    level, i.e. the union of the conditions the renderer queries at this
+    level (see :meth:`mapython.render.Renderer.iter_query_conditions`).
+
+    :param stylesheet: :class:`mapython.style.StyleSheet`
+    :param level: level name
+    :param geom_type: one of ``'point'``, ``'line'`` or ``'polygon'``
+
+    :returns: SQL as str or None if the level has no styles of geom_type
+    '''
+
+    styles = stylesheet.styles.get(level, {}).get(geom_type, {}).values()
+    conditions = [and_(*conds) for _, _, conds
+        in style_conditions(styles, GEOM_TYPES[geom_type])]
+    if not conditions:
+        return None
+    return to_sql(or_(*conditions))
+
+def to_sql(expression):
+    '''
+    Returns SQL of a SQLAlchemy expression with all parameters inlined, so
+    it can be used in DDL statements.
+
+    :param expression: sqlalchemy expression
+
+    :returns: str
+    '''
+
+    compiled = expression.compile(bind=engine)
+    cursor = session.connection().connection.cursor()
+    return cursor.mogrify(str(compiled), compiled.params)
+
+def iter_index_statements(stylesheet, levels=None):
+    '''
+    Yields statements which create a partial GiST index of the features of
+    each level of the stylesheet. The query planner uses these indexes for
+    the queries of a level, because their conditions imply the predicate of
+    the index. Levels with identical predicates share one index. Index names
+    contain the level and the start of the digest of the stylesheet like
+    :func:`mapython.database.generalized_name`, so indexes of other or
+    former stylesheets are kept and existing indexes are not created again.
+
+    :param stylesheet: :class:`mapython.style.StyleSheet`
+    :param levels: list of level names, defaults to all levels
+
+    :yields: SQL statements as str
+    '''
+
+    if levels is None:
+        levels = sorted(stylesheet.zoomlevels)
+    digest = stylesheet.digest()
+    for geom_type, db_class in sorted(GEOM_TYPES.iteritems()):
+        table = db_class.__tablename__
+        predicates = set()
+        for level in levels:
+            predicate = level_predicate(stylesheet, level, geom_type)
+            if predicate is None or predicate in predicates:
+                continue
+            predicates.add(predicate)
+            yield 'CREATE INDEX IF NOT EXISTS %s_way_l%s_%s ON %s ' \
+                'USING GIST (way) WHERE %s' % (table, level, digest[:8],
+                    table, predicate)
+
+def iter_generalize_statements(stylesheet, levels, tolerance=0.5):
+    '''
+    Yields statements which build a generalized table of each table for
+    each of levels, see :func:`mapython.database.generalized_name`. The
+    table only contains the features of the styles of the level and their
+    geometries are simplified by tolerance pixels at the most detailed
+    scale of the level. The renderer uses these tables automatically for
+    maps of this stylesheet once they exist.
+
+    :param stylesheet: :class:`mapython.style.StyleSheet`
+    :param levels: list of level names
+    :param tolerance: max deviation of simplified geometries in pixel
+
+    :yields: SQL statements as str
+    '''
+
+    digest = stylesheet.digest()
+    for level in levels:
+        for geom_type, db_class in sorted(GEOM_TYPES.iteritems()):
+            predicate = level_predicate(stylesheet, level, geom_type)
+            if predicate is None:
+                continue
+            table = db_class.__tablename__
+            name = generalized_name(db_class, level, digest)
+            yield 'DROP TABLE IF EXISTS %s' % name
+            yield 'CREATE TABLE %s AS SELECT * FROM %s WHERE %s' % (name,
+                table, predicate)
+            #: scale is given in metres per pixel
+            distance = stylesheet.zoomlevels[level][0] * tolerance
+            if table_srid(db_class) not in PROJECTED_SRIDS:
+                distance /= METRES_PER_DEGREE
+            if geom_type != 'point' and distance > 0:
+                yield 'UPDATE %s SET way = ST_SimplifyPreserveTopology(' \
+                    'way, %r)' % (name, distance)
+                yield 'DELETE FROM %s WHERE ST_IsEmpty(way)' % name
+            yield 'CREATE INDEX %s_way ON %s USING GIST (way)' % (name, name)
+            yield 'ANALYZE %s' % name
+
+def execute(statements):
+    '''
+    Executes statements in one transaction.
+
+    :param statements: iterable of SQL statements as str
+    '''
+
+    # statements contain inlined parameters, which must not be parsed again
+    cursor = session.connection().connection.cursor()
+    for statement in statements:
+        cursor.execute(statement)
+    session.commit()
+
+def verify(stylesheet, bbox, levels=None):
+    '''
+    Explains the queries of each level within bbox and reports the tables
+    and indexes the query planner chooses, e.g. to check whether the
+    indexes of :func:`iter_index_statements` are used.
+
+    :param stylesheet: :class:`mapython.style.StyleSheet`
+    :param bbox: ``(minlon, minlat, maxlon, maxlat)``
+    :param levels: list of level names, defaults to all levels
+
+    :yields: ``(level, geom_type, tags, table, indexes)`` where indexes is
+        the set of used index names and contains None for sequential scans
+    '''
+
+    if levels is None:
+        levels = sorted(stylesheet.zoomlevels)
+    digest = stylesheet.digest()
+    for level in levels:
+        for geom_type, db_class in sorted(GEOM_TYPES.iteritems()):
+            db_class = generalized_class(db_class, level, digest) or db_class
+            srid = table_srid(db_class)
+            bounds = bbox
+            if srid in PROJECTED_SRIDS:
+                proj = PROJECTED_SRIDS[srid]
+                bounds = proj(bbox[0], bbox[1]) + proj(bbox[2], bbox[3])
+            bbox_condition = BBOX_QUERY_COND % ((db_class.__table__, )
+                + tuple(bounds) + (srid, ))
+            styles = stylesheet.styles.get(level, {}).get(geom_type,
+                {}).values()
+            for tags, _, conditions in style_conditions(styles, db_class):
+                query = session.query(db_class.osm_id).filter(
+                    and_(bbox_condition, *conditions))
+                compiled = query.statement.compile(bind=engine)
+                plan = session.connection().execute(
+                    'EXPLAIN (FORMAT JSON) %s' % compiled, compiled.params
+                ).scalar()
+                # psycopg2 only decodes json columns itself in newer versions
+                if isinstance(plan, basestring):
+                    plan = json.loads(plan)
+                yield (level, geom_type, tags, db_class.__tablename__,
+                    set(_iter_indexes(plan[0]['Plan'])))
+
+def _iter_indexes(node):
+    if node['Node Type'] == 'Seq Scan':
+        yield None
+    if 'Index Name' in node:
+        yield node['Index Name']
+    for child in node.get('Plans', ()):
+        for index in _iter_indexes(child):
+            yield index
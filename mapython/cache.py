@@ -0,0 +1,312 @@
+# coding: utf-8
+import os
+import math
+import hashlib
+import tempfile
+import threading
+import collections
+import numpy
+from mapython.store import makedirs
+
+
+def snap_bounds(bounds, levels=1):
+    '''
+    Expands bounds to a grid of cells whose size is the next power of two of
+    the extents of bounds multiplied by ``2 ** levels``, so neighbouring maps
+    are answered by the same cells.
+
+    :param bounds: ``(minx, miny, maxx, maxy)``
+    :param levels: number of zoom levels the cells are coarser than bounds
+
+    :returns: ``(minx, miny, maxx, maxy)`` of the covering cells
+    '''
+
+    minx, miny, maxx, maxy = bounds
+    size = max(maxx - minx, maxy - miny)
+    if size <= 0:
+        return bounds
+    cell = 2.0 ** (math.ceil(math.log(size, 2)) + levels)
+    return (
+        math.floor(minx / cell) * cell,
+        math.floor(miny / cell) * cell,
+        math.ceil(maxx / cell) * cell,
+        math.ceil(maxy / cell) * cell,
+    )
+
+def snap_size(size, levels=1):
+    '''
+    Rounds size, e.g. the size of a pixel, down to a power of two and divides
+    it by ``2 ** levels``, so maps of the same and the next ``levels`` zoom
+    levels are answered by cells fetched for this size.
+
+    :param size: size in the coordinates of the data
+    :param levels: number of zoom levels the size is finer than size
+
+    :returns: float
+    '''
+
+    if size <= 0:
+        return size
+    return 2.0 ** (math.floor(math.log(size, 2)) - levels)
+
+def contains(outer, inner):
+    '''Returns whether bounds outer contain bounds inner.'''
+
+    return outer[0] <= inner[0] and outer[1] <= inner[1] \
+        and outer[2] >= inner[2] and outer[3] >= inner[3]
+
+def intersects(bounds1, bounds2):
+    '''Returns whether bounds1 and bounds2 intersect.'''
+
+    return bounds1[0] <= bounds2[2] and bounds1[2] >= bounds2[0] \
+        and bounds1[1] <= bounds2[3] and bounds1[3] >= bounds2[1]
+
+def map_key(bbox, max_size, stylesheet_digest, version=None, precision=7):
+    '''
+    Returns key of a rendered map which identifies its content, e.g. for
+    :class:`TileCache` and as ETag. Coordinates are rounded, so requests of
+    clients which compute the same bbox with slightly different float
+    arithmetic share the key.
+
+    :param bbox: ``(minlon, minlat, maxlon, maxlat)``
+    :param max_size: max map width/height in pixel
+    :param stylesheet_digest: see :meth:`mapython.style.StyleSheet.digest`
+    :param version: version of the data, e.g. timestamp of the last import
+    :param precision: number of decimal places of coordinates
+
+    :returns: hex str
+    '''
+
+    bbox = ','.join('%.*f' % (precision, coord) for coord in bbox)
+    return hashlib.sha1('%s|%s|%s|%s' % (bbox, max_size, stylesheet_digest,
+        version)).hexdigest()
+
+
+class QueryCache(object):
+
+    '''
+    Caches query results of :class:`mapython.render.Renderer` keyed by
+    geometry type, query conditions and spatial cell. Queries are expanded
+    to cells (see :func:`snap_bounds`) and every later query whose bbox is
+    contained by a cached cell is answered from the cache by filtering the
+    bounds of the cached features. Queries which cull small features are
+    answered by cells fetched with lower or equal min sizes, so a cell
+    fetched for a tile also answers its child tiles of the next zoom level.
+    The least recently used cells are evicted once more than max_features
+    are cached.
+
+    :param max_features: max number of cached features
+    :param version: version of the data, see :meth:`validate`
+    '''
+
+    def __init__(self, max_features=100000, version=None):
+        self.max_features = max_features
+        self.version = version
+        # (key, cell): (objects, bounds array)
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = self.misses = 0
+
+    def get(self, key, bounds, fetch, min_size=(), cell_min_size=()):
+        '''
+        Returns all objects whose bounds intersect bounds and whose sizes are
+        at least min_size.
+
+        :param key: hashable key of geometry type and conditions
+        :param bounds: ``(minx, miny, maxx, maxy)``
+        :param fetch: callable which is called with the bounds of a cell and
+            returns ``(objects, bounds array)`` where the bounds array has
+            the shape (len(objects), 4 + len(min_size)), the bounds of each
+            object followed by its sizes
+        :param min_size: tuple of min sizes of the objects, e.g. area and
+            length
+        :param cell_min_size: min sizes of the objects fetched for a new
+            cell, at most min_size
+
+        :returns: list of objects
+        '''
+
+        for entry_key, cell, entry_min_size in reversed(self.entries.keys()):
+            if entry_key == key and contains(cell, bounds) \
+                    and all(entry_size <= size for entry_size, size
+                        in zip(entry_min_size, min_size)):
+                self.hits += 1
+                #: mark as recently used
+                entry = self.entries.pop((entry_key, cell, entry_min_size))
+                self.entries[(entry_key, cell, entry_min_size)] = entry
+                return self._filter(entry, bounds, min_size)
+        self.misses += 1
+        cell = snap_bounds(bounds)
+        objects, objects_bounds = fetch(cell)
+        entry = (objects, numpy.asarray(objects_bounds,
+            numpy.float64).reshape(-1, 4 + len(min_size)))
+        if len(objects) <= self.max_features:
+            self.entries[(key, cell, tuple(cell_min_size))] = entry
+            self.size += len(objects)
+            self._evict()
+        return self._filter(entry, bounds, min_size)
+
+    def invalidate(self, bounds=None):
+        '''
+        Removes cached cells, e.g. after the data was updated.
+
+        :param bounds: only remove cells intersecting these bounds
+            ``(minx, miny, maxx, maxy)``, remove all cells if None
+        '''
+
+        for key, cell, min_size in self.entries.keys():
+            if bounds is None or intersects(cell, bounds):
+                self.size -= len(self.entries.pop((key, cell, min_size))[0])
+
+    def validate(self, version):
+        '''
+        Removes all cached cells if version differs from the version of the
+        cached data.
+
+        :param version: any comparable object, e.g. timestamp of the last
+            data import
+        '''
+
+        if version != self.version:
+            self.invalidate()
+            self.version = version
+
+    def _evict(self):
+        while self.size > self.max_features:
+            _, (objects, _) = self.entries.popitem(last=False)
+            self.size -= len(objects)
+
+    def _filter(self, entry, bounds, min_size=()):
+        objects, objects_bounds = entry
+        minx, miny, maxx, maxy = bounds
+        mask = (
+            (objects_bounds[:, 0] <= maxx) & (objects_bounds[:, 2] >= minx)
+            & (objects_bounds[:, 1] <= maxy) & (objects_bounds[:, 3] >= miny)
+        )
+        #: cull objects of cells fetched with lower min sizes
+        for i, size in enumerate(min_size):
+            mask &= objects_bounds[:, 4 + i] >= size
+        return [objects[i] for i in numpy.flatnonzero(mask)]
+
+
+class TileCache(object):
+
+    '''
+    Caches rendered maps by key (see :func:`map_key`) in memory and
+    optionally on disk. Both caches evict the least recently used maps once
+    their max size is exceeded, maps evicted from memory are still served
+    from disk. The cache can be shared by the threads of a server.
+
+    :param max_bytes: max size of the memory cache in bytes
+    :param path: path to directory of the disk cache or None
+    :param max_disk_bytes: max size of the disk cache in bytes
+    '''
+
+    def __init__(self, max_bytes=64 * 2 ** 20, path=None,
+            max_disk_bytes=2 ** 30):
+        self.max_bytes = max_bytes
+        self.path = path
+        self.max_disk_bytes = max_disk_bytes
+        self.lock = threading.Lock()
+        # key: data
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        # key: size of file
+        self.disk_entries = collections.OrderedDict()
+        self.disk_size = 0
+        self.hits = self.misses = 0
+        if path is not None:
+            self._scan()
+
+    def get(self, key):
+        '''
+        Returns cached map.
+
+        :param key: hex str, see :func:`map_key`
+
+        :returns: data as str or None if map is not cached
+        '''
+
+        with self.lock:
+            data = self.entries.pop(key, None)
+            if data is not None:
+                #: mark as recently used
+                self.entries[key] = data
+                self.hits += 1
+                return data
+            on_disk = key in self.disk_entries
+            if on_disk:
+                self.disk_entries[key] = self.disk_entries.pop(key)
+        if on_disk:
+            try:
+                with open(self._file_path(key), 'rb') as fobj:
+                    data = fobj.read()
+                # keep order of use for the next run, see _scan
+                os.utime(self._file_path(key), None)
+            except (IOError, OSError):
+                pass # evicted by another thread
+            else:
+                with self.lock:
+                    self.hits += 1
+                    self._put_memory(key, data)
+                return data
+        with self.lock:
+            self.misses += 1
+
+    def put(self, key, data):
+        '''
+        Adds map to cache.
+
+        :param key: hex str, see :func:`map_key`
+        :param data: map data as str
+        '''
+
+        with self.lock:
+            self._put_memory(key, data)
+            if self.path is None or key in self.disk_entries:
+                return
+        filepath = self._file_path(key)
+        makedirs(os.path.dirname(filepath))
+        fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(filepath))
+        with os.fdopen(fd, 'wb') as fobj:
+            fobj.write(data)
+        os.rename(tmppath, filepath)
+        with self.lock:
+            self.disk_entries[key] = len(data)
+            self.disk_size += len(data)
+            while self.disk_size > self.max_disk_bytes:
+                old_key, size = self.disk_entries.popitem(last=False)
+                self.disk_size -= size
+                try:
+                    os.remove(self._file_path(old_key))
+                except OSError:
+                    pass # already removed
+
+    def _put_memory(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key))
+        self.entries[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, old_data = self.entries.popitem(last=False)
+            self.size -= len(old_data)
+
+    def _file_path(self, key):
+        return os.path.join(self.path, key[:2], key[2:])
+
+    def _scan(self):
+        #: restore disk cache from previous runs, least recently used first
+        files = []
+        for dirpath, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                filepath = os.path.join(dirpath, filename)
+                key = os.path.basename(dirpath) + filename
+                if len(key) != 40:
+                    continue # leftover of crashed process
+                stat = os.stat(filepath)
+                files.append((stat.st_mtime, key, stat.st_size))
+        for _, key, size in sorted(files):
+            self.disk_entries[key] = size
+            self.disk_size += size
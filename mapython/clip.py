@@ -0,0 +1,103 @@
+# coding: utf-8
+import numpy
+
+
+def clip_line(points, bounds):
+    '''
+    Clips a line to bounds with the Liang–Barsky algorithm, which clips all
+    segments at once. Consecutive visible segments are joined again, so a
+    line which leaves and re-enters bounds is split into several lines.
+
+    :param points: float array of shape (n, 2)
+    :param bounds: ``(minx, miny, maxx, maxy)``
+
+    :returns: list of float arrays of shape (n, 2)
+    '''
+
+    minx, miny, maxx, maxy = bounds
+    if len(points) < 2:
+        return []
+    lower = points.min(axis=0)
+    upper = points.max(axis=0)
+    if lower[0] >= minx and lower[1] >= miny \
+            and upper[0] <= maxx and upper[1] <= maxy:
+        return [points]
+    if lower[0] > maxx or lower[1] > maxy \
+            or upper[0] < minx or upper[1] < miny:
+        return []
+    start = points[:-1]
+    delta = points[1:] - start
+    #: parameters of the visible part of each segment
+    t0 = numpy.zeros(len(start))
+    t1 = numpy.ones(len(start))
+    rejected = numpy.zeros(len(start), bool)
+    for p, q in (
+        (-delta[:, 0], start[:, 0] - minx),
+        (delta[:, 0], maxx - start[:, 0]),
+        (-delta[:, 1], start[:, 1] - miny),
+        (delta[:, 1], maxy - start[:, 1]),
+    ):
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            t = q / p
+        t0 = numpy.where(p < 0, numpy.maximum(t0, t), t0)
+        t1 = numpy.where(p > 0, numpy.minimum(t1, t), t1)
+        # parallel to and outside of this edge
+        rejected |= (p == 0) & (q < 0)
+    visible = numpy.flatnonzero(~rejected & (t0 <= t1))
+    if not len(visible):
+        return []
+    first = start + t0[:, numpy.newaxis] * delta
+    last = start + t1[:, numpy.newaxis] * delta
+    #: a new line starts where the previous segment is invisible or clipped
+    starts = numpy.ones(len(visible), bool)
+    starts[1:] = (visible[1:] != visible[:-1] + 1) \
+        | (t1[visible[:-1]] < 1) | (t0[visible[1:]] > 0)
+    lines = []
+    for run in numpy.split(visible, numpy.flatnonzero(starts)[1:]):
+        lines.append(numpy.vstack((first[run[:1]], last[run])))
+    return lines
+
+def clip_ring(points, bounds):
+    '''
+    Clips a polygon ring to bounds with the Sutherland–Hodgman algorithm,
+    all vertices are clipped at once against each edge of bounds. Parts of
+    the ring outside of bounds are replaced by edges along bounds, so
+    bounds should be larger than the visible area by the border width.
+
+    :param points: float array of shape (n, 2)
+    :param bounds: ``(minx, miny, maxx, maxy)``
+
+    :returns: float array of shape (n, 2) or None if the ring is outside of
+        bounds
+    '''
+
+    minx, miny, maxx, maxy = bounds
+    if len(points) < 3:
+        return None
+    lower = points.min(axis=0)
+    upper = points.max(axis=0)
+    if lower[0] >= minx and lower[1] >= miny \
+            and upper[0] <= maxx and upper[1] <= maxy:
+        return points
+    if lower[0] > maxx or lower[1] > maxy \
+            or upper[0] < minx or upper[1] < miny:
+        return None
+    for axis, bound, sign in ((0, minx, 1), (0, maxx, -1), (1, miny, 1),
+            (1, maxy, -1)):
+        inside = sign * (points[:, axis] - bound) >= 0
+        previous = numpy.roll(points, 1, axis=0)
+        crossing = inside != numpy.roll(inside, 1)
+        # only intersections of crossing edges are used
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            t = (bound - previous[:, axis]) \
+                / (points[:, axis] - previous[:, axis])
+            intersections = previous \
+                + t[:, numpy.newaxis] * (points - previous)
+        #: each vertex emits the intersection with the previous edge and
+        #: itself if inside, in this order
+        candidates = numpy.concatenate((intersections[:, numpy.newaxis],
+            points[:, numpy.newaxis]), axis=1)
+        points = candidates[numpy.column_stack((crossing, inside))]
+        if len(points) < 3:
+            return None
+    return points
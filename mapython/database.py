@@ -1,5 +1,7 @@
 # coding: utf-8
 import os
+import time
+import hashlib
 from sqlalchemy import create_engine, MetaData, Column, Integer, String, Float
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
@@ -71,6 +73,14 @@ class OSMBase(object):
     z_order = Column('z_order', Integer)
 
 
+class OSMWayBase(object):
+
+    '''Columns of the tables of ways which are missing in PREFIX_point.'''
+
+    tracktype = Column('tracktype', String)
+    way_area = Column('way_area', Float)
+
+
 class OSMPoint(Base, OSMBase):
 
     '''This class represents the PREFIX_point table generated by osm2pgsql.'''
@@ -80,37 +90,31 @@ class OSMPoint(Base, OSMBase):
     geom = geoalchemy.GeometryColumn('way', geoalchemy.Point(2))
 
 
-class OSMLine(Base, OSMBase):
+class OSMLine(Base, OSMBase, OSMWayBase):
 
     '''This class represents the PREFIX_line table generated by osm2pgsql.'''
 
     __tablename__ = '%s_line' % DB_PREFIX
 
     geom = geoalchemy.GeometryColumn('way', geoalchemy.LineString(2))
-    tracktype = Column('tracktype', String)
-    way_area = Column('way_area', Float)
 
 
-class OSMPolygon(Base, OSMBase):
+class OSMPolygon(Base, OSMBase, OSMWayBase):
 
     '''This class represents the PREFIX_polygon table generated by osm2pgsql.'''
 
     __tablename__ = '%s_polygon' % DB_PREFIX
 
     geom = geoalchemy.GeometryColumn('way', geoalchemy.MultiPolygon(2))
-    tracktype = Column('tracktype', String)
-    way_area = Column('way_area', Float)
 
 
-class OSMRoad(Base, OSMBase):
+class OSMRoad(Base, OSMBase, OSMWayBase):
 
     '''This class represents the PREFIX_road table generated by osm2pgsql.'''
 
     __tablename__ = '%s_roads' % DB_PREFIX
 
     geom = geoalchemy.GeometryColumn('way', geoalchemy.LineString(2))
-    tracktype = Column('tracktype', String)
-    way_area = Column('way_area', Float)
 
 
 geoalchemy.GeometryDDL(OSMPoint.__table__)
@@ -118,3 +122,135 @@ geoalchemy.GeometryDDL(OSMLine.__table__)
 geoalchemy.GeometryDDL(OSMPolygon.__table__)
 geoalchemy.GeometryDDL(OSMRoad.__table__)
 
+#: geometry types of the tables, see :func:`generalized_class`
+GEOMETRY_TYPES = {
+    OSMPoint: geoalchemy.Point,
+    OSMLine: geoalchemy.LineString,
+    OSMPolygon: geoalchemy.MultiPolygon,
+    OSMRoad: geoalchemy.LineString,
+}
+#: seconds after which missing generalized tables are looked up again, so
+#: running renderers use tables which are built later
+GENERALIZED_RECHECK = 60
+# table name: (class or None, time of lookup), see :func:`generalized_class`
+_generalized = {}
+
+
+def generalized_name(db_class, level, digest):
+    '''
+    Returns the name of the generalized table of db_class for a zoom level
+    of a stylesheet, which contains the simplified features of this level
+    only, see :mod:`mapython.advisor`. The name contains the digest of the
+    stylesheet, so the table is not used by other stylesheets or after the
+    stylesheet changed.
+
+    :param db_class: one of the table classes
+    :param level: level name of the stylesheet
+    :param digest: :meth:`mapython.style.StyleSheet.digest`
+    '''
+
+    return '%s_l%s_%s' % (db_class.__tablename__, level, digest[:8])
+
+def generalized_class(db_class, level, digest):
+    '''
+    Returns the class of the generalized table of db_class for a zoom level
+    of a stylesheet if the table exists, see :func:`generalized_name`.
+    Existing tables are queried once, missing tables again after
+    :const:`GENERALIZED_RECHECK` seconds.
+
+    :param db_class: one of the table classes
+    :param level: level name of the stylesheet
+    :param digest: :meth:`mapython.style.StyleSheet.digest`
+
+    :returns: class with the columns of db_class or None
+    '''
+
+    name = generalized_name(db_class, level, digest)
+    cls, checked = _generalized.get(name, (None, None))
+    if cls is None and (checked is None
+            or time.time() - checked > GENERALIZED_RECHECK):
+        exists = session.execute(
+            'SELECT count(*) FROM information_schema.tables '
+            'WHERE table_schema = current_schema() AND table_name = :name',
+            {'name': name}
+        ).scalar()
+        if exists:
+            bases = (Base, ) + tuple(base for base in db_class.__bases__
+                if base is not Base)
+            cls = type(str('%sL%s_%s' % (db_class.__name__, level,
+                digest[:8])), bases, {
+                    '__tablename__': name,
+                    'geom': geoalchemy.GeometryColumn('way',
+                        GEOMETRY_TYPES[db_class](2)),
+                })
+        _generalized[name] = (cls, time.time())
+    return cls
+
+
+class Row(object):
+
+    '''
+    Row of a query which is executed without the ORM, e.g. by
+    :class:`StatementCache`, columns are available as attributes.
+
+    :param names: attribute names of the columns
+    :param values: column values
+    '''
+
+    def __init__(self, names, values):
+        self.__dict__.update(zip(names, values))
+
+
+class StatementCache(object):
+
+    '''
+    Server-side prepared statements of queries which are executed again and
+    again with different parameters, e.g. the bbox queries of all maps
+    rendered by one process. The SQL of each query is built once and the
+    statement is prepared once per database connection, so PostgreSQL parses
+    and plans it only once. Statements are named by a hash of their SQL, so
+    several caches on the same connection share identical statements and
+    never execute the statement of another query.
+
+    :param types: SQL types of the parameters of all statements
+    '''
+
+    def __init__(self, types=('float8', ) * 6):
+        self.types = tuple(types)
+        # key: (statement name, SQL)
+        self.statements = {}
+        self.hits = self.misses = 0
+
+    def execute(self, key, build, params):
+        '''
+        Executes the prepared statement of key with params.
+
+        :param key: hashable key of the query
+        :param build: callable which returns the SQL of the query with the
+            placeholders ``$1``, ``$2``, ... of params, called once per key
+        :param params: list of parameter values in the order of types
+
+        :returns: list of rows as tuples
+        '''
+
+        if key in self.statements:
+            self.hits += 1
+        else:
+            self.misses += 1
+            sql = build()
+            digest = hashlib.sha1('%s|%s' % (','.join(self.types),
+                sql)).hexdigest()
+            self.statements[key] = ('mapython_%s' % digest[:20], sql)
+        name, sql = self.statements[key]
+        connection = session.connection()
+        # statements live as long as the DBAPI connection, Connection.info
+        # is bound to it
+        prepared = connection.info.setdefault('mapython_statements', set())
+        cursor = connection.connection.cursor()
+        if name not in prepared:
+            cursor.execute('PREPARE %s (%s) AS %s' % (name,
+                ', '.join(self.types), sql))
+            prepared.add(name)
+        cursor.execute('EXECUTE %s (%s)' % (name,
+            ', '.join(['%s'] * len(params))), tuple(params))
+        return cursor.fetchall()
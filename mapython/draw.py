@@ -1,10 +1,86 @@
 # coding: utf-8
 import math
+import functools
+import collections
 import cairo
 import numpy
+import pyproj
 from shapely.geometry import Point, LineString, Polygon, box
 from mapython import projection
 from mapython import utils
+from mapython import png
+from mapython.clip import clip_line, clip_ring
+
+
+class FontCache(object):
+
+    '''
+    Scaled fonts and text extents shared by all maps of a process. Maps use
+    few fonts and street names repeat within and across maps, so every font
+    is created once and the extents of the most recently measured texts are
+    kept.
+
+    :param max_extents: max number of cached text extents
+    '''
+
+    def __init__(self, max_extents=10000):
+        self.max_extents = max_extents
+        # (family, slant, weight, size): cairo.ScaledFont
+        self.fonts = {}
+        # (font, text): extents, in order of use
+        self.extents = collections.OrderedDict()
+        self.hits = self.misses = 0
+
+    def scaled_font(self, family, slant, weight, size):
+        '''
+        Returns the scaled font, which is created on first use.
+
+        :param family: font name
+        :param slant: one of :const:`cairo.FONT_SLANT_*`
+        :param weight: one of :const:`cairo.FONT_WEIGHT_*`
+        :param size: font-size in unit (pixel/point)
+
+        :returns: :class:`cairo.ScaledFont`
+        '''
+
+        key = (family, slant, weight, size)
+        if key not in self.fonts:
+            self.fonts[key] = cairo.ScaledFont(
+                cairo.ToyFontFace(family, slant, weight),
+                cairo.Matrix(xx=size, yy=size),
+                cairo.Matrix(),
+                cairo.FontOptions()
+            )
+        return self.fonts[key]
+
+    def text_extents(self, font, text):
+        '''
+        Returns the extents of text, the least recently used extents are
+        evicted once more than max_extents are cached.
+
+        :param font: ``(family, slant, weight, size)``
+        :param text: text as str or unicode
+
+        :returns: ``(x_bearing, y_bearing, width, height, x_advance,
+            y_advance)``
+        '''
+
+        key = (font, text)
+        extents = self.extents.pop(key, None)
+        if extents is None:
+            self.misses += 1
+            extents = self.scaled_font(*font).text_extents(text)
+            if len(self.extents) >= self.max_extents:
+                self.extents.popitem(last=False)
+        else:
+            self.hits += 1
+        #: mark as recently used
+        self.extents[key] = extents
+        return extents
+
+
+#: font cache of all maps, see :attr:`Map.fonts`
+FONTS = FontCache()
 
 
 class Map(object):
@@ -19,8 +95,19 @@ class Map(object):
         surface_type
     :param projection: projection function for drawing the map,
         should return (x, y) in metres. Some functions are predefined in
-        :mod:`mapython.projection`
-    :param surface_type: must be one of png, pdf, ps or svg
+        :mod:`mapython.projection`, which project whole coordinate arrays
+        at once
+    :param surface_type: must be one of png, png8 (8-bit palette png), pdf,
+        ps, svg or recording (:class:`cairo.RecordingSurface` which can be
+        replayed onto other surfaces)
+    :param region: ``(x, y, width, height)`` in unit, only allocate surface
+        for this part of the map. The map keeps the coordinate system of the
+        whole map, but bbox is reduced to the region, so maps can be rendered
+        band by band with bounded memory, see :mod:`mapython.poster`
+    :param projected: coordinates passed to the draw methods are already
+        projected (in metres), e.g. data stored in EPSG:3857 for mercator
+        maps, so only the affine transformation to unit is applied. The bbox
+        is always given as ``(minlon, minlat, maxlon, maxlat)``
     '''
 
     SURFACE_TYPES = {
@@ -37,11 +124,15 @@ class Map(object):
         max_size=800,
         proj=projection.mercator,
         surface_type='png',
+        region=None,
+        projected=False,
     ):
         self.fobj = fobj
         self.bbox = box(*bbox)
         self.max_size = max_size
         self.surface_type = surface_type
+        self.region = region
+        self.projected = projected
         # projection can't be integrated in matrix because projection is not
         # necessarily linear
         self.projection = proj
@@ -49,11 +140,18 @@ class Map(object):
         self._init_coord_system()
         # inits: self.width, self.height, self.surface
         self._init_surface()
-        # inits: self.m2unit_matrix, self.unit2m_matrix, self.scale
+        # inits: self.x_scale, self.y_scale, self.m2unit_matrix,
+        # self.unit2m_matrix, self.scale
         self._init_transformation()
         self.context = cairo.Context(self.surface)
+        if region is not None:
+            self._init_region()
         self.map_area = box(0, 0, self.width, self.height)
         self.conflict_area = Polygon()
+        # path: cairo.ImageSurface, see :meth:`load_image`
+        self.images = {}
+        #: :class:`FontCache` used by all text operations
+        self.fonts = FONTS
 
     def _init_coord_system(self):
         minlon, minlat, maxlon, maxlat = self.bbox.bounds
@@ -79,29 +177,45 @@ class Map(object):
         else:
             self.width = int(math.ceil(self.max_size/self.y_diff*self.x_diff))
             self.height = self.max_size
+        #: only allocate surface for region
+        width, height = self.width, self.height
+        if self.region is not None:
+            width, height = self.region[2:]
         #: init surface object according to surface_type
         if self.SURFACE_TYPES.get(self.surface_type) is not None:
             surface_cls = self.SURFACE_TYPES.get(self.surface_type)
-            self.surface = surface_cls(self.fobj, self.width, self.height)
+            self.surface = surface_cls(self.fobj, width, height)
+        elif self.surface_type == 'recording':
+            self.surface = cairo.RecordingSurface(cairo.CONTENT_COLOR_ALPHA,
+                (0, 0, width, height))
         #: fall back to png as default type
         else:
-            self.surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.width,
-                self.height)
+            self.surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width,
+                height)
 
     def _init_transformation(self):
-        x_scale = self.width / self.x_diff # unit per metre
-        y_scale = self.height / self.y_diff # unit per metre
+        self.x_scale = self.width / self.x_diff # unit per metre
+        self.y_scale = self.height / self.y_diff # unit per metre
         #: transformation matrix to convert from metres to unit
-        self.m2unit_matrix = cairo.Matrix(xx=x_scale, yy=y_scale)
+        self.m2unit_matrix = cairo.Matrix(xx=self.x_scale, yy=self.y_scale)
         #: transformation matrix to convert from unit to metres
         #: NOTE: copy.copy or copy.deepcopy of m2unit_matrix does not work
-        self.unit2m_matrix = cairo.Matrix(xx=x_scale, yy=y_scale)
+        self.unit2m_matrix = cairo.Matrix(xx=self.x_scale, yy=self.y_scale)
         self.unit2m_matrix.invert()
         #: determine average metres per px => scale
         dist = self.unit2m_matrix.transform_distance(math.sqrt(0.5),
             math.sqrt(0.5))
         self.scale = sum(dist) / 2
 
+    def _init_region(self):
+        x, y, width, height = self.region
+        # surface origin is the upper left corner of the region
+        self.context.translate(-x, -y)
+        #: reduce bbox to region
+        minlon, maxlat = self.transform_coords_inverse(x, y)
+        maxlon, minlat = self.transform_coords_inverse(x + width, y + height)
+        self.bbox = box(minlon, minlat, maxlon, maxlat)
+
     def draw_background(self, color):
         '''
         Fills the whole map with color.
@@ -133,13 +247,18 @@ class Map(object):
         :param line_dash: list/tuple used by :meth:`cairo.Context.set_dash`
         '''
 
-        #: move to first coords
-        x, y = self.transform_coords(*coords[0])
-        self.context.move_to(x, y)
-        #: draw line to rest of coords
-        for lon, lat in coords[1:]:
-            x, y = self.transform_coords(lon, lat)
-            self.context.line_to(x, y)
+        lines = [self.transform_array(coords)]
+        # clipping would shift the dash pattern of the visible parts
+        if not line_dash:
+            lines = clip_line(lines[0], self.clip_bounds(width))
+            if not lines:
+                return
+        for points in lines:
+            #: move to first coords
+            self.context.move_to(*points[0])
+            #: draw line to rest of coords
+            for x, y in points[1:]:
+                self.context.line_to(x, y)
         #: fill line with color
         self.context.set_source_rgba(*color)
         self.context.set_line_width(width)
@@ -180,13 +299,21 @@ class Map(object):
         polygons = (exterior, )
         if interiors is not None:
             polygons += interiors
-        for coords in polygons:
+        bounds = self.clip_bounds(border_width)
+        for index, coords in enumerate(polygons):
+            points = self.transform_array(coords)
+            # clipping would shift the dash pattern of the border
+            if not border_line_dash:
+                points = clip_ring(points, bounds)
+                if points is None:
+                    # polygon is invisible if its exterior is
+                    if index == 0:
+                        return
+                    continue
             #: move to first coords
-            x, y = self.transform_coords(*coords[0])
-            self.context.move_to(x, y)
+            self.context.move_to(*points[0])
             #: draw line to rest of coords
-            for lon, lat in coords[1:]:
-                x, y = self.transform_coords(lon, lat)
+            for x, y in points[1:]:
                 self.context.line_to(x, y)
         #: fill polygon with color [and background]
         self.context.set_source_rgba(*background_color)
@@ -312,9 +439,8 @@ class Map(object):
             return
         text = utils.text_transform(text, text_transform)
         #: draw spot name
-        self.context.select_font_face(font_family, font_style, font_weight)
-        self.context.set_font_size(font_size)
-        width, height = self.context.text_extents(text)[2:4]
+        font = self.set_font(font_family, font_style, font_weight, font_size)
+        width, height = self.fonts.text_extents(font, text)[2:4]
         if image is not None:
             image = cairo.ImageSurface.create_from_png(image)
             image_width, image_height = image.get_width(), image.get_height()
@@ -405,17 +531,19 @@ class Map(object):
             :meth:`cairo.Context.set_dash`
         :param text_transform: one of ``'lowercase'``, ``'uppercase'`` or
             ``'capitalize'``
+
+        :returns: list of ``(minx, miny, maxx, maxy)`` in unit which cover
+            the drawn text, empty if no text was drawn
         '''
 
         text = text.strip()
         if not text:
-            return
-        coords = map(lambda c: self.transform_coords(*c), coords)
+            return []
+        coords = self.transform_array(coords)
 
-        self.context.select_font_face(font_family, font_style, font_weight)
-        self.context.set_font_size(font_size)
+        font = self.set_font(font_family, font_style, font_weight, font_size)
         text = utils.text_transform(text, text_transform)
-        width, height = self.context.text_extents(text)[2:4]
+        width, height = self.fonts.text_extents(font, text)[2:4]
         font_ascent, font_descent = self.context.font_extents()[0:2]
         self.context.new_path()
         #: make sure line does not intersect other conflict objects
@@ -425,7 +553,7 @@ class Map(object):
         line = line.difference(self.conflict_area)
         #: check whether line is empty or is split into several different parts
         if line.geom_type == 'GeometryCollection':
-            return
+            return []
         elif line.geom_type == 'MultiLineString':
             longest = None
             min_len = width * 1.2
@@ -435,13 +563,13 @@ class Map(object):
                     longest = seg
                     min_len = seg_len
             if longest is None:
-                return
+                return []
             line = longest
         coords = tuple(line.coords)
         seg = utils.linestring_text_optimal_segment(coords, width)
         # line has either to much change in gradients or is too short
         if seg is None:
-            return
+            return []
         #: crop optimal segment of linestring
         start, end = seg
         coords = coords[start:end+1]
@@ -455,7 +583,8 @@ class Map(object):
         # make sure text is rendered centered on line
         start_len = (line.length - width) / 2.
         char_coords = None
-        chars = utils.generate_char_geoms(self.context, text)
+        chars = utils.generate_char_geoms(self.context, text,
+            text_extents=functools.partial(self.fonts.text_extents, font))
         #: draw all character paths
         for char in utils.iter_chars_on_line(chars, line, start_len):
             for geom in char.geoms:
@@ -465,9 +594,17 @@ class Map(object):
                     self.context.line_to(lon, lat)
                 self.context.close_path()
         #: only add line to reserved area if text was drawn
+        boxes = []
         if char_coords is not None:
             covered = line.buffer(height)
             self.conflict_union(covered)
+            #: boxes of the drawn segment, the remaining line stays free for
+            #: other labels, see :class:`mapython.labels.LabelEngine`
+            points = numpy.array(coords)
+            boxes = [tuple(bounds) for bounds in numpy.hstack((
+                numpy.minimum(points[:-1], points[1:]) - height,
+                numpy.maximum(points[:-1], points[1:]) + height,
+            ))]
         #: draw border around characters
         self.context.set_line_cap(cairo.LINE_CAP_ROUND)
         self.context.set_source_rgba(*text_halo_color)
@@ -479,6 +616,138 @@ class Map(object):
         #: fill actual text
         self.context.set_source_rgba(*color)
         self.context.fill()
+        return boxes
+
+    def label_size(
+        self,
+        text,
+        font_size=11,
+        font_family='Tahoma',
+        font_style=cairo.FONT_SLANT_NORMAL,
+        font_weight=cairo.FONT_WEIGHT_NORMAL,
+        text_transform=None,
+        image=None,
+        image_margin=4
+    ):
+        '''
+        Returns the size of the box of a label drawn by :meth:`draw_label`,
+        see :meth:`draw_text` for the arguments.
+
+        :returns: ``(width, height, image_width)`` in unit
+        '''
+
+        width = height = image_width = 0
+        if text:
+            text = utils.text_transform(text, text_transform)
+            font = self.set_font(font_family, font_style, font_weight,
+                font_size)
+            width, height = self.fonts.text_extents(font, text)[2:4]
+        if image is not None:
+            image = self.load_image(image)
+            image_width = image.get_width()
+            height = max(height, image.get_height())
+            width += image_width
+            if text:
+                width += image_margin
+        return width, height, image_width
+
+    def draw_label(
+        self,
+        bounds,
+        text,
+        color=(0, 0, 0),
+        font_size=11,
+        font_family='Tahoma',
+        font_style=cairo.FONT_SLANT_NORMAL,
+        font_weight=cairo.FONT_WEIGHT_NORMAL,
+        text_halo_width=3,
+        text_halo_color=(1, 1, 1),
+        text_halo_line_cap=cairo.LINE_CAP_ROUND,
+        text_halo_line_join=cairo.LINE_JOIN_ROUND,
+        text_halo_line_dash=None,
+        text_transform=None,
+        image=None,
+        image_margin=4
+    ):
+        '''
+        Draws a label into a box placed by the caller, without any collision
+        tests, e.g. by :class:`mapython.labels.LabelEngine`. The image is
+        drawn at the left of the box and the text right of it, both are
+        centered vertically. See :meth:`draw_text` for the other arguments.
+
+        :param bounds: ``(minx, miny, maxx, maxy)`` in unit, the size is
+            given by :meth:`label_size`
+
+        :returns: ``(minx, miny, maxx, maxy)`` in unit covered by the label
+        '''
+
+        minx, miny, maxx, maxy = bounds
+        area = None
+        if image is not None:
+            image = self.load_image(image)
+            y = miny + (maxy - miny - image.get_height()) / 2.0
+            self.context.set_source_surface(image, minx, y)
+            self.context.paint()
+            area = (minx, y, minx + image.get_width(),
+                y + image.get_height())
+            minx += image.get_width() + image_margin
+        if not text:
+            return area
+        text = utils.text_transform(text, text_transform)
+        font = self.set_font(font_family, font_style, font_weight, font_size)
+        height = self.fonts.text_extents(font, text)[3]
+        # cairo uses the bottom left corner, round for clear text rendering
+        self.context.move_to(int(minx),
+            int(miny + (maxy - miny + height) / 2.0))
+        self.context.text_path(text)
+        #: draw text halo
+        self.context.set_source_rgba(*text_halo_color)
+        self.context.set_line_width(2 * text_halo_width)
+        self.context.set_line_cap(text_halo_line_cap)
+        self.context.set_line_join(text_halo_line_join)
+        self.context.set_dash(text_halo_line_dash or tuple())
+        self.context.stroke_preserve()
+        extents = self.context.path_extents()
+        if area is not None:
+            extents = (min(extents[0], area[0]), min(extents[1], area[1]),
+                max(extents[2], area[2]), max(extents[3], area[3]))
+        #: fill characters with color
+        self.context.set_source_rgba(*color)
+        self.context.fill()
+        return extents
+
+    def set_font(self, family, slant, weight, size):
+        '''
+        Selects the font for the following text operations, the scaled font
+        is taken from :attr:`fonts`.
+
+        :param family: font name
+        :param slant: one of :const:`cairo.FONT_SLANT_*`
+        :param weight: one of :const:`cairo.FONT_WEIGHT_*`
+        :param size: font-size in unit (pixel/point)
+
+        :returns: font key for :meth:`FontCache.text_extents`
+        '''
+
+        font = (family, slant, weight, size)
+        self.context.set_scaled_font(self.fonts.scaled_font(*font))
+        return font
+
+    def load_image(self, image):
+        '''
+        Returns the surface of a png image, images given by path are loaded
+        once.
+
+        :param image: file object or path to image file
+
+        :returns: :class:`cairo.ImageSurface`
+        '''
+
+        if not isinstance(image, basestring):
+            return cairo.ImageSurface.create_from_png(image)
+        if image not in self.images:
+            self.images[image] = cairo.ImageSurface.create_from_png(image)
+        return self.images[image]
 
     def draw_image(self, coord, image):
         '''
@@ -503,6 +772,22 @@ class Map(object):
         self.context.paint()
         self.conflict_union(box(x, y, x + width, y + height))
 
+    def paint_map(self, mapobj):
+        '''
+        Paints another map of the same bbox onto this map scaled to the size
+        of this map, e.g. to replay a map recorded with surface type
+        ``'recording'`` in several sizes and formats.
+
+        :param mapobj: :class:`mapython.draw.Map`
+        '''
+
+        self.context.save()
+        self.context.scale(float(self.width) / mapobj.width,
+            float(self.height) / mapobj.height)
+        self.context.set_source_surface(mapobj.surface, 0, 0)
+        self.context.paint()
+        self.context.restore()
+
     def transform_coords(self, lon, lat):
         '''
         Transforms from ``(lon, lat)`` to ``(x, y)`` in unit (pixel or point).
@@ -513,10 +798,83 @@ class Map(object):
         :returns: (x, y) tuple in unit (pixel or point)
         '''
 
-        x, y = self.projection(lon, lat)
+        x, y = (lon, lat) if self.projected else self.projection(lon, lat)
         x_rel, y_rel = x - self.x0, self.y0 - y
         return self.m2unit_matrix.transform_point(x_rel, y_rel)
 
+    def transform_array(self, coords):
+        '''
+        Transforms an array of ``(lon, lat)`` to ``(x, y)`` in unit (pixel or
+        point). The whole array is projected at once by projections of
+        :mod:`mapython.projection` and :class:`pyproj.Proj`, other projection
+        functions are called for each coordinate. Projected coordinates (see
+        the projected argument of :class:`Map`) are only transformed by one
+        affine transformation of the whole array.
+
+        :param coords: iterable containing all coordinates as ``(lon, lat)``
+
+        :returns: float64 array of shape (n, 2) in unit (pixel or point)
+        '''
+
+        coords = numpy.asarray(coords, numpy.float64).reshape(-1, 2)
+        if self.projected:
+            pass
+        elif isinstance(self.projection, projection.Projection):
+            coords = numpy.column_stack(
+                self.projection.forward(coords[:, 0], coords[:, 1]))
+        elif isinstance(self.projection, pyproj.Proj):
+            coords = numpy.column_stack(
+                self.projection(coords[:, 0], coords[:, 1]))
+        else:
+            coords = numpy.array([self.projection(lon, lat)
+                for lon, lat in coords], numpy.float64).reshape(-1, 2)
+        points = numpy.empty_like(coords)
+        points[:, 0] = (coords[:, 0] - self.x0) * self.x_scale
+        points[:, 1] = (self.y0 - coords[:, 1]) * self.y_scale
+        return points
+
+    def clip_bounds(self, margin=0):
+        '''
+        Returns the bounds of the visible part of the map (the region if
+        given) in unit, which are used to clip lines and polygons before
+        drawing, see :mod:`mapython.clip`.
+
+        :param margin: added to each side in unit, e.g. the line width so
+            clipped line ends are not visible
+
+        :returns: ``(minx, miny, maxx, maxy)`` in unit
+        '''
+
+        x, y, width, height = self.region or (0, 0, self.width, self.height)
+        margin += 1
+        return (x - margin, y - margin, x + width + margin,
+            y + height + margin)
+
+    def world_offset(self):
+        '''
+        Returns the offset from the coordinates of this map to coordinates
+        in unit which are shared by all maps of the same scale and
+        projection, e.g. all tiles of a zoom level, see
+        :class:`mapython.labels.LabelGrid`.
+
+        :returns: ``(dx, dy)`` in unit
+        '''
+
+        return self.x0 * self.x_scale, -self.y0 * self.y_scale
+
+    def projected_bounds(self):
+        '''
+        Returns the bounds of the map bbox in the map projection.
+
+        :returns: ``(minx, miny, maxx, maxy)`` in metres
+        '''
+
+        minlon, minlat, maxlon, maxlat = self.bbox.bounds
+        minx, miny = self.projection(minlon, minlat)
+        maxx, maxy = self.projection(maxlon, maxlat)
+        return (min(minx, maxx), min(miny, maxy), max(minx, maxx),
+            max(miny, maxy))
+
     def transform_coords_inverse(self, x, y):
         '''
         Transforms from ``(x, y)`` in unit (pixel or point) to ``(lon, lat)``.
@@ -608,11 +966,24 @@ class Map(object):
         density_intersection = self.conflict_area.intersection(density_area)
         return density_intersection.area / density_area.area
 
-    def write(self):
-        '''Writes surface to file object.'''
+    def write(self, palette=None, **png_options):
+        '''
+        Writes surface to file object.
+
+        :param palette: iterable of colors ``(r, g, b[, a])`` which are always
+            part of the palette of png8 maps, e.g. the colors of the
+            stylesheet, see :meth:`mapython.style.StyleSheet.iter_colors`
+        :param png_options: additional keyword arguments for png8 maps, see
+            :func:`mapython.png.write_indexed`
+        '''
 
         if self.surface_type == 'png':
             self.surface.write_to_png(self.fobj)
+        elif self.surface_type == 'png8':
+            if palette is not None:
+                palette = map(png.color2argb, palette)
+            png.write_surface_indexed(self.fobj, self.surface,
+                palette=palette, **png_options)
         else:
             self.surface.finish()
 
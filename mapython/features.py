@@ -0,0 +1,251 @@
+# coding: utf-8
+import struct
+import numpy
+
+
+#: WKB geometry types
+WKB_POINT = 1
+WKB_LINESTRING = 2
+WKB_POLYGON = 3
+WKB_MULTIPOINT = 4
+WKB_MULTILINESTRING = 5
+WKB_MULTIPOLYGON = 6
+WKB_GEOMETRYCOLLECTION = 7
+#: flags of the extended WKB format of PostGIS
+EWKB_Z = 0x80000000
+EWKB_M = 0x40000000
+EWKB_SRID = 0x20000000
+
+
+def decode_wkb(geoms, columns=None):
+    '''
+    Decodes WKB geometries directly into a :class:`FeatureBatch` without
+    creating a geometry object per feature. Only the headers are parsed in
+    Python, the coordinates of each ring are read with
+    :func:`numpy.frombuffer` and copied once into the contiguous coordinate
+    array of the batch. Z and M values are dropped.
+
+    :param geoms: iterable of WKB or EWKB geometries as str or buffer
+    :param columns: dict of tag columns, see :class:`FeatureBatch`
+
+    :returns: :class:`FeatureBatch`
+    '''
+
+    chunks = []
+    ring_sizes = []
+    part_rings = []
+    feature_parts = []
+    geom_types = []
+    for data in geoms:
+        number = len(part_rings)
+        _, geom_type = _read_geometry(data, 0, chunks, ring_sizes,
+            part_rings)
+        feature_parts.append(len(part_rings) - number)
+        geom_types.append(geom_type)
+    if chunks:
+        coords = numpy.concatenate(chunks)
+    else:
+        coords = numpy.empty((0, 2), numpy.float64)
+    return FeatureBatch(
+        coords,
+        _offsets(ring_sizes),
+        _offsets(part_rings),
+        _offsets(feature_parts),
+        numpy.array(geom_types, numpy.uint8),
+        columns
+    )
+
+def decode_rows(rows):
+    '''
+    Decodes the geometries of all database rows which are not decoded yet
+    into one :class:`FeatureBatch` and sets the attributes ``wkb_type`` (see
+    :const:`WKB_POINT` etc.), ``parts`` (see :meth:`FeatureBatch.geometry`)
+    and ``coords`` (see :meth:`FeatureBatch.feature_coords`) of each row.
+    The coordinates of the rows are views into the coordinate array of the
+    batch.
+
+    :param rows: list of objects with geometry ``geom``
+
+    :returns: :class:`FeatureBatch` of the newly decoded rows
+    '''
+
+    rows = [row for row in rows if getattr(row, 'parts', None) is None]
+    batch = FeatureBatch.from_rows(rows)
+    for index, row in enumerate(rows):
+        row.wkb_type = batch.geom_types[index]
+        row.parts = batch.geometry(index)
+        row.coords = batch.feature_coords(index)
+    return batch
+
+def _offsets(sizes):
+    offsets = numpy.zeros(len(sizes) + 1, numpy.int64)
+    numpy.cumsum(sizes, out=offsets[1:])
+    return offsets
+
+def _read_geometry(data, offset, chunks, ring_sizes, part_rings):
+    endian = '<' if struct.unpack_from('B', data, offset)[0] == 1 else '>'
+    geom_type = struct.unpack_from(endian + 'I', data, offset + 1)[0]
+    offset += 5
+    dims = 2
+    if geom_type & EWKB_SRID:
+        offset += 4
+    dims += bool(geom_type & EWKB_Z) + bool(geom_type & EWKB_M)
+    geom_type &= 0x0fffffff
+    #: ISO WKB types of 3D and measured geometries, e.g. 1001 for Point Z
+    dims += (0, 1, 1, 2)[geom_type / 1000]
+    geom_type %= 1000
+    if geom_type == WKB_POINT:
+        offset = _read_ring(data, offset, endian, dims, 1, chunks,
+            ring_sizes)
+        part_rings.append(1)
+    elif geom_type == WKB_LINESTRING:
+        offset = _read_ring(data, offset, endian, dims, None, chunks,
+            ring_sizes)
+        part_rings.append(1)
+    elif geom_type == WKB_POLYGON:
+        number = struct.unpack_from(endian + 'I', data, offset)[0]
+        offset += 4
+        for _ in xrange(number):
+            offset = _read_ring(data, offset, endian, dims, None, chunks,
+                ring_sizes)
+        part_rings.append(number)
+    elif WKB_MULTIPOINT <= geom_type <= WKB_GEOMETRYCOLLECTION:
+        number = struct.unpack_from(endian + 'I', data, offset)[0]
+        offset += 4
+        for _ in xrange(number):
+            offset, _ = _read_geometry(data, offset, chunks, ring_sizes,
+                part_rings)
+    else:
+        raise ValueError('unsupported WKB geometry type: %s' % geom_type)
+    return offset, geom_type
+
+def _read_ring(data, offset, endian, dims, number, chunks, ring_sizes):
+    if number is None:
+        number = struct.unpack_from(endian + 'I', data, offset)[0]
+        offset += 4
+    values = numpy.frombuffer(data, endian + 'f8', number * dims, offset)
+    chunks.append(values.reshape(number, dims)[:, :2])
+    ring_sizes.append(number)
+    return offset + 8 * number * dims
+
+
+class FeatureBatch(object):
+
+    '''
+    Columnar representation of the geometries and tags of many features.
+    The coordinates of all features are stored in one contiguous array and
+    geometries are described by offset arrays, so the coordinates of a ring
+    are a slice of the coordinate array without copying.
+
+    :param coords: float64 array of shape (n, 2)
+    :param ring_offsets: index of the first coordinate of each ring in
+        coords followed by the number of coordinates
+    :param part_offsets: index of the first ring of each part (e.g. each
+        polygon of a multipolygon) followed by the number of rings
+    :param feature_offsets: index of the first part of each feature
+        followed by the number of parts
+    :param geom_types: uint8 array of the WKB geometry type of each feature
+    :param columns: dict of tag columns, e.g. ``{'name': [...]}``
+    '''
+
+    def __init__(self, coords, ring_offsets, part_offsets, feature_offsets,
+            geom_types, columns=None):
+        self.coords = coords
+        self.ring_offsets = ring_offsets
+        self.part_offsets = part_offsets
+        self.feature_offsets = feature_offsets
+        self.geom_types = geom_types
+        self.columns = columns or {}
+
+    def __len__(self):
+        return len(self.geom_types)
+
+    @classmethod
+    def from_rows(cls, rows, columns=()):
+        '''
+        Decodes the geometries of database rows, see :func:`decode_wkb`.
+
+        :param rows: list of objects with geometry ``geom``, either a
+            geoalchemy element or WKB
+        :param columns: names of tag columns to copy from the rows
+
+        :returns: :class:`FeatureBatch`
+        '''
+
+        return decode_wkb(
+            (getattr(row.geom, 'geom_wkb', row.geom) for row in rows),
+            dict((c, [getattr(row, c) for row in rows]) for c in columns)
+        )
+
+    def ring(self, index):
+        '''
+        Returns coordinates of a ring as view of the coordinate array.
+
+        :param index: ring index
+
+        :returns: float64 array of shape (n, 2)
+        '''
+
+        return self.coords[
+            self.ring_offsets[index]:self.ring_offsets[index + 1]]
+
+    def part(self, index):
+        '''
+        Returns all rings of a part, e.g. exterior and interiors of a
+        polygon.
+
+        :param index: part index
+
+        :returns: list of float64 arrays
+        '''
+
+        return [self.ring(ring) for ring in
+            xrange(self.part_offsets[index], self.part_offsets[index + 1])]
+
+    def geometry(self, index):
+        '''
+        Returns all parts of a feature.
+
+        :param index: feature index
+
+        :returns: list of parts, see :meth:`part`
+        '''
+
+        return [self.part(part) for part in
+            xrange(self.feature_offsets[index],
+                self.feature_offsets[index + 1])]
+
+    def feature_coords(self, index):
+        '''
+        Returns all coordinates of a feature as view of the coordinate array.
+
+        :param index: feature index
+
+        :returns: float64 array of shape (n, 2)
+        '''
+
+        start = self.part_offsets[self.feature_offsets[index]]
+        end = self.part_offsets[self.feature_offsets[index + 1]]
+        return self.coords[self.ring_offsets[start]:self.ring_offsets[end]]
+
+
+class StyledFeature(object):
+
+    '''
+    Feature of a row with the style of one query group. Rows may be shared
+    by several groups and renderers (see :class:`mapython.render.FeatureSet`
+    and :class:`mapython.cache.QueryCache`), so the style is not set on the
+    row itself. All other attributes are the ones of the row.
+
+    :param row: decoded row, see :func:`decode_rows`
+    :param style: :class:`mapython.style.Style`
+    '''
+
+    __slots__ = ('row', 'style')
+
+    def __init__(self, row, style):
+        self.row = row
+        self.style = style
+
+    def __getattr__(self, name):
+        return getattr(self.row, name)
@@ -0,0 +1,330 @@
+# coding: utf-8
+import math
+import zlib
+import heapq
+import collections
+import numpy
+
+
+#: candidate positions of point labels in order of preference as multiples
+#: of half the label size plus gap: centered, right, left, above, below and
+#: diagonal, see :func:`candidate_boxes`
+POINT_OFFSETS = ((0, 0), (1, 0), (-1, 0), (0, -1), (0, 1), (1, -1),
+    (-1, -1), (1, 1), (-1, 1))
+#: offsets of the neighbouring cells, see :class:`LabelGrid`
+NEIGHBOURS = tuple((dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+    if dx or dy)
+
+
+def thin_grid(points, priorities, cell_size, limit=1):
+    '''
+    Thins out dense candidates of labels and images by a grid of square
+    cells, only the limit candidates with the highest priority of each cell
+    are kept. Candidates of the same priority are kept in their order, so
+    earlier candidates win.
+
+    :param points: float array of shape (n, 2) in unit (pixel or point)
+    :param priorities: sequence of n priorities, e.g. z-indexes
+    :param cell_size: edge length of the cells in unit
+    :param limit: max number of candidates per cell
+
+    :returns: sorted int array of the indexes of the kept candidates
+    '''
+
+    points = numpy.asarray(points, numpy.float64).reshape(-1, 2)
+    cells = numpy.floor(points / cell_size).astype(numpy.int64)
+    # sorted by cell, descending priority and index, the last key is the
+    # primary one
+    order = numpy.lexsort((
+        numpy.arange(len(points)),
+        -numpy.asarray(priorities),
+        cells[:, 1],
+        cells[:, 0],
+    ))
+    cells = cells[order]
+    #: position of each candidate within its cell
+    starts = numpy.ones(len(order), bool)
+    starts[1:] = (cells[1:] != cells[:-1]).any(axis=1)
+    first = numpy.maximum.accumulate(
+        numpy.where(starts, numpy.arange(len(order)), 0))
+    rank = numpy.arange(len(order)) - first
+    return numpy.sort(order[rank < limit])
+
+def candidate_boxes(bounds, offsets=POINT_OFFSETS, gap=2):
+    '''
+    Returns candidate boxes of a label by shifting its box, e.g. centered
+    on the labeled point, by offsets.
+
+    :param bounds: ``(minx, miny, maxx, maxy)`` of the label at its anchor
+    :param offsets: ``((fx, fy),)`` multiples of half the width and height
+        of the box plus gap the box is shifted by
+    :param gap: space between a shifted box and its anchor in unit
+
+    :returns: list of ``(minx, miny, maxx, maxy)`` in order of offsets
+    '''
+
+    minx, miny, maxx, maxy = bounds
+    dx = (maxx - minx) / 2.0 + gap
+    dy = (maxy - miny) / 2.0 + gap
+    return [(minx + fx * dx, miny + fy * dy, maxx + fx * dx, maxy + fy * dy)
+        for fx, fy in offsets]
+
+
+class CollisionIndex(object):
+
+    '''
+    Spatial hash of the boxes of placed labels for collision tests without
+    geometry operations. Every box is registered in all grid cells it
+    overlaps.
+
+    :param cell_size: edge length of the grid cells in unit
+    '''
+
+    def __init__(self, cell_size=64):
+        self.cell_size = float(cell_size)
+        # (column, row): [(minx, miny, maxx, maxy),]
+        self.cells = collections.defaultdict(list)
+
+    def iter_cells(self, bounds):
+        '''
+        Yields the grid cells which bounds overlaps.
+
+        :param bounds: ``(minx, miny, maxx, maxy)``
+
+        :yields: ``(column, row)``
+        '''
+
+        minx, miny, maxx, maxy = bounds
+        for column in xrange(int(minx // self.cell_size),
+                int(maxx // self.cell_size) + 1):
+            for row in xrange(int(miny // self.cell_size),
+                    int(maxy // self.cell_size) + 1):
+                yield column, row
+
+    def collides(self, bounds):
+        '''
+        Returns whether bounds overlaps any box of the index, touching boxes
+        do not collide.
+
+        :param bounds: ``(minx, miny, maxx, maxy)``
+        '''
+
+        minx, miny, maxx, maxy = bounds
+        for cell in self.iter_cells(bounds):
+            for x0, y0, x1, y1 in self.cells.get(cell, ()):
+                if minx < x1 and x0 < maxx and miny < y1 and y0 < maxy:
+                    return True
+        return False
+
+    def insert(self, bounds, margin=0):
+        '''
+        Adds a box to the index.
+
+        :param bounds: ``(minx, miny, maxx, maxy)``
+        :param margin: added to each side of the box
+        '''
+
+        minx, miny, maxx, maxy = bounds
+        bounds = (minx - margin, miny - margin, maxx + margin, maxy + margin)
+        for cell in self.iter_cells(bounds):
+            self.cells[cell].append(bounds)
+
+
+class LabelEngine(object):
+
+    '''
+    Places labels in the order of a global priority queue. Every label has
+    a fixed list of candidate boxes which are tested against a
+    :class:`CollisionIndex` in order of preference, the label is drawn at
+    the first free candidate within bounds or dropped.
+
+    Labels without candidates, e.g. text along lines, are placed by their
+    draw function itself, which returns the boxes it covers.
+
+    :param bounds: ``(minx, miny, maxx, maxy)`` labels must be within
+    :param margin: space around placed labels in unit
+    :param cell_size: see :class:`CollisionIndex`
+    '''
+
+    def __init__(self, bounds, margin=4, cell_size=64):
+        self.bounds = bounds
+        self.margin = margin
+        self.index = CollisionIndex(cell_size)
+        # heap of (negative priority, counter, candidates, draw)
+        self.queue = []
+        self.counter = 0
+        self.placed = self.dropped = 0
+
+    def add(self, priority, candidates, draw):
+        '''
+        Adds a label to the queue. Labels of higher priority are placed
+        first, labels of the same priority in the order they are added.
+
+        :param priority: comparable, e.g. a tuple of z-index and importance
+        :param candidates: list of ``(minx, miny, maxx, maxy)`` in order of
+            preference or None
+        :param draw: callable which is called with the chosen candidate (or
+            None) and returns a list of boxes covered by the drawn label,
+            which is empty if nothing was drawn
+        '''
+
+        if isinstance(priority, tuple):
+            key = tuple(-p for p in priority)
+        else:
+            key = -priority
+        heapq.heappush(self.queue, (key, self.counter, candidates, draw))
+        self.counter += 1
+
+    def __len__(self):
+        return len(self.queue)
+
+    def free_candidate(self, candidates):
+        '''
+        Returns the first candidate within bounds which does not collide
+        with placed labels.
+
+        :param candidates: list of ``(minx, miny, maxx, maxy)``
+
+        :returns: ``(minx, miny, maxx, maxy)`` or None
+        '''
+
+        minx, miny, maxx, maxy = self.bounds
+        for candidate in candidates:
+            if candidate[0] >= minx and candidate[1] >= miny \
+                    and candidate[2] <= maxx and candidate[3] <= maxy \
+                    and not self.index.collides(candidate):
+                return candidate
+        return None
+
+    def place(self, stop=None):
+        '''
+        Places and draws all queued labels in order of priority.
+
+        :param stop: callable which returns True if the remaining labels
+            are dropped, e.g. because the time budget runs out
+
+        :returns: number of drawn labels
+        '''
+
+        placed = self.placed
+        while self.queue:
+            _, _, candidates, draw = heapq.heappop(self.queue)
+            if stop is not None and stop():
+                self.dropped += len(self.queue) + 1
+                del self.queue[:]
+                break
+            candidate = None
+            if candidates is not None:
+                candidate = self.free_candidate(candidates)
+                if candidate is None:
+                    self.dropped += 1
+                    continue
+            covered = draw(candidate)
+            if not covered:
+                self.dropped += 1
+                continue
+            for bounds in covered:
+                self.index.insert(bounds, self.margin)
+            self.placed += 1
+        return self.placed - placed
+
+
+class LabelGrid(object):
+
+    '''
+    Decides the labels of maps of the same scale consistently, e.g. of
+    neighbouring tiles, so labels at the edges of a map are drawn complete
+    and identical in every map they reach into. Labels are assigned to the
+    cells of a grid by their center in a coordinate system shared by all
+    maps (see :meth:`mapython.draw.Map.world_offset`). Only the label of
+    highest rank of each cell is kept and it is dropped if it overlaps the
+    label of higher rank of a neighbouring cell. The rank is the priority
+    followed by a tie-break derived from the feature id. Labels are never
+    shifted, so the decision only depends on the labels of a cell and its
+    neighbours. Every map which knows the labels within two cells plus the
+    max distance labels reach beyond their center around it decides the
+    same, see :meth:`mapython.style.StyleSheet.label_buffer`.
+
+    :param cell_size: edge length of the cells in unit, should be larger
+        than most labels
+    :param offset: ``(dx, dy)`` added to the coordinates of the map to get
+        the shared coordinates
+    :param margin: space between labels of neighbouring cells in unit
+    '''
+
+    def __init__(self, cell_size=64, offset=(0, 0), margin=4):
+        self.cell_size = float(cell_size)
+        self.offset = offset
+        self.margin = margin
+        # cell: (rank, bounds, shared bounds, draw)
+        self.labels = {}
+
+    def add(self, key, priority, bounds, draw):
+        '''
+        Adds a label to the cell of its center, where it replaces a label of
+        lower rank.
+
+        :param key: feature id, e.g. the osm_id
+        :param priority: comparable, see :meth:`LabelEngine.add`
+        :param bounds: ``(minx, miny, maxx, maxy)`` in unit of the map
+        :param draw: callable which is called with bounds and returns a list
+            of covered boxes, see :meth:`LabelEngine.add`
+        '''
+
+        dx, dy = self.offset
+        # rounded, so the float noise of the offsets of different maps does
+        # not change the decision
+        shared = tuple(round(value, 3) for value in (bounds[0] + dx,
+            bounds[1] + dy, bounds[2] + dx, bounds[3] + dy))
+        cell = (int(math.floor((shared[0] + shared[2]) / 2.0
+            / self.cell_size)), int(math.floor((shared[1] + shared[3])
+            / 2.0 / self.cell_size)))
+        rank = (priority, zlib.crc32(str(key)) & 0xffffffff, str(key))
+        if cell not in self.labels or rank > self.labels[cell][0]:
+            self.labels[cell] = (rank, bounds, shared, draw)
+
+    def iter_winners(self):
+        '''
+        Yields the labels which are drawn by every map they reach into.
+
+        :yields: ``(rank, bounds, draw)``
+        '''
+
+        for (column, row), (rank, bounds, shared, draw) in \
+                self.labels.iteritems():
+            minx, miny, maxx, maxy = shared
+            minx -= self.margin
+            miny -= self.margin
+            maxx += self.margin
+            maxy += self.margin
+            for dx, dy in NEIGHBOURS:
+                other = self.labels.get((column + dx, row + dy))
+                if other is not None and other[0] > rank \
+                        and minx < other[2][2] and other[2][0] < maxx \
+                        and miny < other[2][3] and other[2][1] < maxy:
+                    break
+            else:
+                yield rank, bounds, draw
+
+    def place(self, visible, stop=None):
+        '''
+        Draws all labels of :meth:`iter_winners` which intersect the
+        visible part of the map.
+
+        :param visible: ``(minx, miny, maxx, maxy)`` in unit of the map
+        :param stop: callable which returns True if the remaining labels
+            are dropped, see :meth:`LabelEngine.place`
+
+        :returns: list of boxes covered by the drawn labels
+        '''
+
+        minx, miny, maxx, maxy = visible
+        covered = []
+        for _, bounds, draw in sorted(self.iter_winners(),
+                key=lambda winner: winner[0], reverse=True):
+            if stop is not None and stop():
+                break
+            if bounds[0] < maxx and minx < bounds[2] \
+                    and bounds[1] < maxy and miny < bounds[3]:
+                covered.extend(draw(bounds))
+        return covered
@@ -0,0 +1,260 @@
+# coding: utf-8
+import zlib
+import struct
+import numpy
+
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+#: PNG filter types supported by :func:`write_indexed`
+FILTER_NONE = 0
+FILTER_SUB = 1
+FILTER_UP = 2
+#: zlib strategies by name, Z_RLE is not exposed by the zlib module of
+#: Python 2 but supported by the zlib library since version 1.2.0.1
+ZLIB_STRATEGIES = {
+    'default': zlib.Z_DEFAULT_STRATEGY,
+    'filtered': zlib.Z_FILTERED,
+    'huffman': zlib.Z_HUFFMAN_ONLY,
+    'rle': getattr(zlib, 'Z_RLE', 3),
+}
+# max number of colors compared at once while searching nearest palette
+# entries, bounds memory to CHUNK_SIZE * 256 * 4 * 4 bytes
+CHUNK_SIZE = 4096
+
+
+def surface_array(surface):
+    '''
+    Returns pixels of a :class:`cairo.ImageSurface` in
+    :const:`cairo.FORMAT_ARGB32` as 2-dimensional uint32 array without
+    copying the pixel data.
+
+    :param surface: :class:`cairo.ImageSurface`
+
+    :returns: :class:`numpy.ndarray` of shape (height, width)
+    '''
+
+    surface.flush()
+    data = numpy.frombuffer(surface.get_data(), numpy.uint32)
+    data = data.reshape(surface.get_height(), surface.get_stride() / 4)
+    return data[:, :surface.get_width()]
+
+def color2argb(color):
+    '''
+    Converts color as used in stylesheets to a premultiplied ARGB32 value
+    as used by cairo.
+
+    :param color: ``(r, g, b[, a])`` with values between 0 and 1
+
+    :returns: int
+    '''
+
+    alpha = color[3] if len(color) > 3 else 1
+    a = int(round(alpha * 255))
+    r, g, b = (int(round(c * alpha * 255)) for c in color[:3])
+    return a << 24 | r << 16 | g << 8 | b
+
+def split_argb(pixels):
+    '''
+    Splits premultiplied ARGB32 values into unpremultiplied channels.
+
+    :param pixels: uint32 array
+
+    :returns: ``(r, g, b, a)`` uint8 arrays
+    '''
+
+    a = (pixels >> 24).astype(numpy.uint32)
+    channels = []
+    for shift in (16, 8, 0):
+        c = (pixels >> shift) & 0xff
+        # undo premultiplication, fully transparent pixels stay black
+        c = numpy.where(a > 0, (c * 255 + a / 2) / numpy.maximum(a, 1), 0)
+        channels.append(numpy.minimum(c, 255).astype(numpy.uint8))
+    return tuple(channels) + (a.astype(numpy.uint8), )
+
+def quantize(pixels, colors=256, palette=None):
+    '''
+    Reduces premultiplied ARGB32 pixels to a palette of at most colors
+    entries. If the image contains more colors, the palette consists of the
+    given palette colors (e.g. all colors of a stylesheet) followed by the
+    most frequent colors of the image and every pixel is mapped to the
+    nearest palette entry.
+
+    :param pixels: 2-dimensional uint32 array, see :func:`surface_array`
+    :param colors: max number of palette entries (<= 256)
+    :param palette: iterable of ARGB32 values which are always part of the
+        palette, see :func:`color2argb`
+
+    :returns: ``(indexes, palette)`` where indexes is a uint8 array of the
+        shape of pixels and palette a uint32 array of ARGB32 values
+    '''
+
+    unique, inverse, counts = numpy.unique(pixels, return_inverse=True,
+        return_counts=True)
+    if len(unique) <= colors:
+        return inverse.astype(numpy.uint8).reshape(pixels.shape), unique
+    #: seed palette with given colors and fill up with most frequent colors
+    seed = numpy.unique(numpy.array(list(palette or ()), numpy.uint32))
+    seed = seed[:colors]
+    frequent = unique[numpy.argsort(counts)[::-1]]
+    frequent = frequent[~numpy.in1d(frequent, seed)]
+    entries = numpy.concatenate((seed, frequent[:colors - len(seed)]))
+    #: map each unique color to its nearest palette entry
+    entry_channels = numpy.column_stack(
+        [(entries >> shift) & 0xff for shift in (24, 16, 8, 0)]
+    ).astype(numpy.int32)
+    mapping = numpy.empty(len(unique), numpy.uint8)
+    for start in xrange(0, len(unique), CHUNK_SIZE):
+        chunk = unique[start:start + CHUNK_SIZE]
+        channels = numpy.column_stack(
+            [(chunk >> shift) & 0xff for shift in (24, 16, 8, 0)]
+        ).astype(numpy.int32)
+        diff = channels[:, numpy.newaxis, :] - entry_channels[numpy.newaxis]
+        dist = (diff * diff).sum(axis=2)
+        mapping[start:start + CHUNK_SIZE] = dist.argmin(axis=1)
+    return mapping[inverse].reshape(pixels.shape), entries
+
+def filter_rows(indexes, png_filter=FILTER_NONE):
+    '''
+    Applies PNG filter to each row and prepends the filter type byte.
+
+    :param indexes: 2-dimensional uint8 array
+    :param png_filter: one of :const:`FILTER_NONE`, :const:`FILTER_SUB` or
+        :const:`FILTER_UP`
+
+    :returns: 2-dimensional uint8 array with one additional column
+    '''
+
+    if png_filter == FILTER_SUB:
+        filtered = indexes.copy()
+        filtered[:, 1:] -= indexes[:, :-1]
+    elif png_filter == FILTER_UP:
+        filtered = indexes.copy()
+        filtered[1:] -= indexes[:-1]
+    elif png_filter == FILTER_NONE:
+        filtered = indexes
+    else:
+        raise ValueError('unsupported PNG filter: %r' % png_filter)
+    types = numpy.empty((indexes.shape[0], 1), numpy.uint8)
+    types.fill(png_filter)
+    return numpy.hstack((types, filtered))
+
+def write_chunk(fobj, chunk_type, data):
+    fobj.write(struct.pack('>I', len(data)))
+    fobj.write(chunk_type)
+    fobj.write(data)
+    crc = zlib.crc32(chunk_type)
+    crc = zlib.crc32(data, crc)
+    fobj.write(struct.pack('>I', crc & 0xffffffff))
+
+def write_indexed(fobj, indexes, palette, compression=6, strategy='default',
+        png_filter=FILTER_NONE):
+    '''
+    Writes 8-bit palette PNG.
+
+    :param fobj: a filename or writable file object
+    :param indexes: 2-dimensional uint8 array of palette indexes
+    :param palette: uint32 array of premultiplied ARGB32 values
+    :param compression: zlib compression level (0-9)
+    :param strategy: zlib strategy, see :const:`ZLIB_STRATEGIES`, e.g.
+        ``'rle'`` is much faster and often nearly as small for map tiles
+    :param png_filter: PNG row filter, see :func:`filter_rows`
+    '''
+
+    if isinstance(fobj, basestring):
+        with open(fobj, 'wb') as real_fobj:
+            return write_indexed(real_fobj, indexes, palette, compression,
+                strategy, png_filter)
+    height, width = indexes.shape
+    r, g, b, a = split_argb(numpy.asarray(palette, numpy.uint32))
+    fobj.write(PNG_SIGNATURE)
+    # bit depth 8, color type 3 (indexed), default compression, filter and
+    # no interlace
+    write_chunk(fobj, 'IHDR', struct.pack('>IIBBBBB', width, height, 8, 3,
+        0, 0, 0))
+    write_chunk(fobj, 'PLTE', numpy.column_stack((r, g, b)).tostring())
+    if (a < 255).any():
+        write_chunk(fobj, 'tRNS', a.tostring())
+    compressor = zlib.compressobj(compression, zlib.DEFLATED, zlib.MAX_WBITS,
+        zlib.DEF_MEM_LEVEL, ZLIB_STRATEGIES.get(strategy, strategy))
+    data = compressor.compress(filter_rows(indexes, png_filter).tostring())
+    data += compressor.flush()
+    write_chunk(fobj, 'IDAT', data)
+    write_chunk(fobj, 'IEND', '')
+
+def write_surface_indexed(fobj, surface, colors=256, palette=None, **kwargs):
+    '''
+    Quantizes a :class:`cairo.ImageSurface` and writes it as 8-bit palette
+    PNG, see :func:`quantize` and :func:`write_indexed`.
+
+    :param fobj: a filename or writable file object
+    :param surface: :class:`cairo.ImageSurface`
+    :param colors: max number of palette entries (<= 256)
+    :param palette: iterable of ARGB32 values which are always part of the
+        palette
+    '''
+
+    indexes, entries = quantize(surface_array(surface), colors, palette)
+    write_indexed(fobj, indexes, entries, **kwargs)
+
+
+class PNGWriter(object):
+
+    '''
+    Writes a 32-bit RGBA PNG incrementally, so images can be written band by
+    band without keeping the whole image in memory.
+
+    :param fobj: writable file object
+    :param width: image width in pixel
+    :param height: image height in pixel
+    :param compression: zlib compression level (0-9)
+    :param strategy: zlib strategy, see :const:`ZLIB_STRATEGIES`
+    '''
+
+    def __init__(self, fobj, width, height, compression=6,
+            strategy='default'):
+        self.fobj = fobj
+        self.width = width
+        self.height = height
+        self.rows = 0
+        self.compressor = zlib.compressobj(compression, zlib.DEFLATED,
+            zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL,
+            ZLIB_STRATEGIES.get(strategy, strategy))
+        fobj.write(PNG_SIGNATURE)
+        # bit depth 8, color type 6 (RGBA), default compression, filter and
+        # no interlace
+        write_chunk(fobj, 'IHDR', struct.pack('>IIBBBBB', width, height, 8,
+            6, 0, 0, 0))
+
+    def write_surface(self, surface):
+        '''
+        Appends all rows of a :class:`cairo.ImageSurface`.
+
+        :param surface: :class:`cairo.ImageSurface` of the image width
+        '''
+
+        self.write_rows(surface_array(surface))
+
+    def write_rows(self, pixels):
+        '''
+        Appends rows of premultiplied ARGB32 pixels.
+
+        :param pixels: 2-dimensional uint32 array of the image width
+        '''
+
+        if pixels.shape[1] != self.width:
+            raise ValueError('row width does not match image width')
+        pixels = pixels[:self.height - self.rows]
+        rgba = numpy.dstack(split_argb(pixels))
+        rows = filter_rows(rgba.reshape(pixels.shape[0], -1))
+        data = self.compressor.compress(rows.tostring())
+        if data:
+            write_chunk(self.fobj, 'IDAT', data)
+        self.rows += pixels.shape[0]
+
+    def close(self):
+        '''Finishes image, all rows must have been written.'''
+
+        if self.rows != self.height:
+            raise ValueError('missing %s rows' % (self.height - self.rows))
+        write_chunk(self.fobj, 'IDAT', self.compressor.flush())
+        write_chunk(self.fobj, 'IEND', '')
@@ -0,0 +1,262 @@
+# coding: utf-8
+import functools
+import multiprocessing
+import StringIO
+import cairo
+from mapython import png
+from mapython.draw import Map
+from mapython.render import Renderer, DEFAULT_STYLESHEET
+from mapython.style import StyleSheet
+from mapython.cache import QueryCache
+from mapython.database import engine, session, StatementCache
+from mapython.seed import retry
+
+
+#: state of the current render process, see :func:`init_worker`
+_worker = {}
+
+
+def init_worker(stylesheets=None, query_cache=0, label_grid=None):
+    '''
+    Prepares the current process for rendering, so render jobs do not pay
+    for it: opens a dedicated database connection, loads the font faces and
+    palettes of all stylesheets and creates the renderer, which prepares the
+    queries of each level once, see
+    :class:`mapython.database.StatementCache`.
+
+    :param stylesheets: dict of named :class:`mapython.style.StyleSheet`,
+        the default stylesheet is used for the name None unless given
+    :param query_cache: max number of cached features, see
+        :class:`mapython.cache.QueryCache` and :func:`set_data_version`
+    :param label_grid: cell size in pixel of the labels placed identically
+        in neighbouring maps, see :class:`mapython.render.Renderer`
+    '''
+
+    stylesheets = dict(stylesheets or {})
+    stylesheets.setdefault(None, DEFAULT_STYLESHEET)
+    # database connections of the parent process must not be shared
+    session.close()
+    engine.dispose()
+    session.execute('SELECT 1')
+    # the queries of every level are prepared once per process
+    renderer = functools.partial(Renderer, statements=StatementCache(),
+        label_grid=label_grid)
+    if query_cache:
+        query_cache = QueryCache(query_cache)
+        renderer = functools.partial(renderer, query_cache=query_cache)
+    _worker.clear()
+    _worker.update({
+        'stylesheets': stylesheets,
+        'renderer': renderer,
+        'query_cache': query_cache or None,
+        'palettes': dict((name, map(png.color2argb, s.iter_colors()))
+            for name, s in stylesheets.iteritems()),
+        # tile surfaces by size which are reused by every job
+        'surfaces': {},
+    })
+    #: select every font face once, so fonts are loaded and cached
+    context = cairo.Context(cairo.ImageSurface(cairo.FORMAT_ARGB32, 1, 1))
+    for stylesheet in stylesheets.itervalues():
+        for face in iter_font_faces(stylesheet):
+            context.select_font_face(*face)
+            context.text_extents('mapython')
+
+def iter_font_faces(stylesheet):
+    '''
+    Returns generator which yields all font faces of a stylesheet.
+
+    :yields: ``(font_family, font_style, font_weight)``
+    '''
+
+    faces = set()
+    for geom_types in stylesheet.styles.itervalues():
+        for styles in geom_types.itervalues():
+            for style in styles.itervalues():
+                if style.get('text') is not None:
+                    # same defaults as in Renderer.queue_label
+                    faces.add((
+                        style.get('font-family', 'Tahoma'),
+                        style.get('font-style', cairo.FONT_SLANT_NORMAL),
+                        style.get('font-weight', cairo.FONT_WEIGHT_NORMAL),
+                    ))
+    return iter(faces)
+
+def set_data_version(version):
+    '''
+    Drops the features cached by the current render process if they were
+    fetched from another version of the data, see
+    :meth:`mapython.cache.QueryCache.validate`.
+
+    :param version: version of the data, e.g. timestamp of the last import
+        or replication state, the cache is kept if None
+    '''
+
+    query_cache = _worker.get('query_cache')
+    if query_cache is not None and version is not None:
+        query_cache.validate(version)
+
+def render_map(bbox, max_size, stylesheet=None, png_options=None,
+        deadline=None, data_version=None):
+    '''
+    Renders png map in the current render process.
+
+    :param bbox: ``(minlon, minlat, maxlon, maxlat)``
+    :param max_size: max map width/height in pixel
+    :param stylesheet: name of stylesheet, see :func:`init_worker`
+    :param png_options: write 8-bit palette png with these options, see
+        :func:`mapython.png.write_indexed`
+    :param deadline: time budget in seconds, see
+        :meth:`mapython.render.Renderer.run`
+    :param data_version: see :func:`set_data_version`
+
+    :returns: ``(data, skipped)`` where data is the png data as str and
+        skipped the set of work skipped to meet the deadline
+    '''
+
+    set_data_version(data_version)
+    fobj = StringIO.StringIO()
+    surface_type = 'png' if png_options is None else 'png8'
+    map_obj = Map(fobj, bbox, max_size, surface_type=surface_type)
+    renderer = _worker['renderer'](map_obj,
+        _worker['stylesheets'][stylesheet], quiet=True)
+    skipped = renderer.run(deadline=deadline)
+    if png_options is None:
+        map_obj.write()
+    else:
+        map_obj.write(renderer.stylesheet.iter_colors(), **png_options)
+    return fobj.getvalue(), skipped
+
+def render_tiles(bbox, numberx, numbery, width, height, stylesheet=None,
+        png_options=None, data_version=None):
+    '''
+    Renders a block of numberx x numbery tiles at once in the current render
+    process and splits it into single png tiles.
+
+    :param bbox: ``(minlon, minlat, maxlon, maxlat)`` of the whole block
+    :param numberx: number of tiles in x-direction
+    :param numbery: number of tiles in y-direction
+    :param width: tile width in pixel
+    :param height: tile height in pixel
+    :param stylesheet: name of stylesheet, see :func:`init_worker`
+    :param png_options: write 8-bit palette pngs with these options, see
+        :func:`mapython.png.write_indexed`
+    :param data_version: see :func:`set_data_version`
+
+    :returns: list of ``(i, j, data)`` where i and j are the tile offsets in
+        the block and data is the png data as str
+    '''
+
+    set_data_version(data_version)
+    map_obj = Map(None, bbox, max(width * numberx, height * numbery))
+    _worker['renderer'](map_obj, _worker['stylesheets'][stylesheet],
+        quiet=True).run()
+    tile = _worker['surfaces'].get((width, height))
+    if tile is None:
+        tile = _worker['surfaces'][(width, height)] = cairo.ImageSurface(
+            cairo.FORMAT_ARGB32, width, height)
+    context = cairo.Context(tile)
+    # replace the previous content of the reused surface
+    context.set_operator(cairo.OPERATOR_SOURCE)
+    tiles = []
+    for i in xrange(numberx):
+        for j in xrange(numbery):
+            context.set_source_surface(map_obj.surface, -i * width,
+                -j * height)
+            context.paint()
+            fobj = StringIO.StringIO()
+            if png_options is None:
+                tile.write_to_png(fobj)
+            else:
+                png.write_surface_indexed(fobj, tile,
+                    palette=_worker['palettes'][stylesheet], **png_options)
+            tiles.append((i, j, fobj.getvalue()))
+    return tiles
+
+def call(func, args, retries=0, backoff=1):
+    '''Calls func with args, see :func:`mapython.seed.retry`.'''
+
+    return retry(functools.partial(func, *args), retries, backoff)
+
+
+class RenderPool(object):
+
+    '''
+    Pool of pre-forked render processes which are kept warm between render
+    jobs, see :func:`init_worker`. Jobs are dispatched to idle processes and
+    the encoded png data is returned through pipes, so the calling process
+    never allocates a map surface.
+
+    :param processes: number of render processes
+    :param stylesheets: :class:`mapython.style.StyleSheet` or dict of named
+        stylesheets which are selected by the stylesheet argument of jobs
+    :param query_cache: max number of features cached by each process, see
+        :class:`mapython.cache.QueryCache`
+    :param label_grid: see :func:`init_worker`
+    :param retries: number of retries for failing jobs
+    :param backoff: waiting time before first retry in seconds
+    '''
+
+    def __init__(self, processes=3, stylesheets=None, query_cache=0,
+            retries=0, backoff=1, label_grid=None):
+        if isinstance(stylesheets, StyleSheet):
+            stylesheets = {None: stylesheets}
+        self.retries = retries
+        self.backoff = backoff
+        self.pool = multiprocessing.Pool(processes, init_worker,
+            (stylesheets, query_cache, label_grid))
+
+    def render(self, bbox, max_size, stylesheet=None, png_options=None,
+            deadline=None, timeout=None, data_version=None):
+        '''
+        Renders png map, see :func:`render_map`.
+
+        :param timeout: max waiting time in seconds, raises
+            :class:`multiprocessing.TimeoutError` if exceeded
+
+        :returns: ``(data, skipped)``
+        '''
+
+        return self.render_async(bbox, max_size, stylesheet, png_options,
+            deadline, data_version=data_version).get(timeout)
+
+    def render_async(self, bbox, max_size, stylesheet=None,
+            png_options=None, deadline=None, callback=None,
+            data_version=None):
+        '''
+        Renders png map without blocking, see :func:`render_map`.
+
+        :param callback: callable which is called with ``(data, skipped)``
+            once the map is rendered
+
+        :returns: :class:`multiprocessing.pool.AsyncResult`
+        '''
+
+        return self._apply(render_map, (bbox, max_size, stylesheet,
+            png_options, deadline, data_version), callback)
+
+    def render_tiles_async(self, bbox, numberx, numbery, width, height,
+            stylesheet=None, png_options=None, data_version=None):
+        '''
+        Renders block of tiles without blocking, see :func:`render_tiles`.
+
+        :returns: :class:`multiprocessing.pool.AsyncResult`
+        '''
+
+        return self._apply(render_tiles, (bbox, numberx, numbery, width,
+            height, stylesheet, png_options, data_version))
+
+    def close(self):
+        '''Waits until all jobs are done and stops all render processes.'''
+
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self):
+        '''Stops all render processes immediately.'''
+
+        self.pool.terminate()
+        self.pool.join()
+
+    def _apply(self, func, args, callback=None):
+        return self.pool.apply_async(call, (func, args, self.retries,
+            self.backoff), callback=callback)
@@ -0,0 +1,52 @@
+# coding: utf-8
+from mapython import projection
+from mapython import png
+from mapython.draw import Map
+from mapython.render import Renderer, DEFAULT_STYLESHEET
+
+
+def render_poster(
+    fobj,
+    bbox,
+    max_size,
+    stylesheet=DEFAULT_STYLESHEET,
+    proj=projection.mercator,
+    band_size=1024,
+    quiet=False,
+    **png_options
+):
+    '''
+    Renders a large png map band by band, so neither the pixel buffer nor the
+    features of the whole map have to be kept in memory. Labels are placed
+    once for the whole map on a :class:`cairo.RecordingSurface` before the
+    bands are rasterized, so they are consistent across bands.
+
+    :param fobj: a filename or writable file object
+    :param bbox: ``(minlon, minlat, maxlon, maxlat)``
+    :param max_size: max map width/height in pixel
+    :param stylesheet: :class:`mapython.style.StyleSheet`
+    :param proj: projection function, see :class:`mapython.draw.Map`
+    :param band_size: height of each band in pixel
+    :param quiet: specify whether some status information is printed
+    :param png_options: additional keyword arguments for
+        :class:`mapython.png.PNGWriter`
+    '''
+
+    if isinstance(fobj, basestring):
+        with open(fobj, 'wb') as real_fobj:
+            return render_poster(real_fobj, bbox, max_size, stylesheet, proj,
+                band_size, quiet, **png_options)
+    #: place all labels of the whole map without allocating pixels
+    labels = Map(None, bbox, max_size, proj, surface_type='recording')
+    Renderer(labels, stylesheet, quiet).run(geometry=False)
+    writer = png.PNGWriter(fobj, labels.width, labels.height, **png_options)
+    for top in xrange(0, labels.height, band_size):
+        height = min(band_size, labels.height - top)
+        band = Map(None, bbox, max_size, proj,
+            region=(0, top, labels.width, height))
+        Renderer(band, stylesheet, quiet).run(labels=False)
+        #: band context uses the coordinate system of the whole map
+        band.context.set_source_surface(labels.surface, 0, 0)
+        band.context.paint()
+        writer.write_surface(band.surface)
+    writer.close()
@@ -1,40 +1,140 @@
 # coding: utf-8
+import numpy
 import pyproj
 
 
-mercator = pyproj.Proj('''
-+proj=merc
-    +a=6378137
-    +b=6378137
-    +lat_ts=0
-    +lon_0=0
-    +x_0=0
-    +y_0=0
-    +k=1
-    +units=m
-    +nadgrids=@null
-    +no_defs
-''')
+#: radius of the sphere of the spherical projections in metres
+EARTH_RADIUS = 6378137
+
+
+class Projection(object):
+
+    '''
+    Base class of projections which transform whole arrays of coordinates at
+    once. Projections are callable like :class:`pyproj.Proj`, so they can be
+    used wherever a projection function is expected, e.g. by
+    :class:`mapython.draw.Map`. Subclasses implement :meth:`forward` and
+    :meth:`inverse`.
+    '''
+
+    def __call__(self, x, y, inverse=False):
+        '''
+        Projects ``(lon, lat)`` to ``(x, y)`` or the other way round if
+        inverse is True.
+
+        :param x: longitude in degree or x in metres, scalar or array
+        :param y: latitude in degree or y in metres, scalar or array
+        :param inverse: transform from ``(x, y)`` to ``(lon, lat)``
+
+        :returns: ``(x, y)`` or ``(lon, lat)``, floats for scalar input
+        '''
+
+        func = self.inverse if inverse else self.forward
+        if numpy.isscalar(x) and numpy.isscalar(y):
+            x, y = func(numpy.float64(x), numpy.float64(y))
+            return float(x), float(y)
+        return func(numpy.asarray(x, numpy.float64),
+            numpy.asarray(y, numpy.float64))
+
+    def forward(self, lon, lat):
+        '''
+        Projects arrays of geographic coordinates.
+
+        :param lon: array of longitudes in degree
+        :param lat: array of latitudes in degree
+
+        :returns: ``(x, y)`` arrays in metres
+        '''
+
+        raise NotImplementedError
+
+    def inverse(self, x, y):
+        '''
+        Transforms arrays of projected coordinates to geographic coordinates.
+
+        :param x: array of x in metres
+        :param y: array of y in metres
+
+        :returns: ``(lon, lat)`` arrays in degree
+        '''
+
+        raise NotImplementedError
+
+
+class Mercator(Projection):
+
+    '''
+    Spherical mercator projection in closed form, see
+    http://spatialreference.org/ref/epsg/3785/
+
+    :param radius: radius of the sphere in metres
+    '''
+
+    def __init__(self, radius=EARTH_RADIUS):
+        self.radius = radius
+
+    def forward(self, lon, lat):
+        return (
+            self.radius * numpy.radians(lon),
+            self.radius * numpy.log(numpy.tan(numpy.pi / 4
+                + numpy.radians(lat) / 2)),
+        )
+
+    def inverse(self, x, y):
+        return (
+            numpy.degrees(x / self.radius),
+            numpy.degrees(2 * numpy.arctan(numpy.exp(y / self.radius))
+                - numpy.pi / 2),
+        )
+
+
+class PlateCarree(Projection):
+
+    '''
+    Plate Carreé projection in closed form, see
+    http://spatialreference.org/ref/esri/53001/
+
+    :param radius: radius of the sphere in metres
+    '''
+
+    def __init__(self, radius=EARTH_RADIUS):
+        self.radius = radius
+
+    def forward(self, lon, lat):
+        return self.radius * numpy.radians(lon), \
+            self.radius * numpy.radians(lat)
+
+    def inverse(self, x, y):
+        return numpy.degrees(x / self.radius), numpy.degrees(y / self.radius)
+
+
+class ProjProjection(Projection):
+
+    '''
+    Projection of an arbitrary proj string, which is transformed by pyproj.
+
+    :param definition: proj string, e.g. ``'+proj=cass +a=6378137 ...'``
+    '''
+
+    def __init__(self, definition):
+        self.proj = pyproj.Proj(definition)
+
+    def forward(self, lon, lat):
+        return self.proj(lon, lat)
+
+    def inverse(self, x, y):
+        return self.proj(x, y, inverse=True)
+
+
+mercator = Mercator()
 '''Spherical mercator projection, see http://spatialreference.org/ref/epsg/3785/'''
 
 
-plate_carree = pyproj.Proj('''
-+proj=eqc
-    +a=6378137
-    +b=6378137
-    +lat_ts=0
-    +lon_0=0
-    +x_0=0
-    +y_0=0
-    +k=1
-    +units=m
-    +nadgrids=@null
-    +no_defs
-''')
+plate_carree = PlateCarree()
 '''Plate Carreé projection, see http://spatialreference.org/ref/esri/53001/'''
 
 
-cassini = pyproj.Proj('''
+cassini = ProjProjection('''
 +proj=cass
     +a=6378137
     +b=6378137
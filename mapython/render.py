@@ -1,15 +1,28 @@
 # coding: utf-8
 import os
 import math
+import time
+import json
+import weakref
 import functools
 import collections
 import cairo
 import numpy
-from sqlalchemy import and_
+from sqlalchemy import and_, or_, literal_column, bindparam, text, Float
+from psycopg2.extensions import AsIs
 from shapely import wkb
+from shapely.geometry import Polygon, box
 from mapython import utils
-from mapython.database import session, OSMPoint, OSMLine, OSMPolygon
+from mapython import projection
+from mapython.database import engine, session, OSMPoint, OSMLine, \
+    OSMPolygon, Row, generalized_class
 from mapython.style import StyleSheet
+from mapython.draw import Map
+from mapython.features import decode_rows, StyledFeature, WKB_POINT, \
+    WKB_LINESTRING
+from mapython.labels import LabelEngine, LabelGrid, thin_grid, \
+    candidate_boxes
+from mapython.cache import snap_size, intersects
 
 
 GEOM_TYPES = {
@@ -21,8 +34,57 @@ GEOM_TYPES = {
 COLUMN_ATTRS = ('text', )
 DEFAULT_STYLE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
     'styles/default.yml')
-BBOX_QUERY_COND = "(%s.way && SetSRID('BOX3D(%s %s, %s %s)'::box3d, 4326))"
+DEFAULT_STYLESHEET = StyleSheet(DEFAULT_STYLE)
+BBOX_QUERY_COND = "(%s.way && SetSRID('BOX3D(%s %s, %s %s)'::box3d, %s))"
+#: bbox condition with bound parameters, see :meth:`Renderer.fetch_objects`
+BBOX_PARAM_COND = '(%s.way && ST_SetSRID(ST_MakeBox2D(' \
+    'ST_Point(:minx, :miny), ST_Point(:maxx, :maxy)), %s))'
+#: parameters of the cull conditions, see :func:`cull_conditions`
+CULL_PARAMS = ('pixel_area', 'pixel_length')
+#: parameters of prepared statements in the order of their placeholders,
+#: see :class:`mapython.database.StatementCache`
+PREPARED_PARAMS = ('minx', 'miny', 'maxx', 'maxy', 'pixel_area',
+    'pixel_length')
+#: SRID of geographic coordinates, the default of the tables
+LATLON_SRID = 4326
+#: projections of data which is stored projected by its SRID, see
+#: :func:`table_srid`
+PROJECTED_SRIDS = {
+    3857: projection.mercator,
+    900913: projection.mercator,
+}
 TRANSPARENT = (0, 0, 0, 0)
+BOUNDS_FUNCS = ('ST_XMin', 'ST_YMin', 'ST_XMax', 'ST_YMax')
+#: optional work which is skipped once this fraction of the time budget of
+#: :meth:`Renderer.run` has elapsed
+DEGRADATION = {
+    'outlines': 0.4,
+    'borders': 0.5,
+    'text-on-line': 0.6,
+    'labels': 0.75,
+}
+#: features smaller than this area in square pixels (polygons) or shorter
+#: than this length in pixels (lines) are not fetched, styles override it
+#: with ``min-pixel-area`` and ``min-pixel-length``
+MIN_PIXEL_AREA = 1
+MIN_PIXEL_LENGTH = 1
+#: labels and images of points are thinned out by a grid of cells of this
+#: size in pixel before placement, only the ones with the highest z-index
+#: of each cell are placed, see :meth:`Renderer.thin_labels`
+LABEL_CELL_SIZE = 32
+LABEL_CELL_LIMIT = 2
+#: labels of the same z-index and label-priority are placed in this order
+#: (higher first), see :meth:`Renderer.queue_label`
+LABEL_GEOM_RANKS = {
+    WKB_POINT: 2,
+    WKB_LINESTRING: 1,
+}
+# table name: SRID, see :func:`table_srid`
+_srids = {}
+# stylesheet: {key: groups}, see :meth:`Renderer.query_groups`
+_query_groups = weakref.WeakKeyDictionary()
+# stylesheet: (revision, digest), see :func:`stylesheet_digest`
+_digests = weakref.WeakKeyDictionary()
 
 
 class Renderer(object):
@@ -33,33 +95,90 @@ class Renderer(object):
     :param mapobj: :class:`mapython.draw.Map`
     :param stylesheet: :class:`mapython.style.StyleSheet`
     :param quiet: specify whether some status information is printed
+    :param query_cache: :class:`mapython.cache.QueryCache` shared by several
+        renderers, so overlapping maps of the same and the next zoom level
+        do not fetch the same features again
+    :param features: :class:`FeatureSet` shared by renderers of the same bbox
+        with different stylesheets, see :func:`render_stylesheets`
+    :param statements: :class:`mapython.database.StatementCache` shared by
+        renderers, so the queries of each level are prepared once and only
+        executed with the bbox of every map
+    :param label_grid: cell size in pixel of a
+        :class:`mapython.labels.LabelGrid` which places the labels of points
+        and polygons identically in all maps of the same scale, e.g. tiles,
+        so labels are not cut at the edges. Features are fetched within two
+        cells plus :meth:`mapython.style.StyleSheet.label_buffer` around the
+        map, at least three cells.
     '''
 
     def __init__(
         self,
         mapobj,
-        stylesheet=StyleSheet(DEFAULT_STYLE),
-        quiet=False
+        stylesheet=DEFAULT_STYLESHEET,
+        quiet=False,
+        query_cache=None,
+        features=None,
+        statements=None,
+        label_grid=None
     ):
         self.mapobj = mapobj
         self.stylesheet = stylesheet
         self.quiet = quiet
+        self.query_cache = query_cache
+        self.features = features
+        self.statements = statements
+        self.label_grid = label_grid
         self.conflict_list = []
+        #: objects of each query group, see :meth:`group_objects`
+        self.fetched = {}
+        #: generalized tables of the current level replace the tables, see
+        #: :mod:`mapython.advisor`
+        level = self.stylesheet.get_level(self.mapobj.scale)
+        self.tables = dict(GEOM_TYPES)
+        if level is not None:
+            digest = stylesheet_digest(self.stylesheet)
+            for geom_type, db_class in GEOM_TYPES.iteritems():
+                self.tables[geom_type] = \
+                    generalized_class(db_class, level, digest) or db_class
+        #: ``(start, end)`` of time budget, see :meth:`run`
+        self.deadline = None
+        self.skipped = set()
+        #: data stored in the projection of the map is drawn without
+        #: reprojecting every vertex and queried by the projected bbox
+        self.srid = table_srid(OSMPolygon)
+        self.mapobj.projected = \
+            PROJECTED_SRIDS.get(self.srid) is self.mapobj.projection
+        if self.mapobj.projected:
+            #: bbox of the map in the coordinates of the data
+            self.data_bbox = box(*self.mapobj.projected_bounds())
+        else:
+            self.data_bbox = self.mapobj.bbox
         #: add a buffer of 0.05 % around actual bbox so every element
         #: is queried from database - e.g. if an element is actually outside
         #: of bbox but its visible extents are big enough to intersect
         #: the visible map
-        minx, miny, maxx, maxy = self.mapobj.bbox.bounds
+        minx, miny, maxx, maxy = self.data_bbox.bounds
         diffx = maxx - minx
         diffy = maxy - miny
         dilation = 0.0005 * math.sqrt(diffx ** 2 + diffy ** 2)
-        self.bbox = self.mapobj.bbox.buffer(dilation)
+        #: size of a pixel in the coordinates of the data
+        width, height = (self.mapobj.region
+            or (0, 0, self.mapobj.width, self.mapobj.height))[2:]
+        self.pixel_size = (diffx / width, diffy / height)
+        if self.label_grid is not None:
+            # labels reach up to the label buffer into the map and are
+            # decided by the labels of the neighbouring cells of their cell,
+            # see LabelGrid
+            dilation = max(dilation, max(3 * self.label_grid,
+                2 * self.label_grid + self.stylesheet.label_buffer())
+                * max(self.pixel_size))
+        self.bbox = self.data_bbox.buffer(dilation)
         self.verbose_print(
             'Zoomlevel:',
             self.stylesheet.get_level(self.mapobj.scale)
         )
 
-    def run(self):
+    def run(self, geometry=True, labels=True, deadline=None):
         '''
         Runs all rendering processes and draws the different layers in the
         correct order:
@@ -71,14 +190,59 @@ class Renderer(object):
             4. points
             5. conflicts (text, images etc.)
 
+        Layers 2 to 5 are skipped if the map contains no features. This is
+        answered by the queries of the layers themselves, so it costs no
+        extra query, see :meth:`has_features`.
+
+        If a deadline is given, optional work is skipped progressively while
+        the time budget runs out (see :const:`DEGRADATION`): line outlines,
+        borders, text on lines and finally the labels with lowest priority.
+
+        :param geometry: draw layers 0 to 4
+        :param labels: draw layer 5, only features with labels are fetched
+            if geometry is not drawn
+        :param deadline: time budget in seconds or None
+
+        :returns: set of skipped work, e.g. ``set(['borders', 'labels'])``,
+            so degraded maps can be rendered again in full quality later
+        '''
+
+        if deadline is not None:
+            start = time.time()
+            self.deadline = (start, start + deadline)
+        if geometry:
+            self.mapobj.draw_background(self.stylesheet.map_background)
+            self.coastlines()
+        if not self.has_features(labels_only=not geometry):
+            self.verbose_print('>  no features')
+            return self.skipped
+        if geometry or labels:
+            self.polygons(draw=geometry)
+            self.lines(draw=geometry)
+            self.points(draw=geometry)
+        if labels:
+            self.conflicts()
+        return self.skipped
+
+    def degrade(self, work):
+        '''
+        Returns whether optional work is skipped because the time budget of
+        :meth:`run` runs out. Once skipped, work is skipped for the rest of
+        the run and recorded in ``self.skipped``.
+
+        :param work: one of the keys of :const:`DEGRADATION`
         '''
 
-        self.mapobj.draw_background(self.stylesheet.map_background)
-        self.coastlines()
-        self.polygons()
-        self.lines()
-        self.points()
-        self.conflicts()
+        if work in self.skipped:
+            return True
+        if self.deadline is None:
+            return False
+        start, end = self.deadline
+        if time.time() - start < DEGRADATION[work] * (end - start):
+            return False
+        self.skipped.add(work)
+        self.verbose_print('>  skipped %s' % work)
+        return True
 
     def verbose_print(self, *args):
         if not self.quiet:
@@ -94,19 +258,14 @@ class Renderer(object):
             the area actually is no land mass
         '''
 
-        coastlines = session.query(OSMLine).filter(and_(
-            BBOX_QUERY_COND % ((OSMLine.__table__, ) + self.mapobj.bbox.bounds),
-            OSMLine.natural=='coastline'
-        )).all()
-        coastpolygons = session.query(OSMPolygon).filter(and_(
-            BBOX_QUERY_COND % ((OSMPolygon.__table__, ) + self.mapobj.bbox.bounds),
-            OSMPolygon.natural=='coastline'
-        )).all()
+        if self.features is not None:
+            coastlines, coastpolygons = self.features.coastlines(self)
+        else:
+            coastlines, coastpolygons = \
+                self.fetch_coastlines(self.data_bbox.bounds)
         # only fill map with sea color if there is a at least one coastline
         if coastlines or coastpolygons:
-            lines = tuple(wkb.loads(str(cl.geom.geom_wkb))
-                for cl in coastlines)
-            merged = utils.merge_lines(lines)
+            merged = utils.merge_lines(coastlines)
             islands = []
             shorelines = []
             for line in merged:
@@ -114,8 +273,8 @@ class Renderer(object):
                 if line.is_ring:
                     islands.append(line)
                 else:
-                    inter = line.intersection(self.mapobj.bbox)
-                    points = line.intersection(self.mapobj.bbox.exterior)
+                    inter = line.intersection(self.data_bbox)
+                    points = line.intersection(self.data_bbox.exterior)
                     #: only add line to closing process if number of intersections
                     #: with bbox is even. Otherwise we have a incomplete coastline
                     #: which ends in the visible map
@@ -127,10 +286,10 @@ class Renderer(object):
                             shorelines.extend(inter)
             #: save all polygon coordinates as numpy arrays and add to islands
             for island in coastpolygons:
-                islands.append(numpy.array(wkb.loads(str(island.geom.geom_wkb)).exterior))
+                islands.append(numpy.array(island.exterior))
             #: fill water with sea background
             shore = None
-            for shore in utils.close_coastlines(shorelines, self.mapobj.bbox):
+            for shore in utils.close_coastlines(shorelines, self.data_bbox):
                 self.mapobj.draw_polygon(
                     exterior=numpy.array(shore),
                     background_color=self.stylesheet.sea_background
@@ -145,45 +304,84 @@ class Renderer(object):
                     background_color=self.stylesheet.map_background
                 )
 
-    def polygons(self):
-        '''Draws polygons on the map.'''
+    def fetch_coastlines(self, bounds):
+        '''
+        Fetches the coastlines within bounds from database.
+
+        :param bounds: ``(minx, miny, maxx, maxy)`` in the coordinates of
+            the data
+
+        :returns: ``([LineString,], [Polygon,])``
+        '''
+
+        coastlines = session.query(OSMLine).filter(and_(
+            self.bbox_condition(OSMLine, bounds),
+            OSMLine.natural=='coastline'
+        )).all()
+        coastpolygons = session.query(OSMPolygon).filter(and_(
+            self.bbox_condition(OSMPolygon, bounds),
+            OSMPolygon.natural=='coastline'
+        )).all()
+        return (
+            [wkb.loads(str(cl.geom.geom_wkb)) for cl in coastlines],
+            [wkb.loads(str(cp.geom.geom_wkb)) for cp in coastpolygons],
+        )
+
+    def polygons(self, draw=True):
+        '''
+        Draws polygons on the map.
+
+        :param draw: only collect labels if False
+        '''
 
-        results = self.query_objects('polygon')
+        results = self.query_objects('polygon', labels_only=not draw)
         for polygons in results:
             for polygon in polygons:
-                geom = wkb.loads(str(polygon.geom.geom_wkb))
+                if polygon.style.get('text') is not None:
+                    self.conflict_list.append(polygon)
+                if not draw:
+                    continue
                 background_image = None
                 if polygon.style.get('background-image') is not None:
                     background_image = os.path.join(self.stylesheet.dirname,
                         polygon.style.get('background-image'))
-                self.mapobj.draw_polygon(
-                    exterior=numpy.array(geom.exterior),
-                    interiors=tuple(numpy.array(i) for i in geom.interiors),
-                    background_color=polygon.style.get('background-color',
-                        TRANSPARENT),
-                    background_image=background_image,
-                    border_width=polygon.style.get('border-width', 0),
-                    border_color=polygon.style.get('border-color',
-                        TRANSPARENT),
-                    border_line_cap=polygon.style.get('border-line-cap',
-                        cairo.LINE_CAP_ROUND),
-                    border_line_join=polygon.style.get('border-line-join',
-                        cairo.LINE_JOIN_ROUND),
-                    border_line_dash=polygon.style.get('border-line-dash'),
-                )
-                if polygon.style.get('text') is not None:
-                    self.conflict_list.append(polygon)
+                border_width = polygon.style.get('border-width', 0)
+                if border_width and self.degrade('borders'):
+                    border_width = 0
+                #: rings are views into the coordinates of the feature batch
+                for rings in polygon.parts:
+                    self.mapobj.draw_polygon(
+                        exterior=rings[0],
+                        interiors=tuple(rings[1:]),
+                        background_color=polygon.style.get(
+                            'background-color', TRANSPARENT),
+                        background_image=background_image,
+                        border_width=border_width,
+                        border_color=polygon.style.get('border-color',
+                            TRANSPARENT),
+                        border_line_cap=polygon.style.get('border-line-cap',
+                            cairo.LINE_CAP_ROUND),
+                        border_line_join=polygon.style.get(
+                            'border-line-join', cairo.LINE_JOIN_ROUND),
+                        border_line_dash=polygon.style.get(
+                            'border-line-dash'),
+                    )
+
+    def lines(self, draw=True):
+        '''
+        Draws lines on the map.
 
-    def lines(self):
-        '''Draws lines on the map.'''
+        :param draw: only collect labels if False
+        '''
 
-        results = self.query_objects('line')
+        results = self.query_objects('line', labels_only=not draw)
         for lines in results:
+            if not draw:
+                continue
             #: draw outline
+            outlines = not self.degrade('outlines')
             for line in lines:
-                # convert WKB to coordinate tuple once for all lines
-                line.coords = numpy.array(wkb.loads(str(line.geom.geom_wkb)))
-                if line.style.get('outline-width') is not None:
+                if outlines and line.style.get('outline-width') is not None:
                     self.mapobj.draw_line(
                         coords=line.coords,
                         color=line.style.outline_color,
@@ -196,8 +394,9 @@ class Renderer(object):
                         line_dash=line.style.get('outline-line-dash')
                     )
             #: draw border as background so border-lines do not overlap
+            borders = not self.degrade('borders')
             for line in lines:
-                if line.style.get('border-width') is not None:
+                if borders and line.style.get('border-width') is not None:
                     self.mapobj.draw_line(
                         coords=line.coords,
                         color=line.style.border_color,
@@ -225,21 +424,25 @@ class Renderer(object):
                 if line.style.get('text') is not None:
                     self.conflict_list.append(line)
 
-    def points(self):
-        '''Draws points on the map.'''
+    def points(self, draw=True):
+        '''
+        Draws points on the map.
 
-        results = self.query_objects('point')
+        :param draw: only collect labels if False
+        '''
+
+        results = self.query_objects('point', labels_only=not draw)
+        labels = []
         for points in results:
             for point in points:
                 if (
                     point.style.get('text') is not None
                     or point.style.get('image') is not None
                 ):
-                    self.conflict_list.append(point)
-                if point.style.get('circle-radius') is not None:
-                    coord = numpy.array(wkb.loads(str(point.geom.geom_wkb)))
+                    labels.append(point)
+                if draw and point.style.get('circle-radius') is not None:
                     self.mapobj.draw_arc(
-                        coord,
+                        point.coords[0],
                         radius=point.style.get('circle-radius'),
                         background_color=point.style.get('circle-background-color',
                             TRANSPARENT),
@@ -253,85 +456,187 @@ class Renderer(object):
                             cairo.LINE_JOIN_ROUND),
                         border_line_dash=point.style.get('border-line-dash')
                     )
+        # a label grid keeps one label per cell shared by all maps, thinning
+        # by the cells of each map would decide differently in every map
+        if self.label_grid is None:
+            labels = self.thin_labels(labels)
+        self.conflict_list.extend(labels)
+
+    def thin_labels(self, objects):
+        '''
+        Thins out dense labels and images of points before placement, which
+        is much cheaper than rejecting them one by one in :meth:`conflicts`,
+        see :func:`mapython.labels.thin_grid`. The cells are relative to
+        the map, so labels are not thinned out if :attr:`label_grid` is set.
+
+        :param objects: list of objects with style in the order of
+            :attr:`conflict_list`, i.e. later objects are placed first
+
+        :returns: list of the kept objects in their order
+        '''
+
+        if len(objects) <= LABEL_CELL_LIMIT:
+            return objects
+        # conflicts are placed in reversed order, so later objects win
+        objects = objects[::-1]
+        points = self.mapobj.transform_array([obj.coords[0]
+            for obj in objects])
+        keep = thin_grid(points, [obj.style.get('z-index', 0)
+            for obj in objects], LABEL_CELL_SIZE, LABEL_CELL_LIMIT)
+        self.verbose_print('>  %s point labels thinned out'
+            % (len(objects) - len(keep)))
+        return [objects[i] for i in keep[::-1]]
 
     def conflicts(self):
         '''
         Draws all conflicting objects on the map. Conflicting objects are all
         objects which should not overlap in the final output, such as text or
-        images. These objects are rendered in reverse order so objects with
-        higher z-index are more likely drawn.
+        images. They are placed from a global priority queue by
+        :class:`mapython.labels.LabelEngine`, see :meth:`queue_label`. If the
+        time budget runs out, the remaining objects with lower priority are
+        skipped.
         '''
 
-        # render text in reversed order so points are rendered before
-        # lines before polygons
+        label_engine = LabelEngine(self.mapobj.map_area.bounds)
+        grid = None
+        if self.label_grid is not None:
+            grid = LabelGrid(self.label_grid, self.mapobj.world_offset())
+        # objects of the same priority keep the former order, i.e. reversed
+        # so points are placed before lines before polygons
         for obj in reversed(self.conflict_list):
-            geom = wkb.loads(str(obj.geom.geom_wkb))
-            func = None
-            if geom.geom_type == 'Point':
-                if (
-                    obj.style.get('text') is not None
-                    and obj.style.get('image') is not None
-                ):
-                    func = functools.partial(
-                        self.mapobj.draw_text,
-                        coord=numpy.array(geom),
-                        image=os.path.join(self.stylesheet.dirname,
-                            obj.style.get('image')),
-                        image_margin=obj.style.get('image-margin', 4)
-                    )
-                elif obj.style.get('text') is not None:
-                    func = functools.partial(
-                        self.mapobj.draw_text,
-                        coord=numpy.array(geom)
-                    )
-                elif obj.style.get('image') is not None:
-                    self.mapobj.draw_image(
-                        numpy.array(geom),
-                        os.path.join(self.stylesheet.dirname,
-                            obj.style.get('image'))
-                    )
-            elif geom.geom_type == 'LineString':
-                func = functools.partial(
-                    self.mapobj.draw_text_on_line,
-                    coords=numpy.array(geom)
-                )
-            else: # Polygon
-                try:
-                    func = functools.partial(
-                        self.mapobj.draw_text,
-                        coord=numpy.array(geom.representative_point())
-                    )
-                except ValueError: # geometry may be null value?
-                    pass
-            if func is not None:
-                func(
-                    text=getattr(obj, obj.style.text) or '',
-                    color=obj.style.get('text-color', (0, 0, 0)),
-                    font_size=obj.style.get('font-size', 10),
-                    font_family=obj.style.get('font-family',
-                        'Tahoma'),
-                    font_style=obj.style.get('font-style',
-                        cairo.FONT_SLANT_NORMAL),
-                    font_weight=obj.style.get('font-weight',
-                        cairo.FONT_WEIGHT_NORMAL),
-                    text_halo_width=obj.style.get('text-halo-width', 1.5),
-                    text_halo_color=obj.style.get('text-halo-color',
-                        TRANSPARENT),
-                    text_halo_line_cap=obj.style.get('text-halo-line-cap',
-                        cairo.LINE_CAP_ROUND),
-                    text_halo_line_join=obj.style.get('text-halo-line-join',
-                        cairo.LINE_JOIN_ROUND),
-                    text_halo_line_dash=obj.style.get('text-halo-line-dash'),
-                    text_transform=obj.style.get('text-transform'),
-                )
+            self.queue_label(label_engine, obj, grid)
+        stop = functools.partial(self.degrade, 'labels')
+        if grid is not None:
+            # labels of the grid are placed first, text on lines avoids them
+            for bounds in grid.place(self.mapobj.clip_bounds(), stop):
+                label_engine.index.insert(bounds, label_engine.margin)
+        label_engine.place(stop)
+        self.verbose_print('>  %s labels placed, %s dropped'
+            % (label_engine.placed, label_engine.dropped))
 
-    def query_objects(self, geom_type):
+    def queue_label(self, label_engine, obj, grid=None):
+        '''
+        Adds the label of obj to label_engine. Labels are placed in order of
+        the z-index and ``label-priority`` of their style and then points
+        before lines before polygons. Labels of points and polygons are placed
+        at the first free of the candidate positions around their anchor (see
+        :func:`mapython.labels.candidate_boxes`), labels with an image keep
+        the image centered on the point. Text on lines is placed by
+        :meth:`mapython.draw.Map.draw_text_on_line`.
+
+        :param label_engine: :class:`mapython.labels.LabelEngine`
+        :param obj: object with style
+        :param grid: :class:`mapython.labels.LabelGrid` which places the
+            labels of points and polygons at their anchor instead of
+            label_engine
+        '''
+
+        priority = (obj.style.get('z-index', 0),
+            obj.style.get('label-priority', 0),
+            LABEL_GEOM_RANKS.get(obj.wkb_type, 0))
+        text = None
+        if obj.style.get('text') is not None:
+            text = getattr(obj, obj.style.text) or ''
+        font = dict(
+            font_size=obj.style.get('font-size', 10),
+            font_family=obj.style.get('font-family', 'Tahoma'),
+            font_style=obj.style.get('font-style', cairo.FONT_SLANT_NORMAL),
+            font_weight=obj.style.get('font-weight',
+                cairo.FONT_WEIGHT_NORMAL),
+            text_transform=obj.style.get('text-transform'),
+        )
+        attrs = dict(font,
+            color=obj.style.get('text-color', (0, 0, 0)),
+            text_halo_width=obj.style.get('text-halo-width', 1.5),
+            text_halo_color=obj.style.get('text-halo-color', TRANSPARENT),
+            text_halo_line_cap=obj.style.get('text-halo-line-cap',
+                cairo.LINE_CAP_ROUND),
+            text_halo_line_join=obj.style.get('text-halo-line-join',
+                cairo.LINE_JOIN_ROUND),
+            text_halo_line_dash=obj.style.get('text-halo-line-dash'),
+        )
+        if obj.wkb_type == WKB_LINESTRING:
+            label_engine.add(priority, None, functools.partial(
+                self.draw_line_label, obj.coords, text, attrs))
+            return
+        if obj.wkb_type == WKB_POINT:
+            anchor = obj.coords[0]
+        else: # Polygon
+            rings = obj.parts[0]
+            try:
+                anchor = numpy.array(Polygon(rings[0],
+                    rings[1:]).representative_point())
+            except ValueError: # geometry may be null value?
+                return
+        image = None
+        if obj.style.get('image') is not None:
+            image = os.path.join(self.stylesheet.dirname,
+                obj.style.get('image'))
+            attrs['image_margin'] = obj.style.get('image-margin', 4)
+        if not text and image is None:
+            return
+        x, y = self.mapobj.transform_coords(*anchor)
+        width, height, image_width = self.mapobj.label_size(text, image=image,
+            image_margin=attrs.get('image_margin', 4), **font)
+        if image is not None:
+            # the image stays on the point
+            minx = x - image_width / 2.0
+            candidates = [(minx, y - height / 2.0, minx + width,
+                y + height / 2.0)]
+        else:
+            candidates = candidate_boxes((x - width / 2.0, y - height / 2.0,
+                x + width / 2.0, y + height / 2.0))
+        draw = functools.partial(self.draw_label, text=text, image=image,
+            **attrs)
+        if grid is not None:
+            grid.add(getattr(obj, 'osm_id', None), priority, candidates[0],
+                draw)
+        else:
+            label_engine.add(priority, candidates, draw)
+
+    def draw_label(self, bounds, **kwargs):
+        '''
+        Draws a label placed by :class:`mapython.labels.LabelEngine`, see
+        :meth:`mapython.draw.Map.draw_label`.
+
+        :param bounds: ``(minx, miny, maxx, maxy)`` of the chosen candidate
+
+        :returns: list of covered boxes
+        '''
+
+        area = self.mapobj.draw_label(bounds, **kwargs)
+        if area is None:
+            return []
+        # text on lines avoids the conflict area
+        self.mapobj.conflict_union(box(*area))
+        return [area]
+
+    def draw_line_label(self, coords, text, attrs, bounds=None):
+        '''
+        Draws text on a line, see :meth:`mapython.draw.Map.draw_text_on_line`.
+
+        :param coords: coordinates of the line
+        :param text: text to be drawn
+        :param attrs: dict of keyword arguments of draw_text_on_line
+        :param bounds: unused, lines have no candidate positions
+
+        :returns: list of covered boxes
+        '''
+
+        if not text or self.degrade('text-on-line'):
+            return []
+        return self.mapobj.draw_text_on_line(coords=coords, text=text,
+            **attrs)
+
+    def query_objects(self, geom_type, labels_only=False):
         '''
         Returns all objects for current scale/geom_type as a 2-dimensional
-        sorted list (according to z-index specified in stylesheet) and sets
-        style as attribute to db objects.
+        sorted list (according to z-index specified in stylesheet). Every
+        object is a :class:`mapython.features.StyledFeature`, so a row which
+        matches several tag groups is returned once with each style.
 
         :param geom_type: one of ``'point'``, ``'line'`` or ``'polygon'``
+        :param labels_only: only return objects with text or image
 
         :returns: 2-dimensional list containing sorted objects
         '''
@@ -341,68 +646,716 @@ class Renderer(object):
         # MAX_Z_INDEX)
         results = [list() for _ in xrange(self.stylesheet.MAX_Z_INDEX)]
         # determine database model class
-        db_class = GEOM_TYPES[geom_type]
+        db_class = self.tables[geom_type]
         counter = 0
+        # tags of the shared features which were already assigned
+        shared_tags = set()
         # iterate over all visible tags and names
-        for tags, columns, conditions in self.iter_query_conditions(geom_type):
-            # simple st_intersects() does not work because this operation
-            # raises an InternalError exception because of invalid geometries
-            # in the OSM database
-            bbox_condition = BBOX_QUERY_COND % (
-                (db_class.__table__, ) + self.bbox.bounds)
-            objects = session.query(
-                # only get necessary columns to increase performance
-                db_class.geom,
-                *[getattr(db_class, c) for c in tuple(tags) + tuple(columns)]
-            ).filter(and_(bbox_condition, *conditions)).all()
-            #: set style attr to obj and sort according to z-index
-            for obj in objects:
-                counter += 1
+        params = self.query_params()
+        for group in self.query_groups(geom_type, labels_only):
+            tags = group[1]
+            # area and length of shared features, see FeatureSet.get
+            sizes = None
+            if self.features is not None:
+                # all conditions with the same tags select the same shared
+                # features by their style
+                if tuple(sorted(tags)) in shared_tags:
+                    continue
+                shared_tags.add(tuple(sorted(tags)))
+                objects, sizes = self.features.get(geom_type, self)
+            else:
+                objects = self.group_objects(db_class, *group)
+            # decode geometries of all new objects at once, cached and shared
+            # objects are already decoded
+            decode_rows(objects)
+            #: attach style to obj and sort according to z-index
+            for i, obj in enumerate(objects):
                 tag_value = dict((tag, getattr(obj, tag)) for tag in tags)
-                obj.style = self.stylesheet.get(self.mapobj.scale, geom_type,
+                style = self.stylesheet.get(self.mapobj.scale, geom_type,
                     tag_value)
-                results[obj.style.get('z-index', 0)].append(obj)
+                # shared features contain features of other stylesheets
+                if style is None or labels_only \
+                        and style.get('text') is None \
+                        and style.get('image') is None:
+                    continue
+                # shared features are fetched with the loosest cull
+                # parameters of all renderers
+                if sizes is not None:
+                    min_area, min_length = cull_thresholds(geom_type, style)
+                    if sizes[i, 0] < min_area * params['pixel_area'] \
+                            or sizes[i, 1] < min_length \
+                                * params['pixel_length']:
+                        continue
+                counter += 1
+                results[style.get('z-index', 0)].append(
+                    StyledFeature(obj, style))
         self.verbose_print('>  %s %ss' % (counter, geom_type))
         return results
 
-    def iter_query_conditions(self, geom_type):
+    def group_objects(self, db_class, key, tags, columns, conditions, cull):
+        '''
+        Returns the objects of a query group (see :meth:`query_groups`)
+        from the query cache or database. The objects are fetched once per
+        map, so the groups fetched by :meth:`has_features` are not fetched
+        again by the layers.
+
+        :param db_class: one of the classes of :mod:`mapython.database`
+
+        :returns: list of objects
+        '''
+
+        if key not in self.fetched:
+            fetch = functools.partial(self.fetch_objects, db_class,
+                tuple(tags) + tuple(columns), conditions, key=key)
+            if self.query_cache is None:
+                objects = fetch(self.bbox.bounds)
+            else:
+                objects = self.cached_objects(key, db_class, cull, fetch)
+            self.fetched[key] = objects
+        return self.fetched[key]
+
+    def cached_objects(self, key, db_class, cull, fetch):
+        '''
+        Returns the objects of a query group from the query cache. Cells are
+        fetched with the cull parameters of the pixel size rounded down to a
+        power of two of the next zoom level (see
+        :func:`mapython.cache.snap_size`), so they answer the neighbouring
+        maps of this and the next zoom level, which cull the cached features
+        by their sizes.
+
+        :param key: key of the query group, see :meth:`query_groups`
+        :param db_class: one of the classes of :mod:`mapython.database`
+        :param cull: ``(min_area, min_length)`` of the query group, see
+            :func:`cull_thresholds`
+        :param fetch: :meth:`fetch_objects` with the columns and conditions
+            of the query group
+
+        :returns: list of objects
+        '''
+
+        params = self.query_params()
+        factor = snap_size(params['pixel_length']) / params['pixel_length']
+        cell_params = {
+            'pixel_area': params['pixel_area'] * factor ** 2,
+            'pixel_length': params['pixel_length'] * factor,
+        }
+        measures = cull_measures(db_class, cull)
+        return self.query_cache.get(key, self.bbox.bounds,
+            functools.partial(fetch, with_bounds=True, params=cell_params,
+                measures=[measure for measure, _, _ in measures]),
+            tuple(params[name] * threshold
+                for _, name, threshold in measures),
+            tuple(cell_params[name] * threshold
+                for _, name, threshold in measures))
+
+    def fetch_objects(self, db_class, columns, conditions, bounds,
+            with_bounds=False, key=None, params=None, measures=()):
+        '''
+        Fetches objects matching conditions within bounds from database.
+
+        If the renderer has a statement cache and a key is given, the query
+        is prepared once per key and executed with bounds and the pixel size
+        as parameters, see :meth:`query_groups`.
+
+        :param db_class: one of the classes of :mod:`mapython.database`
+        :param columns: names of the columns to fetch besides the geometry
+        :param conditions: ``[sqlalchemy binary expressions,]``
+        :param bounds: ``(minlon, minlat, maxlon, maxlat)``
+        :param with_bounds: additionally return the bounds of all objects,
+            see :class:`mapython.cache.QueryCache`
+        :param key: hashable key which identifies db_class, columns and
+            conditions
+        :param params: values of the cull parameters, defaults to
+            :meth:`query_params`
+        :param measures: sizes of the objects which are returned after their
+            bounds, see :func:`cull_measures`
+
+        :returns: list of objects or ``(objects, [(minx, miny, maxx, maxy,
+            sizes...),])``
+        '''
+
+        if params is None:
+            params = self.query_params()
+        # only get necessary columns to increase performance
+        query_columns = [db_class.geom] + [getattr(db_class, c)
+            for c in columns]
+        if with_bounds:
+            query_columns.extend(
+                literal_column('%s(%s.way)' % (func, db_class.__table__))
+                for func in BOUNDS_FUNCS
+            )
+            query_columns.extend(measures)
+        bounds_columns = len(BOUNDS_FUNCS) + len(measures)
+        # simple st_intersects() does not work because this operation
+        # raises an InternalError exception because of invalid geometries
+        # in the OSM database
+        if key is not None and self.statements is not None:
+            bbox_condition = text(BBOX_PARAM_COND % (db_class.__table__,
+                table_srid(db_class)))
+            params = dict(zip(PREPARED_PARAMS[:4], bounds), **params)
+            rows = self.statements.execute(
+                key + (with_bounds, len(measures)),
+                lambda: prepared_sql(session.query(*query_columns).filter(
+                    and_(bbox_condition, *conditions))),
+                [params[name] for name in PREPARED_PARAMS]
+            )
+            names = ('geom', ) + tuple(columns)
+            objects = [Row(names, row) for row in rows]
+            if with_bounds:
+                return objects, [row[-bounds_columns:] for row in rows]
+            return objects
+        objects = session.query(*query_columns).filter(
+            and_(self.bbox_condition(db_class, bounds), *conditions)
+        ).params(**params).all()
+        if with_bounds:
+            return objects, [obj[-bounds_columns:] for obj in objects]
+        return objects
+
+    def bbox_condition(self, db_class, bounds=None):
+        '''
+        Returns condition which selects the rows of db_class whose bounding
+        box intersects bounds. Bounds are in the coordinates of the table,
+        i.e. projected if the table stores projected data.
+
+        :param db_class: one of the classes of :mod:`mapython.database`
+        :param bounds: ``(minx, miny, maxx, maxy)``, defaults to the bbox of
+            the renderer
+
+        :returns: SQL condition as str
+        '''
+
+        if bounds is None:
+            bounds = self.bbox.bounds
+        return BBOX_QUERY_COND % ((db_class.__table__, ) + tuple(bounds)
+            + (table_srid(db_class), ))
+
+    def has_features(self, labels_only=False):
+        '''
+        Checks whether there is any feature of the current scale within the
+        bbox. The query groups of the layers are fetched in the order of the
+        layers until one of them returns a feature, so non-empty maps
+        usually cost no extra query because the layers reuse the fetched
+        groups, see :meth:`group_objects`.
+
+        :param labels_only: only check features with text or image
+
+        :returns: bool
+        '''
+
+        if self.features is not None:
+            return self.features.has_features(self)
+        for geom_type in ('polygon', 'line', 'point'):
+            db_class = self.tables[geom_type]
+            for group in self.query_groups(geom_type, labels_only):
+                if self.group_objects(db_class, *group):
+                    return True
+        return False
+
+    def estimate_cost(self, exact=False):
+        '''
+        Estimates the rendering cost as the number of features which would be
+        fetched by :meth:`query_objects` for all geometry types. By default
+        the row estimates of the PostgreSQL query planner are used, which are
+        much cheaper than counting.
+
+        :param exact: count features instead of using planner estimates
+
+        :returns: estimated number of features
+        '''
+
+        cost = 0
+        for geom_type, db_class in self.tables.iteritems():
+            bbox_condition = self.bbox_condition(db_class)
+            for tags, columns, conditions in \
+                    self.iter_query_conditions(geom_type):
+                query = session.query(db_class.osm_id).filter(
+                    and_(bbox_condition, *conditions)
+                ).params(**self.query_params())
+                if exact:
+                    cost += query.count()
+                else:
+                    cost += self.planner_rows(query)
+        return cost
+
+    def planner_rows(self, query):
+        '''
+        Returns the number of rows the query planner expects for query.
+
+        :param query: :class:`sqlalchemy.orm.query.Query`
+
+        :returns: estimated number of rows
+        '''
+
+        compiled = query.statement.compile(bind=engine)
+        params = dict(compiled.params)
+        params.update(self.query_params())
+        plan = session.connection().execute(
+            'EXPLAIN (FORMAT JSON) %s' % compiled, params
+        ).scalar()
+        # psycopg2 only decodes json columns itself in newer versions
+        if isinstance(plan, basestring):
+            plan = json.loads(plan)
+        return plan[0]['Plan']['Plan Rows']
+
+    def iter_query_conditions(self, geom_type, labels_only=False):
         '''
-        Yields tags, columns and conditions for the current scale.
+        Yields tags, columns and conditions for the current scale. The
+        conditions contain the parameters of :meth:`query_params`.
 
         :param geom_type: one of ``'point'``, ``'line'`` or ``'polygon'``
+        :param labels_only: only yield conditions of styles with text or
+            image
 
         :yields: ``[tags,]``, ``[columns,]``,
             ``[sqlalchemy binary expressions,]``
         '''
 
-        db_class = GEOM_TYPES[geom_type]
-        # only one condition so it can be combined with others to get better
-        # performance
-        simple_conds = collections.defaultdict(list)
-        # multiple contitions
-        complex_conds = []
-        # columns which need to be fetched from database
-        columns = collections.defaultdict(set)
-        for style in self.stylesheet.iter_styles(self.mapobj.scale, geom_type):
-            if len(style.tag_value) == 1:
-                tag, value = style.tag_value.iteritems().next()
-                simple_conds[tag].append(value)
-                column_key = tag
-            else:
-                complex_conds.append(style.tag_value)
-                column_key = utils.dict2key(style.tag_value)
-            #: search for additional columns which need to be fetched from
-            #: from database
-            for attr in COLUMN_ATTRS:
-                if style.get(attr) in db_class.__dict__:
-                    columns[column_key].add(style.get(attr))
-        for tag, names in simple_conds.iteritems():
-            yield [tag], columns[tag], [getattr(db_class, tag).in_(names)]
-        for conds in complex_conds:
-            tags = []
-            query_conds = []
-            for key, value in conds.iteritems():
-                tags.append(key)
-                query_conds.append(getattr(db_class, key)==value)
-            yield tags, columns[utils.dict2key(conds)], query_conds
+        for _, tags, columns, conditions, _ in self.query_groups(geom_type,
+                labels_only):
+            yield tags, columns, conditions
+
+    def query_groups(self, geom_type, labels_only=False, db_class=None):
+        '''
+        Returns the query groups of the current level, see
+        :func:`style_conditions`. The groups only depend on the stylesheet,
+        level and table, so they are built once and shared by all renderers
+        until the stylesheet is updated. Each group has a key of its geometry
+        type, columns and conditions which is stable across maps, levels and
+        stylesheets, e.g. for :class:`mapython.cache.QueryCache` and
+        :class:`mapython.database.StatementCache`.
+
+        :param geom_type: one of ``'point'``, ``'line'`` or ``'polygon'``
+        :param labels_only: only return groups of styles with text or image
+        :param db_class: table of the conditions, defaults to the table of
+            the current level
+
+        :returns: ``[(key, [tags,], [columns,],
+            [sqlalchemy binary expressions,], (min_area, min_length)),]``
+        '''
+
+        level = self.stylesheet.get_level(self.mapobj.scale)
+        if db_class is None:
+            db_class = self.tables[geom_type]
+        key = (self.stylesheet.revision, level, geom_type, labels_only,
+            db_class.__tablename__)
+        groups = _query_groups.setdefault(self.stylesheet, {})
+        if key not in groups:
+            #: styles with the same cull thresholds are combined, see
+            #: style_conditions
+            culls = collections.defaultdict(list)
+            for style in self.stylesheet.iter_styles(self.mapobj.scale,
+                    geom_type):
+                if not labels_only or style.get('text') is not None \
+                        or style.get('image') is not None:
+                    culls[cull_thresholds(geom_type, style)].append(style)
+            groups[key] = []
+            for cull, styles in sorted(culls.iteritems()):
+                for tags, columns, conditions in style_conditions(styles,
+                        db_class):
+                    conditions = conditions + cull_conditions(db_class,
+                        cull)
+                    groups[key].append((
+                        (geom_type, tuple(tags), tuple(sorted(columns)))
+                            + conditions_key(conditions),
+                        tags, columns, conditions, cull
+                    ))
+        return groups[key]
+
+    def query_params(self):
+        '''
+        Returns the values of the cull parameters of the conditions, see
+        :func:`cull_conditions`.
+
+        :returns: ``{'pixel_area': float, 'pixel_length': float}`` in the
+            coordinates of the data
+        '''
+
+        sizex, sizey = self.pixel_size
+        return {
+            'pixel_area': sizex * sizey,
+            'pixel_length': min(sizex, sizey),
+        }
+
+
+class FeatureSet(object):
+
+    '''
+    Features of several renderers of the same bbox, e.g. with different
+    stylesheets, which are fetched with one query per geometry type for the
+    union of the conditions and columns of all renderers. Coastlines and
+    the existence of features are fetched once for all renderers as well.
+    Every renderer selects its features by the styles of its own stylesheet.
+
+    :param renderers: list of :class:`Renderer`
+    '''
+
+    def __init__(self, renderers):
+        self.renderers = renderers
+        # geom_type: (objects, bounds and sizes array)
+        self.objects = {}
+        # ([LineString,], [Polygon,]), see Renderer.fetch_coastlines
+        self.coasts = None
+
+    def get(self, geom_type, renderer):
+        '''
+        Returns the features of geom_type within the bbox of renderer,
+        fetches the features of all renderers on first call. The features
+        are fetched with the loosest cull parameters of all renderers, so
+        renderers cull them by their own parameters and the returned sizes.
+
+        :param geom_type: one of ``'point'``, ``'line'`` or ``'polygon'``
+        :param renderer: one of the renderers
+
+        :returns: ``(objects, sizes)`` where sizes is an array of the area
+            and length of each object
+        '''
+
+        if geom_type not in self.objects:
+            self.objects[geom_type] = self.fetch(geom_type)
+        objects, array = self.objects[geom_type]
+        minx, miny, maxx, maxy = renderer.bbox.bounds
+        indexes = numpy.flatnonzero(
+            (array[:, 0] <= maxx) & (array[:, 2] >= minx)
+            & (array[:, 1] <= maxy) & (array[:, 3] >= miny)
+        )
+        return [objects[i] for i in indexes], array[indexes, 4:]
+
+    def has_features(self, renderer):
+        '''
+        Checks whether there is any feature within the bbox of renderer by
+        the shared features, see :meth:`Renderer.has_features`.
+
+        :param renderer: one of the renderers
+
+        :returns: bool
+        '''
+
+        return any(self.get(geom_type, renderer)[0]
+            for geom_type in GEOM_TYPES)
+
+    def coastlines(self, renderer):
+        '''
+        Returns the coastlines within the data bbox of renderer, fetches the
+        coastlines of all renderers on first call.
+
+        :param renderer: one of the renderers
+
+        :returns: ``([LineString,], [Polygon,])``
+        '''
+
+        if self.coasts is None:
+            self.coasts = self.renderers[0].fetch_coastlines(
+                self.union_bounds('data_bbox'))
+        bounds = renderer.data_bbox.bounds
+        return tuple([geom for geom in geoms
+            if intersects(geom.bounds, bounds)] for geoms in self.coasts)
+
+    def fetch(self, geom_type):
+        '''
+        Fetches features of geom_type of all renderers from database within
+        the union of their bboxes and with the loosest cull parameters of
+        all renderers.
+
+        :param geom_type: one of ``'point'``, ``'line'`` or ``'polygon'``
+
+        :returns: ``(objects, array)`` where each row of array contains the
+            bounds, area and length of an object
+        '''
+
+        #: renderers of different stylesheets may use different generalized
+        #: tables, their features are fetched from the complete table
+        tables = set(r.tables[geom_type] for r in self.renderers)
+        if len(tables) == 1:
+            db_class = tables.pop()
+        else:
+            db_class = GEOM_TYPES[geom_type]
+        columns = set()
+        conditions = []
+        culls = set()
+        for renderer in self.renderers:
+            for _, tags, tag_columns, conds, cull in \
+                    renderer.query_groups(geom_type, db_class=db_class):
+                columns.update(tags)
+                columns.update(tag_columns)
+                conditions.append(and_(*conds))
+                culls.add(cull)
+        if not conditions:
+            return [], numpy.zeros((0, 6))
+        params = dict((name, min(r.query_params()[name]
+            for r in self.renderers)) for name in CULL_PARAMS)
+        measures = cull_measures(db_class, map(max, zip(*culls)))
+        objects, rows = self.renderers[0].fetch_objects(db_class,
+            tuple(sorted(columns)), [or_(*conditions)],
+            self.union_bounds('bbox'), with_bounds=True, params=params,
+            measures=[measure for measure, _, _ in measures])
+        array = numpy.zeros((len(objects), 6))
+        if objects:
+            rows = numpy.asarray(rows, numpy.float64)
+            array[:, :4] = rows[:, :4]
+            for i, (_, name, _) in enumerate(measures):
+                array[:, 4 + CULL_PARAMS.index(name)] = rows[:, 4 + i]
+        return objects, array
+
+    def union_bounds(self, attr):
+        '''
+        Returns the bounds of the union of a bbox of all renderers.
+
+        :param attr: ``'bbox'`` or ``'data_bbox'``
+
+        :returns: ``(minx, miny, maxx, maxy)``
+        '''
+
+        bounds = [getattr(r, attr).bounds for r in self.renderers]
+        return (
+            min(b[0] for b in bounds),
+            min(b[1] for b in bounds),
+            max(b[2] for b in bounds),
+            max(b[3] for b in bounds),
+        )
+
+
+def style_conditions(styles, db_class, thresholds=None):
+    '''
+    Yields tags, columns and conditions which select the features of styles.
+    Styles with a single tag are combined to one condition per tag.
+
+    :param styles: list of :class:`mapython.style.Style`
+    :param db_class: one of the classes of :mod:`mapython.database`
+    :param thresholds: callable which returns the cull thresholds of a
+        style, see :func:`cull_thresholds`
+
+    :yields: ``[tags,]``, ``[columns,]``,
+        ``[sqlalchemy binary expressions,]``
+    '''
+
+    # only one condition so it can be combined with others to get better
+    # performance
+    simple_conds = collections.defaultdict(list)
+    # multiple contitions
+    complex_conds = []
+    # columns which need to be fetched from database
+    columns = collections.defaultdict(set)
+    for style in styles:
+        cull = (0, 0) if thresholds is None else thresholds(style)
+        if len(style.tag_value) == 1:
+            tag, value = style.tag_value.iteritems().next()
+            simple_conds[(tag, cull)].append(value)
+            column_key = tag
+        else:
+            complex_conds.append((style.tag_value, cull))
+            column_key = utils.dict2key(style.tag_value)
+        #: search for additional columns which need to be fetched from
+        #: from database
+        for attr in COLUMN_ATTRS:
+            if style.get(attr) in db_class.__dict__:
+                columns[column_key].add(style.get(attr))
+        # labels are keyed by feature, see LabelGrid
+        if style.get('text') is not None or style.get('image') is not None:
+            columns[column_key].add('osm_id')
+    for (tag, cull), names in simple_conds.iteritems():
+        yield [tag], columns[tag], [getattr(db_class, tag).in_(names)] \
+            + cull_conditions(db_class, cull)
+    for conds, cull in complex_conds:
+        tags = []
+        query_conds = []
+        for key, value in conds.iteritems():
+            tags.append(key)
+            query_conds.append(getattr(db_class, key)==value)
+        yield tags, columns[utils.dict2key(conds)], query_conds \
+            + cull_conditions(db_class, cull)
+
+def cull_thresholds(geom_type, style):
+    '''
+    Returns the min area and length of features of style in pixels,
+    features below these thresholds are not fetched.
+
+    :param geom_type: one of ``'point'``, ``'line'`` or ``'polygon'``
+    :param style: :class:`mapython.style.Style`
+
+    :returns: ``(min_area, min_length)`` where 0 disables the threshold
+    '''
+
+    if geom_type == 'polygon':
+        return (style.get('min-pixel-area', MIN_PIXEL_AREA), 0)
+    if geom_type == 'line':
+        return (0, style.get('min-pixel-length', MIN_PIXEL_LENGTH))
+    return (0, 0)
+
+def cull_conditions(db_class, thresholds):
+    '''
+    Returns conditions which filter features below thresholds in the
+    database, see :func:`cull_thresholds`. The thresholds are multiplied by
+    the parameters ``pixel_area`` and ``pixel_length``, the size of a pixel
+    in the coordinates of the data, see :meth:`Renderer.query_params`.
+
+    The ``way_area`` column of osm2pgsql is used for tables in spherical
+    mercator only. osm2pgsql calculates it in the units of the table, but in
+    square metres of spherical mercator if data in other projections is
+    imported with ``--reproject-area``, so the area of other tables is
+    calculated from their geometries.
+
+    :param db_class: one of the classes of :mod:`mapython.database`
+    :param thresholds: ``(min_area, min_length)`` in pixels
+
+    :returns: ``[sqlalchemy binary expressions,]``
+    '''
+
+    min_area, min_length = thresholds
+    conditions = []
+    if min_area > 0:
+        pixel_area = bindparam('pixel_area', type_=Float) * min_area
+        if table_srid(db_class) in PROJECTED_SRIDS:
+            conditions.append(or_(db_class.way_area == None,
+                db_class.way_area >= pixel_area))
+        else:
+            conditions.append(literal_column('ST_Area(%s.way)'
+                % db_class.__table__) >= pixel_area)
+    if min_length > 0:
+        conditions.append(literal_column('ST_Length(%s.way)'
+            % db_class.__table__) >= bindparam('pixel_length', type_=Float)
+                * min_length)
+    return conditions
+
+def cull_measures(db_class, thresholds):
+    '''
+    Returns the sizes of the features of db_class which are compared with
+    the cull parameters by :func:`cull_conditions`, e.g. to cull cached
+    features locally, see :meth:`Renderer.cached_objects`.
+
+    :param db_class: one of the classes of :mod:`mapython.database`
+    :param thresholds: ``(min_area, min_length)`` in pixels
+
+    :returns: ``[(sqlalchemy column, parameter name, threshold),]``
+    '''
+
+    min_area, min_length = thresholds
+    measures = []
+    if min_area > 0:
+        if table_srid(db_class) in PROJECTED_SRIDS:
+            # features without way_area are never culled
+            area = literal_column("coalesce(%s.way_area, 'Infinity')"
+                % db_class.__table__)
+        else:
+            area = literal_column('ST_Area(%s.way)' % db_class.__table__)
+        measures.append((area, 'pixel_area', min_area))
+    if min_length > 0:
+        measures.append((literal_column('ST_Length(%s.way)'
+            % db_class.__table__), 'pixel_length', min_length))
+    return measures
+
+def conditions_key(conditions):
+    '''
+    Returns a hashable key of conditions which is equal for equal
+    conditions, e.g. of different levels or stylesheets.
+
+    :param conditions: ``[sqlalchemy binary expressions,]``
+
+    :returns: ``(SQL, parameters)``
+    '''
+
+    compiled = and_(*conditions).compile()
+    return str(compiled), repr(sorted(compiled.params.iteritems()))
+
+def prepared_sql(query):
+    '''
+    Returns SQL of query for a prepared statement, the parameters of
+    :const:`PREPARED_PARAMS` are replaced by their placeholders and all
+    other parameters are inlined.
+
+    :param query: :class:`sqlalchemy.orm.query.Query`
+
+    :returns: str
+    '''
+
+    compiled = query.statement.compile(bind=engine)
+    params = dict(compiled.params)
+    for i, name in enumerate(PREPARED_PARAMS):
+        params[name] = AsIs('$%s' % (i + 1))
+    cursor = session.connection().connection.cursor()
+    return cursor.mogrify(str(compiled), params)
+
+def table_srid(db_class):
+    '''
+    Returns the SRID of the geometry column of a table, e.g. 4326 for data
+    imported by osm2pgsql with ``--latlong`` or 3857 for data imported in
+    spherical mercator. The SRID is queried once per table.
+
+    :param db_class: one of the classes of :mod:`mapython.database`
+
+    :returns: int
+    '''
+
+    table = db_class.__tablename__
+    if table not in _srids:
+        srid = session.execute(
+            "SELECT Find_SRID(current_schema(), :table, 'way')",
+            {'table': table}
+        ).scalar()
+        _srids[table] = LATLON_SRID if srid is None else int(srid)
+    return _srids[table]
+
+def stylesheet_digest(stylesheet):
+    '''
+    Returns :meth:`mapython.style.StyleSheet.digest` of stylesheet, which is
+    computed once per revision of the stylesheet.
+
+    :param stylesheet: :class:`mapython.style.StyleSheet`
+
+    :returns: hex str
+    '''
+
+    revision, digest = _digests.get(stylesheet, (None, None))
+    if revision != stylesheet.revision:
+        digest = stylesheet.digest()
+        _digests[stylesheet] = (stylesheet.revision, digest)
+    return digest
+
+def render_stylesheets(targets, quiet=False, deadline=None):
+    '''
+    Renders the same bbox with several stylesheets, e.g. a default and a dark
+    variant of the same tiles, while features are fetched and decoded only
+    once for all stylesheets, see :class:`FeatureSet`.
+
+    :param targets: list of ``(mapobj, stylesheet)`` where all maps have the
+        same bbox
+    :param quiet: specify whether some status information is printed
+    :param deadline: time budget of each map in seconds, see
+        :meth:`Renderer.run`
+
+    :returns: list of sets of skipped work of each map, see
+        :meth:`Renderer.run`
+    '''
+
+    renderers = [Renderer(mapobj, stylesheet, quiet)
+        for mapobj, stylesheet in targets]
+    features = FeatureSet(renderers)
+    for renderer in renderers:
+        renderer.features = features
+    return [renderer.run(deadline=deadline) for renderer in renderers]
+
+def render_targets(targets, stylesheet=DEFAULT_STYLESHEET, quiet=False,
+        deadline=None):
+    '''
+    Renders several maps of the same bbox, e.g. pngs at 1x and 2x (HiDPI)
+    and a pdf for print, while querying and decoding all features only once.
+    The map is rendered onto a :class:`cairo.RecordingSurface` of the size
+    of the first target which is then replayed onto every target scaled to
+    its size. So styles and label placement are chosen for the first target
+    and the other targets are scaled versions of it.
+
+    :param targets: list of :class:`mapython.draw.Map` with the same bbox
+        and projection
+    :param stylesheet: :class:`mapython.style.StyleSheet`
+    :param quiet: specify whether some status information is printed
+    :param deadline: time budget in seconds, see :meth:`Renderer.run`
+
+    :returns: set of skipped work, see :meth:`Renderer.run`
+    '''
 
+    first = targets[0]
+    recording = Map(None, first.bbox.bounds, first.max_size, first.projection,
+        surface_type='recording')
+    skipped = Renderer(recording, stylesheet, quiet).run(deadline=deadline)
+    for target in targets:
+        target.paint_map(recording)
+    return skipped
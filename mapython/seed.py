@@ -0,0 +1,452 @@
+# coding: utf-8
+import time
+import json
+import math
+import sqlite3
+import numpy
+from mapython.projection import mercator
+
+
+# global bbox of spherical mercator projection (-180, -85.501, 180, 85.501)
+MERC_GLOBAL_BBOX = (-20037508.34, -20037508.34, 20037508.34, 20037508.34)
+
+
+def retry(func, retries=3, backoff=1):
+    '''
+    Calls func until it succeeds or the number of retries is exceeded. The
+    waiting time between two attempts is doubled after each failure.
+
+    :param func: callable without arguments
+    :param retries: number of retries after the first failed attempt
+    :param backoff: waiting time before the first retry in seconds
+
+    :returns: return value of func
+    '''
+
+    for attempt in xrange(retries + 1):
+        try:
+            return func()
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+def tile_size(level, width, height):
+    '''
+    Returns tile size in metres.
+
+    :param level: zoom level
+    :param width: tile width in pixel
+    :param height: tile height in pixel
+
+    :returns: ``(tilesizex, tilesizey)``
+    '''
+
+    glminx, glminy, glmaxx, glmaxy = MERC_GLOBAL_BBOX
+    #: global size in metres
+    diffx = glmaxx - glminx
+    diffy = glmaxy - glminy
+    return (
+        diffx / float(2 ** level) * width / 256,
+        diffy / float(2 ** level) * height / 256,
+    )
+
+def tile_bbox(level, indexx, indexy, width, height, numberx=1, numbery=1):
+    '''
+    Returns bbox of a block of tiles as ``(minlon, minlat, maxlon, maxlat)``.
+
+    :param level: zoom level
+    :param indexx: x-index of upper left tile
+    :param indexy: y-index of upper left tile
+    :param width: tile width in pixel
+    :param height: tile height in pixel
+    :param numberx: number of tiles in x-direction
+    :param numbery: number of tiles in y-direction
+    '''
+
+    return tuple(tile_bboxes(level, [indexx], [indexy], width, height,
+        numberx, numbery)[0])
+
+def tile_bboxes(level, indexx, indexy, width, height, numberx=1, numbery=1):
+    '''
+    Returns bboxes of many blocks of tiles at once, see :func:`tile_bbox`.
+    All corners are transformed by one call of the vectorized projection.
+
+    :param indexx: array of x-indexes of upper left tiles
+    :param indexy: array of y-indexes of upper left tiles
+
+    :returns: float64 array of shape (n, 4) with rows
+        ``(minlon, minlat, maxlon, maxlat)``
+    '''
+
+    glminx, glminy, glmaxx, glmaxy = MERC_GLOBAL_BBOX
+    tilesizex, tilesizey = tile_size(level, width, height)
+    indexx = numpy.asarray(indexx, numpy.float64)
+    indexy = numpy.asarray(indexy, numpy.float64)
+    minlon, minlat = mercator.inverse(
+        glminx + indexx * tilesizex,
+        glmaxy - (indexy + numbery) * tilesizey
+    )
+    maxlon, maxlat = mercator.inverse(
+        glminx + (indexx + numberx) * tilesizex,
+        glmaxy - indexy * tilesizey
+    )
+    return numpy.column_stack((minlon, minlat, maxlon, maxlat))
+
+def read_expire_list(fobj):
+    '''
+    Reads dirty tiles as written by ``osm2pgsql --expire-tiles``, i.e. one
+    ``z/x/y`` per line, or changed areas as ``minlon,minlat,maxlon,maxlat``
+    per line. Empty lines and lines starting with ``#`` are ignored.
+
+    :param fobj: a filename or readable file object
+
+    :returns: list of areas ``(left, top, right, bottom)`` as fractions of
+        the global mercator map whose origin is the upper left corner
+    '''
+
+    if isinstance(fobj, basestring):
+        with open(fobj, 'r') as real_fobj:
+            return read_expire_list(real_fobj)
+    glminx, glminy, glmaxx, glmaxy = MERC_GLOBAL_BBOX
+    areas = []
+    for line in fobj:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if '/' in line:
+            level, indexx, indexy = map(int, line.split('/'))
+            number = float(2 ** level)
+            areas.append((indexx / number, indexy / number,
+                (indexx + 1) / number, (indexy + 1) / number))
+        else:
+            minlon, minlat, maxlon, maxlat = map(float,
+                line.replace(',', ' ').split())
+            minx, miny = mercator(minlon, minlat)
+            maxx, maxy = mercator(maxlon, maxlat)
+            areas.append(tuple(min(max(value, 0), 1) for value in (
+                (minx - glminx) / (glmaxx - glminx),
+                (glmaxy - maxy) / (glmaxy - glminy),
+                (maxx - glminx) / (glmaxx - glminx),
+                (glmaxy - miny) / (glmaxy - glminy),
+            )))
+    return areas
+
+def expire_metatiles(areas, level, width=256, height=256, buffer=0,
+        metatile=1):
+    '''
+    Returns all metatiles of a zoom level which have to be re-rendered
+    after the data within areas has changed. Tiles within buffer pixels of
+    an area are included as well, because labels and images of changed
+    features may extend into them.
+
+    :param areas: list of areas, see :func:`read_expire_list`
+    :param level: zoom level
+    :param width: tile width in pixel
+    :param height: tile height in pixel
+    :param buffer: label buffer in pixel, see
+        :meth:`mapython.style.StyleSheet.label_buffer`
+    :param metatile: number of tiles rendered at once in each direction
+
+    :returns: set of ``(indexx, indexy)`` of the upper left tile of each
+        metatile, aligned to the global metatile grid
+    '''
+
+    #: number of tiles of global map in each direction
+    numberx = 2 ** level * 256 / width
+    numbery = 2 ** level * 256 / height
+    bufferx = buffer / float(width)
+    buffery = buffer / float(height)
+    metatiles = set()
+    for left, top, right, bottom in areas:
+        #: tile index range of area, end indexes are exclusive
+        startx = int(math.floor(left * numberx - bufferx))
+        starty = int(math.floor(top * numbery - buffery))
+        endx = max(int(math.ceil(right * numberx + bufferx)), startx + 1)
+        endy = max(int(math.ceil(bottom * numbery + buffery)), starty + 1)
+        startx, starty = max(startx, 0), max(starty, 0)
+        endx, endy = min(endx, numberx), min(endy, numbery)
+        for indexx in xrange(startx / metatile, (endx - 1) / metatile + 1):
+            for indexy in xrange(starty / metatile,
+                    (endy - 1) / metatile + 1):
+                metatiles.add((indexx * metatile, indexy * metatile))
+    return metatiles
+
+
+class TileJournal(object):
+
+    '''
+    Persistent ledger of rendered and failed tiles which is stored in a small
+    SQLite database, so an interrupted tile seed can be resumed. Every process
+    must create its own journal object as SQLite connections can not be shared
+    between processes.
+
+    :param path: path to SQLite database file
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        # generous timeout because several render processes write
+        # concurrently to the same database
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS tiles (
+                path TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                updated REAL NOT NULL
+            )
+        ''')
+        self.connection.commit()
+
+    def is_done(self, tilepath):
+        '''
+        Returns whether tile was already rendered successfully.
+
+        :param tilepath: path to tile file
+        '''
+
+        row = self.connection.execute(
+            'SELECT status FROM tiles WHERE path = ?', (tilepath, )
+        ).fetchone()
+        return row is not None and row[0] == 'done'
+
+    def mark_done(self, tilepath):
+        '''
+        Records tile as rendered successfully.
+
+        :param tilepath: path to tile file
+        '''
+
+        self._record(tilepath, 'done', None)
+
+    def mark_failed(self, tilepath, error):
+        '''
+        Records tile as failed.
+
+        :param tilepath: path to tile file
+        :param error: error message as str
+        '''
+
+        self._record(tilepath, 'failed', error)
+
+    def iter_failed(self):
+        '''
+        Returns generator which yields all failed tiles.
+
+        :yields: ``(tilepath, attempts, error)``
+        '''
+
+        for row in self.connection.execute(
+            'SELECT path, attempts, error FROM tiles WHERE status = ?',
+            ('failed', )
+        ):
+            yield row
+
+    def clear(self):
+        '''Removes all records from journal.'''
+
+        self.connection.execute('DELETE FROM tiles')
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def _record(self, tilepath, status, error):
+        with self.connection:
+            self.connection.execute(
+                'UPDATE tiles SET status = ?, error = ?, updated = ?, '
+                'attempts = attempts + 1 WHERE path = ?',
+                (status, error, time.time(), tilepath)
+            )
+            self.connection.execute(
+                'INSERT OR IGNORE INTO tiles '
+                '(path, status, attempts, error, updated) '
+                'VALUES (?, ?, 1, ?, ?)',
+                (tilepath, status, error, time.time())
+            )
+
+
+class TileQueue(object):
+
+    '''
+    Job queue which is stored in a SQLite database, so it can be shared by
+    render processes on several machines through a shared file system
+    without running an additional message broker. Workers lease jobs for a
+    limited time, so jobs of crashed workers are automatically handed out
+    again once their lease has expired. Note that the shared file system must
+    support POSIX file locks.
+
+    :param path: path to SQLite database file
+    :param lease_time: default lease duration in seconds
+    :param max_attempts: number of leases after which a failing job is no
+        longer handed out
+    '''
+
+    def __init__(self, path, lease_time=600, max_attempts=3):
+        self.path = path
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        # transactions are handled explicitly so leasing is atomic
+        self.connection = sqlite3.connect(path, timeout=60,
+            isolation_level=None)
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                key TEXT UNIQUE NOT NULL,
+                data TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                cost REAL NOT NULL DEFAULT 0
+            )
+        ''')
+
+    def put(self, jobs):
+        '''
+        Publishes jobs. Jobs whose key and data are already known are
+        ignored, so a coordinator can safely publish the same jobs again.
+        Known jobs with other data, e.g. of a newer version of the data, are
+        published again with the new data, even if they are done, failed or
+        leased. Jobs with higher estimated cost are handed out first, so a
+        seed does not end with a single worker rendering the most expensive
+        job.
+
+        :param jobs: iterable of ``(key, data, cost)`` where key is a unique
+            str, data is a JSON serializable object and cost is the
+            estimated rendering cost as int or float
+
+        :returns: number of new and published again jobs
+        '''
+
+        jobs = [(key, json.dumps(data, sort_keys=True), cost)
+            for key, data, cost in jobs]
+        before = self.connection.total_changes
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO jobs (key, data, cost) '
+                'VALUES (?, ?, ?)', jobs)
+            self.connection.executemany(
+                "UPDATE jobs SET data = ?, cost = ?, status = 'pending', "
+                "worker = NULL, expires = NULL, attempts = 0, error = NULL "
+                "WHERE key = ? AND data != ?",
+                ((data, cost, key, data) for key, data, cost in jobs))
+        except:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT')
+        return self.connection.total_changes - before
+
+    def lease(self, worker, lease=None):
+        '''
+        Leases the most expensive pending job or a job whose lease has
+        expired.
+
+        :param worker: unique name of the worker as str
+        :param lease: lease duration in seconds, defaults to
+            ``self.lease_time``
+
+        :returns: ``(job_id, data)`` or None if there is no job available
+        '''
+
+        now = time.time()
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            # jobs which crashed their workers too often are given up
+            self.connection.execute(
+                "UPDATE jobs SET status = 'failed', error = 'lease expired' "
+                "WHERE status = 'leased' AND expires < ? AND attempts >= ?",
+                (now, self.max_attempts)
+            )
+            row = self.connection.execute(
+                "SELECT id, data FROM jobs WHERE status = 'pending' "
+                "OR (status = 'leased' AND expires < ?) "
+                "ORDER BY cost DESC, id LIMIT 1",
+                (now, )
+            ).fetchone()
+            if row is not None:
+                self.connection.execute(
+                    "UPDATE jobs SET status = 'leased', worker = ?, "
+                    "expires = ?, attempts = attempts + 1 WHERE id = ?",
+                    (worker, now + (lease or self.lease_time), row[0])
+                )
+        except:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT')
+        if row is not None:
+            return row[0], json.loads(row[1])
+
+    def renew(self, job_id, worker, lease=None):
+        '''
+        Extends the lease of a job.
+
+        :param job_id: id returned by :meth:`lease`
+        :param worker: name of the worker holding the lease
+        :param lease: lease duration in seconds, defaults to
+            ``self.lease_time``
+        '''
+
+        self.connection.execute(
+            "UPDATE jobs SET expires = ? WHERE id = ? AND worker = ? "
+            "AND status = 'leased'",
+            (time.time() + (lease or self.lease_time), job_id, worker)
+        )
+
+    def complete(self, job_id, worker=None):
+        '''
+        Marks job as done unless it was published again or, if worker is
+        given, leased by another worker in the meantime.
+
+        :param job_id: id returned by :meth:`lease`
+        :param worker: name of the worker holding the lease
+        '''
+
+        self.connection.execute(
+            "UPDATE jobs SET status = 'done', error = NULL WHERE id = ? "
+            "AND status = 'leased' AND worker = coalesce(?, worker)",
+            (job_id, worker)
+        )
+
+    def fail(self, job_id, error, worker=None):
+        '''
+        Releases job after a failure. The job is handed out again unless it
+        has already been leased ``max_attempts`` times. Like
+        :meth:`complete` only jobs which are still leased are released.
+
+        :param job_id: id returned by :meth:`lease`
+        :param error: error message as str
+        :param worker: name of the worker holding the lease
+        '''
+
+        self.connection.execute(
+            "UPDATE jobs SET status = CASE WHEN attempts >= ? "
+            "THEN 'failed' ELSE 'pending' END, error = ?, worker = NULL, "
+            "expires = NULL WHERE id = ? AND status = 'leased' "
+            "AND worker = coalesce(?, worker)",
+            (self.max_attempts, error, job_id, worker)
+        )
+
+    def counts(self):
+        '''
+        Returns number of jobs per status.
+
+        :returns: dict, e.g. ``{'pending': 10, 'leased': 2, 'done': 5}``
+        '''
+
+        return dict(self.connection.execute(
+            'SELECT status, count(*) FROM jobs GROUP BY status'
+        ).fetchall())
+
+    def is_finished(self):
+        '''Returns whether all jobs are either done or failed.'''
+
+        counts = self.counts()
+        return not counts.get('pending') and not counts.get('leased')
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,329 @@
+# coding: utf-8
+import re
+import threading
+import multiprocessing
+import urlparse
+import SocketServer
+from wsgiref.simple_server import make_server, WSGIServer
+from mapython.render import DEFAULT_STYLESHEET
+from mapython.pool import RenderPool
+from mapython.cache import map_key
+from mapython.seed import tile_bbox
+
+
+TILE_PATH = re.compile(r'^/tiles/(\d+)/(\d+)/(\d+)\.png$')
+STATUS = {
+    200: '200 OK',
+    304: '304 Not Modified',
+    400: '400 Bad Request',
+    404: '404 Not Found',
+    503: '503 Service Unavailable',
+    504: '504 Gateway Timeout',
+}
+
+
+class Busy(Exception):
+
+    '''Raised if the max number of pending renders is exceeded.'''
+
+
+class Timeout(Exception):
+
+    '''Raised if a render does not finish in time.'''
+
+
+class Coalescer(object):
+
+    '''
+    Runs at most one call per key at once. Concurrent calls with the same
+    key wait for the running call and share its result, e.g. several clients
+    panning over the same area only trigger one render of each tile.
+
+    :param max_pending: max number of different keys which are called at
+        once, further calls raise :class:`Busy`
+    '''
+
+    def __init__(self, max_pending=32):
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        # key: (event, [result, exception])
+        self.pending = {}
+
+    def call(self, key, func, timeout=None):
+        '''
+        Calls func or waits for a running call with the same key.
+
+        :param key: hashable key
+        :param func: callable without arguments
+        :param timeout: max waiting time for a running call in seconds
+
+        :returns: return value of func
+        '''
+
+        with self.lock:
+            running = key in self.pending
+            if not running:
+                self._add(key)
+            event, outcome = self.pending[key]
+        if running:
+            if not event.wait(timeout):
+                raise Timeout('render of %r did not finish' % (key, ))
+        else:
+            self._run(key, func)
+        if outcome[1] is not None:
+            raise outcome[1]
+        return outcome[0]
+
+    def call_async(self, key, func):
+        '''
+        Calls func in a background thread unless a call with the same key is
+        running, e.g. to refresh a cache. The call counts towards
+        max_pending like the calls of :meth:`call`.
+
+        :param key: hashable key
+        :param func: callable without arguments
+
+        :returns: True if func is called, False if a call is running
+        '''
+
+        with self.lock:
+            if key in self.pending:
+                return False
+            self._add(key)
+        thread = threading.Thread(target=self._run, args=(key, func))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def _add(self, key):
+        if len(self.pending) >= self.max_pending:
+            raise Busy('%s renders pending' % len(self.pending))
+        self.pending[key] = (threading.Event(), [None, None])
+
+    def _run(self, key, func):
+        event, outcome = self.pending[key]
+        try:
+            outcome[0] = func()
+        except Exception, e:
+            outcome[1] = e
+        finally:
+            with self.lock:
+                del self.pending[key]
+            event.set()
+
+
+class TileServer(object):
+
+    '''
+    WSGI application which serves tiles as ``/tiles/level/x/y.png`` and
+    dynamic maps as ``/render/?left=&bottom=&right=&top=&width=&height=``.
+    Tiles are served directly from the tile store, missing tiles are
+    rendered and written to the store. Renders are dispatched to a
+    :class:`mapython.pool.RenderPool`, identical requests are coalesced onto
+    one render and requests are rejected with ``503`` once max_pending
+    renders are pending, so a busy server does not queue up more work than
+    it can handle.
+    Dynamic maps are cached in cache and sent with an ETag, so clients
+    revalidate them without a render. If a deadline is given, dynamic maps
+    are degraded to meet it (see :meth:`mapython.render.Renderer.run`),
+    degraded maps are neither cached nor sent with an ETag and rendered
+    again in full quality in the background.
+
+    :param store: :class:`mapython.store.TileStore`
+    :param stylesheet: :class:`mapython.style.StyleSheet`
+    :param processes: number of render processes
+    :param max_pending: max number of different renders at once
+    :param timeout: max rendering time of a request in seconds
+    :param width: tile width in pixel
+    :param height: tile height in pixel
+    :param render_missing: render tiles which do not exist in store
+    :param cache: :class:`mapython.cache.TileCache` of dynamic maps or None
+    :param data_version: version of the data, e.g. timestamp of the last
+        import, which is part of cache keys and ETags of dynamic maps; set
+        the attribute after data updates
+    :param deadline: time budget of dynamic maps in seconds or None
+    '''
+
+    def __init__(
+        self,
+        store,
+        stylesheet=DEFAULT_STYLESHEET,
+        processes=3,
+        max_pending=32,
+        timeout=60,
+        width=256,
+        height=256,
+        render_missing=True,
+        cache=None,
+        data_version=None,
+        deadline=None
+    ):
+        self.store = store
+        self.timeout = timeout
+        self.width = width
+        self.height = height
+        self.render_missing = render_missing
+        self.cache = cache
+        self.data_version = data_version
+        self.deadline = deadline
+        self.stylesheet_digest = stylesheet.digest()
+        self.coalescer = Coalescer(max_pending)
+        self.pool = RenderPool(processes, stylesheet)
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        params = dict(urlparse.parse_qsl(environ.get('QUERY_STRING', '')))
+        headers = []
+        try:
+            match = TILE_PATH.match(path)
+            if match is not None:
+                data = self.tile(*map(int, match.groups()))
+                status = 200 if data is not None else 404
+            elif path == '/render/':
+                bbox = tuple(float(params[key])
+                    for key in ('left', 'bottom', 'right', 'top'))
+                max_size = max(int(params['width']), int(params['height']))
+                etag = '"%s"' % self.etag(bbox, max_size)
+                if environ.get('HTTP_IF_NONE_MATCH') == etag:
+                    status, data = 304, ''
+                    headers.append(('ETag', etag))
+                else:
+                    data, skipped = self.render(bbox, max_size)
+                    status = 200
+                    if skipped:
+                        headers.append(('Cache-Control', 'no-cache'))
+                    else:
+                        headers.append(('ETag', etag))
+            else:
+                status, data = 404, None
+        except (KeyError, ValueError):
+            status, data = 400, None
+        except Busy:
+            status, data = 503, None
+            headers.append(('Retry-After', '1'))
+        except Timeout:
+            status, data = 504, None
+        if data is None:
+            data = STATUS[status]
+            headers.append(('Content-Type', 'text/plain'))
+        elif status == 200:
+            headers.append(('Content-Type', 'image/png'))
+        headers.append(('Content-Length', str(len(data))))
+        start_response(STATUS[status], headers)
+        return [data]
+
+    def tile(self, level, indexx, indexy):
+        '''
+        Returns tile from store or renders and stores missing tile.
+
+        :returns: png data as str or None if tile does not exist
+        '''
+
+        data = self.store.read(level, indexx, indexy)
+        if data is None and self.render_missing:
+            #: number of tiles of global map in each direction
+            numberx = 2 ** level * 256 / self.width
+            numbery = 2 ** level * 256 / self.height
+            if not 0 <= indexx < numberx or not 0 <= indexy < numbery:
+                return None
+            data = self.coalescer.call(('tile', level, indexx, indexy),
+                lambda: self._render_tile(level, indexx, indexy),
+                self.timeout)
+        return data
+
+    def render(self, bbox, max_size):
+        '''
+        Returns cached map or renders map in a render process, identical
+        concurrent requests are rendered once.
+
+        :param bbox: ``(minlon, minlat, maxlon, maxlat)``
+        :param max_size: max map width/height in pixel
+
+        :returns: ``(data, skipped)`` where data is the png data as str and
+            skipped the set of work skipped to meet the deadline
+        '''
+
+        key = self.etag(bbox, max_size)
+        if self.cache is not None:
+            data = self.cache.get(key)
+            if data is not None:
+                return data, set()
+        return self.coalescer.call(('render', key),
+            lambda: self._render(key, bbox, max_size), self.timeout)
+
+    def etag(self, bbox, max_size):
+        '''
+        Returns ETag of a dynamic map, see :func:`mapython.cache.map_key`.
+
+        :param bbox: ``(minlon, minlat, maxlon, maxlat)``
+        :param max_size: max map width/height in pixel
+
+        :returns: hex str
+        '''
+
+        return map_key(bbox, max_size, self.stylesheet_digest,
+            self.data_version)
+
+    def close(self):
+        '''Terminates all render processes.'''
+
+        self.pool.terminate()
+
+    def _render_tile(self, level, indexx, indexy):
+        bbox = tile_bbox(level, indexx, indexy, self.width, self.height)
+        data, _ = self._wait(self.pool.render_async(bbox,
+            max(self.width, self.height), data_version=self.data_version))
+        self.store.write(level, indexx, indexy, data)
+        return data
+
+    def _render(self, key, bbox, max_size):
+        data, skipped = self._wait(self.pool.render_async(bbox, max_size,
+            deadline=self.deadline, data_version=self.data_version))
+        if self.cache is not None:
+            if not skipped:
+                self.cache.put(key, data)
+            else:
+                #: refresh cache with map in full quality, at most once at a
+                #: time and only if the server is not busy
+                try:
+                    self.coalescer.call_async(('refresh', key),
+                        lambda: self._refresh(key, bbox, max_size))
+                except Busy:
+                    pass
+        return data, skipped
+
+    def _refresh(self, key, bbox, max_size):
+        data, _ = self._wait(self.pool.render_async(bbox, max_size,
+            data_version=self.data_version))
+        self.cache.put(key, data)
+
+    def _wait(self, result):
+        try:
+            return result.get(self.timeout)
+        except multiprocessing.TimeoutError:
+            raise Timeout('render did not finish in %ss' % self.timeout)
+
+
+class ThreadingWSGIServer(SocketServer.ThreadingMixIn, WSGIServer):
+
+    '''WSGI server which handles each request in a separate thread.'''
+
+    daemon_threads = True
+
+
+def serve(app, host='localhost', port=8080):
+    '''
+    Serves WSGI application until interrupted.
+
+    :param app: WSGI application, e.g. :class:`TileServer`
+    :param host: host name
+    :param port: port number
+    '''
+
+    server = make_server(host, port, app, ThreadingWSGIServer)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,110 @@
+# coding: utf-8
+import os
+import errno
+import hashlib
+import tempfile
+
+
+class TileStore(object):
+
+    '''
+    Stores tiles as ``path/level/x/y.png``. If dedup is set, the content of
+    each tile is stored only once in ``path/blobs`` and tiles are relative
+    symbolic links to their content. Most tiles over sea or farmland are
+    identical, so this saves a lot of disk space and inodes.
+
+    :param path: path to root directory of tiles
+    :param dedup: store identical tiles only once
+    :param extension: file extension of tiles
+    '''
+
+    BLOB_DIR = 'blobs'
+
+    def __init__(self, path, dedup=False, extension='png'):
+        self.path = path
+        self.dedup = dedup and hasattr(os, 'symlink')
+        self.extension = extension
+
+    def tile_path(self, level, indexx, indexy):
+        '''Returns path of tile file.'''
+
+        return os.path.join(self.path, str(level), str(indexx),
+            '%s.%s' % (indexy, self.extension))
+
+    def exists(self, level, indexx, indexy):
+        '''Returns whether tile exists.'''
+
+        return os.path.exists(self.tile_path(level, indexx, indexy))
+
+    def read(self, level, indexx, indexy):
+        '''
+        Returns content of tile.
+
+        :returns: str or None if tile does not exist
+        '''
+
+        try:
+            with open(self.tile_path(level, indexx, indexy), 'rb') as fobj:
+                return fobj.read()
+        except IOError:
+            return None
+
+    def write(self, level, indexx, indexy, data):
+        '''
+        Writes tile or replaces existing tile. The content is written to a
+        temporary file which is synced to disk and then renamed, so tiles can
+        be updated while they are served and an interrupted write never
+        leaves a truncated tile, which would be skipped by later seeds with
+        ``--skip-existing``.
+
+        :param data: content of tile as str
+
+        :returns: path of tile file
+        '''
+
+        tilepath = self.tile_path(level, indexx, indexy)
+        makedirs(os.path.dirname(tilepath))
+        if not self.dedup:
+            self._write_atomic(tilepath, data)
+            return tilepath
+        digest = hashlib.sha1(data).hexdigest()
+        blobpath = os.path.join(self.path, self.BLOB_DIR, digest[:2],
+            '%s.%s' % (digest[2:], self.extension))
+        if not os.path.exists(blobpath):
+            makedirs(os.path.dirname(blobpath))
+            self._write_atomic(blobpath, data)
+        #: replace tile by link to blob
+        target = os.path.relpath(blobpath, os.path.dirname(tilepath))
+        tmppath = '%s.%s.tmp' % (tilepath, os.getpid())
+        try:
+            os.remove(tmppath)
+        except OSError:
+            pass # no leftover of crashed process
+        os.symlink(target, tmppath)
+        os.rename(tmppath, tilepath)
+        return tilepath
+
+    def _write_atomic(self, path, data):
+        fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as fobj:
+                fobj.write(data)
+                # the rename must not reach the disk before the content
+                fobj.flush()
+                os.fsync(fobj.fileno())
+            # mkstemp creates files only readable by owner
+            os.chmod(tmppath, 0644)
+            os.rename(tmppath, path)
+        except:
+            os.remove(tmppath)
+            raise
+
+
+def makedirs(path):
+    '''Creates directory and all parent directories if they do not exist.'''
+
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
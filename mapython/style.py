@@ -1,6 +1,8 @@
 # coding: utf-8
 import os
+import math
 import string
+import hashlib
 import functools
 from collections import defaultdict
 import yaml
@@ -170,6 +172,9 @@ class StyleSheet(object):
         self.styles = defaultdict(lambda: defaultdict(dict))
         self.zoomlevels = {}
         self.dirname = None
+        #: incremented by every update, see
+        #: :meth:`mapython.render.Renderer.query_groups`
+        self.revision = 0
         if stylesheet is not None:
             if (
                 (isinstance(stylesheet, str) or isinstance(stylesheet, unicode))
@@ -233,6 +238,7 @@ class StyleSheet(object):
         :param style: :class:`mapython.style.Style` object
         '''
 
+        self.revision += 1
         #: overwrite if style is already set for this level
         existing = self.get(self.zoomlevels[style.level][0], style.geom_type,
             style.tag_value)
@@ -242,6 +248,76 @@ class StyleSheet(object):
             self.styles[style.level][style.geom_type] \
                 [utils.dict2key(style.tag_value)] = style
 
+    def digest(self):
+        '''
+        Returns hash of all zoom levels, backgrounds and styles, e.g. to
+        key caches of rendered maps, see :func:`mapython.cache.map_key`.
+
+        :returns: hex str
+        '''
+
+        styles = sorted(
+            (level, geom_type, key, sorted(style.attrs.iteritems()))
+            for level, geom_types in self.styles.iteritems()
+            for geom_type, styles in geom_types.iteritems()
+            for key, style in styles.iteritems()
+        )
+        return hashlib.sha1(repr((
+            sorted(self.zoomlevels.iteritems()),
+            getattr(self, 'map_background', None),
+            getattr(self, 'sea_background', None),
+            self.dirname,
+            styles,
+        ))).hexdigest()
+
+    def iter_colors(self):
+        '''
+        Returns generator which yields all colors used in this stylesheet,
+        e.g. to seed the palette of 8-bit png maps.
+
+        :yields: ``(r, g, b[, a])``
+        '''
+
+        # backgrounds are not set for empty stylesheets
+        colors = [getattr(self, 'map_background', None),
+            getattr(self, 'sea_background', None)]
+        for geom_types in self.styles.itervalues():
+            for styles in geom_types.itervalues():
+                for style in styles.itervalues():
+                    for key, value in style.attrs.iteritems():
+                        if 'color' in key:
+                            colors.append(value)
+        seen = set()
+        for color in colors:
+            if color is not None and tuple(color) not in seen:
+                seen.add(tuple(color))
+                yield tuple(color)
+
+    def label_buffer(self, chars=16):
+        '''
+        Estimates the max distance in pixel labels and images may extend
+        beyond the feature they belong to from the largest font size, e.g.
+        to find the tiles affected by changed features of neighbouring tiles.
+
+        :param chars: max number of characters of a label
+
+        :returns: distance in pixel
+        '''
+
+        buffer = 0
+        for geom_types in self.styles.itervalues():
+            for styles in geom_types.itervalues():
+                for style in styles.itervalues():
+                    if style.get('text') is None:
+                        continue
+                    # labels are centered, average glyph width is about 60 %
+                    # of the font size
+                    size = style.get('font-size', 10) * chars * 0.6 / 2
+                    size += style.get('text-halo-width', 1.5)
+                    size += style.get('image-margin', 0)
+                    buffer = max(buffer, size)
+        return int(math.ceil(buffer))
+
     def iter_styles(self, scale, geom_type):
         '''
         Returns generator which yields all styles set for this scale and
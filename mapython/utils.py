@@ -173,7 +173,8 @@ def linestring_text_optimal_segment(coords, width, max_rad=4.5):
             midmost = (start, end)
     return midmost
 
-def generate_char_geoms(ctx, text, spacing=0.6, space_width=3):
+def generate_char_geoms(ctx, text, spacing=0.6, space_width=3,
+        text_extents=None):
     '''
     Generates coordinates for each character in text. Each character is placed
     at (0, 0). Additionally the character width and spacing to
@@ -183,10 +184,15 @@ def generate_char_geoms(ctx, text, spacing=0.6, space_width=3):
     :param text: text as str or unicode
     :param spacing: spacing between characters as int or float
     :param space_width: width of one space character
+    :param text_extents: callable which returns the extents of a character
+        in the current font, defaults to :meth:`cairo.Context.text_extents`,
+        see :class:`mapython.draw.FontCache`
 
     :returns: list containing (coordinate tuple, width, spacing) tuples
     '''
 
+    if text_extents is None:
+        text_extents = ctx.text_extents
     ctx.save()
     # list containing geometries and info for each character as a tuple:
     # (geometry, width, height, spacing)
@@ -208,7 +214,7 @@ def generate_char_geoms(ctx, text, spacing=0.6, space_width=3):
                 coords = []
             else: # cairo.PATH_MOVE_TO or cairo.PATH_LINE_TO
                 coords.append(point)
-        width = ctx.text_extents(char)[2]
+        width = text_extents(char)[2]
         geoms.append((paths, width, cur_spacing))
         ctx.new_path()
         cur_spacing = spacing
@@ -31,14 +31,16 @@ setup(
     author_email='johannes.schoenberger@tum.de',
 
     packages=['mapython'],
-    scripts=['scripts/generate_tiles.py'],
+    scripts=['scripts/generate_tiles.py', 'scripts/serve_tiles.py',
+        'scripts/advise_indexes.py'],
     install_requires=[
         'shapely>=1.2.9',
         'sqlalchemy>=0.6',
         'geoalchemy>=0.5',
         'pyyaml>=3',
         'pyproj>=1.8',
-        'pycairo>=1.8',
+        'pycairo>=1.10',
+        'numpy>=1.9',
     ],
     package_data = {'mapython': ['styles/*']},
 )
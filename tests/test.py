@@ -3,12 +3,30 @@ import sys
 import os
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+import test_cache
+import test_clip
+import test_features
+import test_labels
 import test_map
+import test_png
+import test_projection
+import test_render
+import test_seed
+import test_store
 import test_style
 
 
 def suite():
     suite = unittest.TestSuite()
+    suite.addTest(test_cache.suite())
+    suite.addTest(test_clip.suite())
+    suite.addTest(test_features.suite())
+    suite.addTest(test_labels.suite())
     suite.addTest(test_map.suite())
+    suite.addTest(test_png.suite())
+    suite.addTest(test_projection.suite())
+    suite.addTest(test_render.suite())
+    suite.addTest(test_seed.suite())
+    suite.addTest(test_store.suite())
     suite.addTest(test_style.suite())
     return suite
@@ -0,0 +1,133 @@
+# coding: utf-8
+import unittest
+import tempfile
+import shutil
+
+from mapython import cache
+
+
+class QueryCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.fetched = []
+
+    def fetch(self, bounds):
+        self.fetched.append(bounds)
+        objects = ['a', 'b', 'c']
+        objects_bounds = [(0, 0, 1, 1), (2, 2, 3, 3), (0.5, 0.5, 2.5, 0.5)]
+        return objects, objects_bounds
+
+    def test_snap_bounds(self):
+        self.assertEqual(cache.snap_bounds((0.5, 0.5, 1.5, 1), 0),
+            (0, 0, 2, 1))
+        self.assertEqual(cache.snap_bounds((-3, 1, -1, 2), 0),
+            (-4, 0, 0, 2))
+        self.assertEqual(cache.snap_bounds((1, 1, 2, 2)), (0, 0, 2, 2))
+
+    def test_snap_size(self):
+        self.assertEqual(cache.snap_size(3, 0), 2)
+        self.assertEqual(cache.snap_size(0.3), 0.125)
+        self.assertEqual(cache.snap_size(0), 0)
+
+    def test_get(self):
+        queries = cache.QueryCache()
+        self.assertEqual(queries.get('polygon', (0, 0, 1, 1), self.fetch),
+            ['a', 'c'])
+        self.assertEqual(queries.get('polygon', (1.5, 1.5, 2, 2),
+            self.fetch), ['b'])
+        self.assertEqual(len(self.fetched), 1)
+        self.assertEqual((queries.hits, queries.misses), (1, 1))
+        queries.get('line', (0, 0, 1, 1), self.fetch)
+        self.assertEqual(len(self.fetched), 2)
+
+    def test_min_size(self):
+        def fetch(bounds):
+            objects, objects_bounds = self.fetch(bounds)
+            sizes = [(1, ), (4, ), (2, )]
+            return objects, [b + s for b, s in zip(objects_bounds, sizes)]
+        queries = cache.QueryCache()
+        self.assertEqual(queries.get('polygon', (0, 0, 1, 1), fetch, (4, ),
+            (1, )), [])
+        #: cells fetched with lower min sizes answer the next zoom level
+        self.assertEqual(queries.get('polygon', (0, 0, 1, 1), fetch, (2, ),
+            (0.5, )), ['c'])
+        self.assertEqual(queries.get('polygon', (0, 0, 2, 2), fetch, (1, ),
+            (0.25, )), ['a', 'b', 'c'])
+        self.assertEqual(len(self.fetched), 1)
+        self.assertEqual(queries.get('polygon', (0, 0, 1, 1), fetch,
+            (0.5, ), (0.25, )), ['a', 'c'])
+        self.assertEqual(len(self.fetched), 2)
+
+    def test_evict(self):
+        queries = cache.QueryCache(max_features=4)
+        queries.get('polygon', (0, 0, 1, 1), self.fetch)
+        queries.get('line', (0, 0, 1, 1), self.fetch)
+        self.assertEqual(queries.size, 3)
+        self.assertEqual(queries.entries.keys()[0][0], 'line')
+
+    def test_invalidate(self):
+        queries = cache.QueryCache(version=1)
+        queries.get('polygon', (0, 0, 1, 1), self.fetch)
+        queries.invalidate((10, 10, 11, 11))
+        self.assertEqual(queries.size, 3)
+        queries.validate(1)
+        self.assertEqual(queries.size, 3)
+        queries.validate(2)
+        self.assertEqual(queries.size, 0)
+        queries.get('polygon', (0, 0, 1, 1), self.fetch)
+        self.assertEqual(len(self.fetched), 2)
+
+
+class TileCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_map_key(self):
+        key = cache.map_key((1, 2, 3, 4), 256, 'style')
+        self.assertEqual(len(key), 40)
+        self.assertEqual(key,
+            cache.map_key((1.00000001, 2, 3, 4), 256, 'style'))
+        self.assertNotEqual(key, cache.map_key((1, 2, 3, 4), 512, 'style'))
+        self.assertNotEqual(key,
+            cache.map_key((1, 2, 3, 4), 256, 'style', version=2))
+
+    def test_memory(self):
+        tiles = cache.TileCache(max_bytes=4)
+        self.assertIsNone(tiles.get('a'))
+        tiles.put('a', 'aa')
+        tiles.put('b', 'bb')
+        self.assertEqual(tiles.get('a'), 'aa')
+        #: least recently used map is evicted
+        tiles.put('c', 'cc')
+        self.assertIsNone(tiles.get('b'))
+        self.assertEqual(tiles.get('a'), 'aa')
+        #: too large for cache
+        tiles.put('d', 'ddddd')
+        self.assertIsNone(tiles.get('d'))
+        self.assertEqual((tiles.hits, tiles.misses), (2, 3))
+
+    def test_disk(self):
+        keys = [cache.map_key((i, 0, 1, 1), 256, 'style') for i in xrange(3)]
+        tiles = cache.TileCache(max_bytes=0, path=self.tempdir,
+            max_disk_bytes=4)
+        tiles.put(keys[0], 'aa')
+        tiles.put(keys[1], 'bb')
+        self.assertEqual(tiles.get(keys[0]), 'aa')
+        tiles.put(keys[2], 'cc')
+        self.assertIsNone(tiles.get(keys[1]))
+        #: disk cache is restored
+        tiles = cache.TileCache(path=self.tempdir)
+        self.assertEqual(tiles.disk_size, 4)
+        self.assertEqual(tiles.get(keys[2]), 'cc')
+
+
+def suite():
+    loader = unittest.TestLoader()
+    return unittest.TestSuite([
+        loader.loadTestsFromTestCase(QueryCacheTestCase),
+        loader.loadTestsFromTestCase(TileCacheTestCase),
+    ])
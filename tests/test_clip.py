@@ -0,0 +1,58 @@
+# coding: utf-8
+import unittest
+import numpy
+from shapely.geometry import Polygon, box
+
+from mapython import clip
+
+
+BOUNDS = (0, 0, 10, 10)
+
+
+class ClipTestCase(unittest.TestCase):
+
+    def test_clip_line(self):
+        inside = numpy.array([(1, 1), (5, 5), (9, 1)], float)
+        self.assertTrue(clip.clip_line(inside, BOUNDS)[0] is inside)
+        outside = numpy.array([(-5, -5), (-1, 20)], float)
+        self.assertEqual(clip.clip_line(outside, BOUNDS), [])
+        # crossing the bounds
+        line = numpy.array([(-5, 5), (5, 5), (5, 15)], float)
+        lines = clip.clip_line(line, BOUNDS)
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(lines[0].tolist(), [[0, 5], [5, 5], [5, 10]])
+        # leaving and re-entering the bounds
+        line = numpy.array([(2, 2), (2, 20), (8, 20), (8, 2)], float)
+        lines = clip.clip_line(line, BOUNDS)
+        self.assertEqual([l.tolist() for l in lines],
+            [[[2, 2], [2, 10]], [[8, 10], [8, 2]]])
+        # passing through without vertex inside
+        line = numpy.array([(-10, -10), (20, 20)], float)
+        self.assertEqual(clip.clip_line(line, BOUNDS)[0].tolist(),
+            [[0, 0], [10, 10]])
+
+    def test_clip_ring(self):
+        inside = numpy.array([(1, 1), (2, 1), (2, 2), (1, 1)], float)
+        self.assertTrue(clip.clip_ring(inside, BOUNDS) is inside)
+        outside = inside + 20
+        self.assertTrue(clip.clip_ring(outside, BOUNDS) is None)
+        ring = numpy.array([(-5, -5), (5, -5), (5, 5), (-5, 5), (-5, -5)],
+            float)
+        clipped = clip.clip_ring(ring, BOUNDS)
+        self.assertAlmostEqual(Polygon(clipped).area, 25)
+        self.assertTrue(box(*BOUNDS).buffer(1e-9).contains(Polygon(clipped)))
+        # ring containing the bounds
+        ring = numpy.array([(-5, -5), (15, -5), (15, 15), (-5, 15),
+            (-5, -5)], float)
+        self.assertAlmostEqual(Polygon(clip.clip_ring(ring, BOUNDS)).area,
+            100)
+        # concave ring
+        ring = numpy.array([(-5, 2), (15, 2), (15, 4), (5, 4), (5, 6),
+            (15, 6), (15, 8), (-5, 8), (-5, 2)], float)
+        expected = Polygon(ring).intersection(box(*BOUNDS)).area
+        self.assertAlmostEqual(Polygon(clip.clip_ring(ring, BOUNDS)).area,
+            expected)
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(ClipTestCase)
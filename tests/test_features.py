@@ -0,0 +1,87 @@
+# coding: utf-8
+import unittest
+import struct
+import numpy
+from shapely import wkb
+from shapely.geometry import Point, LineString, Polygon, MultiPolygon
+
+from mapython import features
+
+
+class Row(object):
+
+    def __init__(self, geom):
+        self.geom = self
+        self.geom_wkb = wkb.dumps(geom)
+
+
+class FeatureBatchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.square = Polygon([(0, 0), (4, 0), (4, 4), (0, 4), (0, 0)],
+            [[(1, 1), (2, 1), (2, 2), (1, 1)]])
+        self.geoms = [
+            Point(1, 2),
+            LineString([(0, 0), (1, 1), (2, 0)]),
+            self.square,
+            MultiPolygon([self.square, Polygon([(5, 5), (6, 5), (6, 6)])]),
+        ]
+
+    def test_decode_wkb(self):
+        batch = features.decode_wkb(wkb.dumps(geom) for geom in self.geoms)
+        self.assertEqual(len(batch), 4)
+        self.assertEqual(list(batch.geom_types), [features.WKB_POINT,
+            features.WKB_LINESTRING, features.WKB_POLYGON,
+            features.WKB_MULTIPOLYGON])
+        self.assertEqual(batch.coords.shape, (1 + 3 + 9 + 9 + 4, 2))
+        self.assertEqual(batch.geometry(0)[0][0].tolist(), [[1, 2]])
+        self.assertEqual(batch.feature_coords(1).tolist(),
+            [[0, 0], [1, 1], [2, 0]])
+        rings = batch.geometry(2)[0]
+        self.assertTrue(numpy.array_equal(rings[0],
+            numpy.array(self.square.exterior)))
+        self.assertEqual(rings[1].tolist(), [[1, 1], [2, 1], [2, 2], [1, 1]])
+        parts = batch.geometry(3)
+        self.assertEqual(len(parts), 2)
+        self.assertEqual(len(parts[0]), 2)
+        self.assertEqual(parts[1][0].tolist(),
+            [[5, 5], [6, 5], [6, 6], [5, 5]])
+        # rings are views of the coordinate array
+        self.assertTrue(parts[1][0].base is batch.coords)
+
+    def test_decode_wkb_formats(self):
+        # big endian
+        data = wkb.dumps(self.geoms[1], big_endian=True)
+        batch = features.decode_wkb([data])
+        self.assertEqual(batch.feature_coords(0).tolist(),
+            [[0, 0], [1, 1], [2, 0]])
+        # extended WKB with SRID and Z coordinate
+        data = struct.pack('<BIIIddddd', 1,
+            features.WKB_LINESTRING | features.EWKB_SRID | features.EWKB_Z,
+            4326, 2, 1, 2, 3, 4, 5) + struct.pack('<d', 6)
+        batch = features.decode_wkb([data])
+        self.assertEqual(batch.feature_coords(0).tolist(), [[1, 2], [4, 5]])
+        # ISO WKB of measured point
+        data = struct.pack('<BIddd', 1, 2001, 7, 8, 9)
+        batch = features.decode_wkb([data])
+        self.assertEqual(batch.feature_coords(0).tolist(), [[7, 8]])
+        self.assertRaises(ValueError, features.decode_wkb,
+            [struct.pack('<BI', 1, 17)])
+
+    def test_decode_rows(self):
+        rows = [Row(geom) for geom in self.geoms]
+        batch = features.decode_rows(rows[:2])
+        self.assertEqual(len(batch), 2)
+        batch = features.decode_rows(rows)
+        self.assertEqual(len(batch), 2)
+        self.assertEqual(rows[0].wkb_type, features.WKB_POINT)
+        self.assertEqual(rows[0].coords.tolist(), [[1, 2]])
+        self.assertEqual(rows[3].wkb_type, features.WKB_MULTIPOLYGON)
+        self.assertEqual(len(rows[3].parts), 2)
+        self.assertTrue(numpy.array_equal(rows[2].parts[0][0],
+            numpy.array(self.square.exterior)))
+        self.assertEqual(len(features.decode_rows([])), 0)
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(FeatureBatchTestCase)
@@ -0,0 +1,131 @@
+# coding: utf-8
+import unittest
+import functools
+import numpy
+
+from mapython import labels
+
+
+class ThinGridTestCase(unittest.TestCase):
+
+    def test_thin_grid(self):
+        points = [(1, 1), (5, 5), (9, 9), (15, 1), (25, 25), (26, 26)]
+        priorities = [0, 2, 1, 0, 1, 1]
+        keep = labels.thin_grid(points, priorities, 10)
+        # highest priority of each cell, earlier candidates win ties
+        self.assertEqual(keep.tolist(), [1, 3, 4])
+        keep = labels.thin_grid(points, priorities, 10, limit=2)
+        self.assertEqual(keep.tolist(), [1, 2, 3, 4, 5])
+        keep = labels.thin_grid(points, priorities, 100, limit=3)
+        self.assertEqual(keep.tolist(), [1, 2, 4])
+
+    def test_thin_grid_negative(self):
+        # cells left of and above the origin are distinct
+        keep = labels.thin_grid([(-1, 1), (1, 1), (1, -1)], [0, 0, 0], 10)
+        self.assertEqual(keep.tolist(), [0, 1, 2])
+
+    def test_thin_grid_empty(self):
+        keep = labels.thin_grid(numpy.empty((0, 2)), [], 10)
+        self.assertEqual(len(keep), 0)
+
+
+class LabelEngineTestCase(unittest.TestCase):
+
+    def test_candidate_boxes(self):
+        boxes = labels.candidate_boxes((-5, -2, 5, 2), gap=1)
+        self.assertEqual(len(boxes), len(labels.POINT_OFFSETS))
+        self.assertEqual(boxes[0], (-5, -2, 5, 2))
+        # right of and above the anchor
+        self.assertEqual(boxes[1], (1, -2, 11, 2))
+        self.assertEqual(boxes[3], (-5, -5, 5, -1))
+
+    def test_collision_index(self):
+        index = labels.CollisionIndex(cell_size=10)
+        index.insert((5, 5, 25, 8))
+        self.assertTrue(index.collides((20, 0, 30, 6)))
+        self.assertFalse(index.collides((25, 0, 30, 6)))
+        self.assertFalse(index.collides((0, 8, 30, 20)))
+        index.insert((40, 40, 41, 41), margin=2)
+        self.assertTrue(index.collides((42, 42, 50, 50)))
+
+    def test_place(self):
+        drawn = []
+        def draw(name, bounds):
+            drawn.append((name, bounds))
+            return [bounds]
+        engine = labels.LabelEngine((0, 0, 100, 100), margin=0)
+        boxes = labels.candidate_boxes((40, 40, 60, 50))
+        # overlaps the higher label at its anchor, free on the right
+        shifted = labels.candidate_boxes((55, 40, 75, 50))
+        engine.add((0, 0), shifted, functools.partial(draw, 'low'))
+        engine.add((1, 0), boxes, functools.partial(draw, 'high'))
+        engine.add((1, 0), boxes[:1], functools.partial(draw, 'dropped'))
+        engine.add((1, 1), [(95, 95, 105, 105)],
+            functools.partial(draw, 'outside'))
+        self.assertEqual(engine.place(), 2)
+        self.assertEqual(drawn, [('high', boxes[0]), ('low', shifted[1])])
+        self.assertEqual((engine.placed, engine.dropped), (2, 2))
+        # labels without candidates place themselves
+        engine.add(0, None, lambda bounds: [])
+        engine.add(0, None, lambda bounds: [(0, 0, 10, 10)])
+        self.assertEqual(engine.place(), 1)
+        self.assertTrue(engine.index.collides((5, 5, 6, 6)))
+
+    def test_stop(self):
+        engine = labels.LabelEngine((0, 0, 100, 100))
+        for i in xrange(3):
+            engine.add(i, [(i * 10, 0, i * 10 + 5, 5)], lambda b: [b])
+        self.assertEqual(engine.place(stop=lambda: engine.placed == 2), 2)
+        self.assertEqual((len(engine), engine.dropped), (0, 1))
+
+
+class LabelGridTestCase(unittest.TestCase):
+
+    #: (key, priority, bounds in shared coordinates)
+    LABELS = [
+        (1, 1, (80, 40, 120, 50)), # on the edge of both tiles
+        (2, 0, (115, 45, 145, 55)), # overlaps 1 in the next cell
+        (3, 0, (97, 30, 105, 40)), # same cell as 1
+        (4, 0, (150, 10, 170, 20)),
+    ]
+
+    def place(self, dx):
+        # a tile of 100 x 100 whose left edge is at dx
+        grid = labels.LabelGrid(cell_size=32, offset=(dx, 0), margin=0)
+        drawn = []
+        def draw(key, bounds):
+            drawn.append((key, (bounds[0] + dx, ) + bounds[1:2]
+                + (bounds[2] + dx, ) + bounds[3:]))
+            return [bounds]
+        for key, priority, (minx, miny, maxx, maxy) in self.LABELS:
+            grid.add(key, priority, (minx - dx, miny, maxx - dx, maxy),
+                functools.partial(draw, key))
+        grid.place((0, 0, 100, 100))
+        return drawn
+
+    def test_place(self):
+        left = self.place(0)
+        right = self.place(100)
+        self.assertEqual(left, [(1, (80, 40, 120, 50))])
+        self.assertEqual(right, [(1, (80, 40, 120, 50)),
+            (4, (150, 10, 170, 20))])
+
+    def test_tie_break(self):
+        grid = labels.LabelGrid(cell_size=100)
+        for key in (5, 6):
+            grid.add(key, 0, (10, 10, 20, 20), None)
+        winner = grid.labels.values()[0][0]
+        for key in (6, 5):
+            other = labels.LabelGrid(cell_size=100)
+            other.add(key, 0, (10, 10, 20, 20), None)
+            other.add(11 - key, 0, (10, 10, 20, 20), None)
+            self.assertEqual(other.labels.values()[0][0], winner)
+
+
+def suite():
+    loader = unittest.TestLoader()
+    return unittest.TestSuite([
+        loader.loadTestsFromTestCase(ThinGridTestCase),
+        loader.loadTestsFromTestCase(LabelEngineTestCase),
+        loader.loadTestsFromTestCase(LabelGridTestCase),
+    ])
@@ -7,6 +7,7 @@ import cairo
 from shapely.geometry import box
 
 import mapython.draw
+import mapython.png
 
 
 PLACES = 9
@@ -56,6 +57,23 @@ class MapTestCase(unittest.TestCase):
         self.assertEqual((self.map.x0, self.map.y0),
             self.map.projection(self.bbox[0], self.bbox[3]))
 
+    def test_transform_array(self):
+        coords = [(self.bbox[0], self.bbox[3]), (11.1, 45.6)]
+        points = self.map.transform_array(coords)
+        for coord, point in zip(coords, points):
+            x, y = self.map.transform_coords(*coord)
+            self.assertAlmostEqual(x, point[0], places=PLACES)
+            self.assertAlmostEqual(y, point[1], places=PLACES)
+        #: projected coordinates are only transformed to unit
+        self.map.projected = True
+        projected = [self.map.projection(*coord) for coord in coords]
+        self.assertTrue((abs(self.map.transform_array(projected)
+            - points) < 1e-6).all())
+        minx, miny, maxx, maxy = self.map.projected_bounds()
+        self.assertAlmostEqual(self.map.transform_coords(minx, maxy)[0], 0)
+        self.assertAlmostEqual(self.map.transform_coords(maxx, miny)[0],
+            self.map.width)
+
     def test_conflicts(self):
         conflict = box(0, 0, 20, 20)
         self.map.conflict_union(conflict, margin=0)
@@ -157,6 +175,48 @@ class MapTestCase(unittest.TestCase):
         self.map.draw_image((11.2, 45.6),
             StringIO.StringIO(ICON.decode('base64')))
 
+    def test_draw_label(self):
+        width, height, image_width = self.map.label_size('TEST',
+            font_size=11)
+        self.assertTrue(width > 0 and height > 0)
+        self.assertEqual(image_width, 0)
+        area = self.map.draw_label((100, 100, 100 + width, 100 + height),
+            'TEST', font_size=11)
+        self.assertTrue(area[0] <= 100 + 1 and area[2] >= 100 + width - 1)
+        icon = StringIO.StringIO(ICON.decode('base64'))
+        size = self.map.label_size('TEST', font_size=11, image=icon)
+        self.assertEqual(size[0], width + 32 + 4)
+        self.assertEqual(size[1:], (32, 32))
+        icon.seek(0)
+        area = self.map.draw_label((200, 200, 200 + size[0], 232), None,
+            image=icon)
+        self.assertEqual(area, (200, 200, 232, 232))
+
+    def test_font_cache(self):
+        fonts = mapython.draw.FontCache(max_extents=2)
+        font = ('Tahoma', cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL,
+            11)
+        self.assertTrue(fonts.scaled_font(*font) is fonts.scaled_font(*font))
+        self.map.fonts = fonts
+        self.assertEqual(self.map.set_font(*font), font)
+        expected = self.map.context.text_extents('Main Street')
+        self.assertEqual(fonts.text_extents(font, 'Main Street'), expected)
+        fonts.text_extents(font, 'Main Street')
+        self.assertEqual((fonts.hits, fonts.misses), (1, 1))
+        # least recently used extents are evicted
+        fonts.text_extents(font, 'A')
+        fonts.text_extents(font, 'B')
+        self.assertEqual(fonts.extents.keys(), [(font, 'A'), (font, 'B')])
+
+    def test_paint_map(self):
+        recording = mapython.draw.Map(None, self.bbox, 400,
+            surface_type='recording')
+        recording.draw_background((1, 0, 0, 1))
+        self.map.paint_map(recording)
+        pixels = mapython.png.surface_array(self.map.surface)
+        self.assertEqual(pixels.shape, (self.map.height, self.map.width))
+        self.assertTrue((pixels == 0xffff0000).all())
+
 
 def suite():
     return unittest.TestLoader().loadTestsFromTestCase(MapTestCase)
@@ -0,0 +1,64 @@
+# coding: utf-8
+import unittest
+import struct
+import zlib
+import StringIO
+import numpy
+
+from mapython import png
+
+
+class PNGTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.red = png.color2argb((1, 0, 0))
+        self.blue = png.color2argb((0, 0, 1, 0.5))
+        self.pixels = numpy.array([
+            [self.red, self.blue, 0],
+            [0, self.red, self.red],
+        ], numpy.uint32)
+
+    def test_color2argb(self):
+        self.assertEqual(self.red, 0xffff0000)
+        #: premultiplied alpha
+        self.assertEqual(self.blue, 0x80000080)
+        r, g, b, a = png.split_argb(numpy.array([self.blue], numpy.uint32))
+        self.assertEqual((r[0], g[0], b[0], a[0]), (0, 0, 255, 128))
+
+    def test_quantize(self):
+        indexes, palette = png.quantize(self.pixels)
+        self.assertEqual(len(palette), 3)
+        numpy.testing.assert_array_equal(palette[indexes], self.pixels)
+        #: reduce to 2 colors, seed color is always kept
+        indexes, palette = png.quantize(self.pixels, colors=2,
+            palette=[self.blue])
+        self.assertEqual(list(palette), [self.blue, self.red])
+        self.assertEqual(palette[indexes[0, 2]], self.blue)
+
+    def test_write(self):
+        indexes, palette = png.quantize(self.pixels)
+        for png_filter in (png.FILTER_NONE, png.FILTER_SUB, png.FILTER_UP):
+            fobj = StringIO.StringIO()
+            png.write_indexed(fobj, indexes, palette, strategy='rle',
+                png_filter=png_filter)
+            data = fobj.getvalue()
+            self.assertTrue(data.startswith(png.PNG_SIGNATURE))
+            width, height, depth, color_type = struct.unpack('>IIBB',
+                data[16:26])
+            self.assertEqual((width, height, depth, color_type), (3, 2, 8, 3))
+            #: decode image data and undo filter
+            start = data.index('IDAT') + 4
+            length = struct.unpack('>I', data[start - 8:start - 4])[0]
+            rows = numpy.fromstring(zlib.decompress(
+                data[start:start + length]), numpy.uint8).reshape(2, 4)
+            self.assertTrue((rows[:, 0] == png_filter).all())
+            decoded = rows[:, 1:]
+            if png_filter == png.FILTER_SUB:
+                decoded = numpy.cumsum(decoded, axis=1, dtype=numpy.uint8)
+            elif png_filter == png.FILTER_UP:
+                decoded = numpy.cumsum(decoded, axis=0, dtype=numpy.uint8)
+            numpy.testing.assert_array_equal(decoded, indexes)
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(PNGTestCase)
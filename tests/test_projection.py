@@ -0,0 +1,65 @@
+# coding: utf-8
+import unittest
+import numpy
+import pyproj
+
+from mapython import projection
+from mapython import seed
+
+
+PLACES = 6
+
+
+class ProjectionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.lon = numpy.array([-179.5, -12.25, 0, 11.5, 179.9])
+        self.lat = numpy.array([-85, -45.5, 0, 48.1, 85])
+
+    def assertArrayAlmostEqual(self, first, second):
+        self.assertTrue(numpy.allclose(first, second, rtol=0, atol=1e-6),
+            '%r != %r' % (first, second))
+
+    def test_closed_form(self):
+        definitions = {
+            projection.mercator: '+proj=merc +a=6378137 +b=6378137 '
+                '+lat_ts=0 +lon_0=0 +x_0=0 +y_0=0 +k=1 +units=m +no_defs',
+            projection.plate_carree: '+proj=eqc +a=6378137 +b=6378137 '
+                '+lat_ts=0 +lon_0=0 +x_0=0 +y_0=0 +units=m +no_defs',
+        }
+        for proj, definition in definitions.iteritems():
+            expected = pyproj.Proj(definition)(self.lon, self.lat)
+            x, y = proj.forward(self.lon, self.lat)
+            self.assertArrayAlmostEqual(x, expected[0])
+            self.assertArrayAlmostEqual(y, expected[1])
+            lon, lat = proj.inverse(x, y)
+            self.assertArrayAlmostEqual(lon, self.lon)
+            self.assertArrayAlmostEqual(lat, self.lat)
+
+    def test_call(self):
+        for proj in (projection.mercator, projection.plate_carree,
+                projection.cassini):
+            x, y = proj(11.5, 48.1)
+            self.assertTrue(isinstance(x, float))
+            self.assertTrue(isinstance(y, float))
+            lon, lat = proj(x, y, inverse=True)
+            self.assertAlmostEqual(lon, 11.5, places=PLACES)
+            self.assertAlmostEqual(lat, 48.1, places=PLACES)
+            xs, ys = proj(self.lon, self.lat)
+            self.assertAlmostEqual(xs[3], x, places=PLACES)
+            self.assertAlmostEqual(ys[3], y, places=PLACES)
+
+    def test_tile_bboxes(self):
+        bboxes = seed.tile_bboxes(2, [0, 1, 3], [0, 2, 3], 256, 256)
+        self.assertEqual(bboxes.shape, (3, 4))
+        for (indexx, indexy), bbox in zip([(0, 0), (1, 2), (3, 3)], bboxes):
+            x0, y0 = projection.mercator(bbox[0], bbox[3])
+            size = seed.tile_size(2, 256, 256)[0]
+            self.assertAlmostEqual(x0, -20037508.34 + indexx * size, 2)
+            self.assertAlmostEqual(y0, 20037508.34 - indexy * size, 2)
+        self.assertEqual(seed.tile_bbox(2, 1, 2, 256, 256),
+            tuple(bboxes[1]))
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(ProjectionTestCase)
@@ -0,0 +1,182 @@
+# coding: utf-8
+import unittest
+import functools
+import StringIO
+import numpy
+from shapely import wkb
+from shapely.geometry import LineString, box
+
+from mapython import render
+from mapython.style import StyleSheet, Style
+from mapython.database import OSMLine, OSMPolygon
+from mapython.render import Renderer, FeatureSet
+
+
+STYLESHEET = '''
+ZOOMLEVELS:
+    0: [0, 1]
+
+LINE:
+    highway:
+        residential:
+            - all:
+                color: 1 1 1
+                width: 2
+                z-index: 2
+    railway:
+        tram:
+            - all:
+                color: 0 0 0
+                width: 1
+                z-index: 3
+'''
+
+
+class Row(object):
+
+    def __init__(self, geom, **tags):
+        self.geom = self
+        self.geom_wkb = wkb.dumps(geom)
+        self.osm_id = 1
+        self.name = None
+        self.highway = self.railway = None
+        self.__dict__.update(tags)
+
+
+class MapStub(object):
+
+    scale = 0.5
+
+
+class QueryObjectsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.row = Row(LineString([(0, 0), (1, 1)]), highway='residential',
+            railway='tram')
+        self.renderer = Renderer.__new__(Renderer)
+        self.renderer.mapobj = MapStub()
+        self.renderer.stylesheet = StyleSheet(StringIO.StringIO(STYLESHEET))
+        self.renderer.tables = {'line': OSMLine}
+        self.renderer.quiet = True
+        self.renderer.query_cache = None
+        self.renderer.statements = None
+        self.renderer.bbox = box(-1, -1, 2, 2)
+        self.renderer.pixel_size = (0.5, 0.5)
+        self.renderer.features = FeatureSet([self.renderer])
+        #: bounds, area and length of the shared features
+        self.renderer.features.objects['line'] = ([self.row],
+            numpy.array([(0, 0, 1, 1, 0, 1.4)], numpy.float64))
+
+    def test_shared_feature(self):
+        results = self.renderer.query_objects('line')
+        highway, railway = results[2], results[3]
+        self.assertEqual(len(highway), 1)
+        self.assertEqual(len(railway), 1)
+        self.assertIs(highway[0].row, self.row)
+        self.assertIs(railway[0].row, self.row)
+        self.assertEqual(highway[0].style['width'], 2)
+        self.assertEqual(railway[0].style['width'], 1)
+        self.assertEqual(railway[0].osm_id, 1)
+        self.assertIsNotNone(railway[0].coords)
+        self.assertFalse(hasattr(self.row, 'style'))
+        # the features of a second query keep their styles
+        self.assertEqual(self.renderer.query_objects('line')[2][0].style,
+            highway[0].style)
+
+    def test_shared_cull(self):
+        #: shared features are culled by the pixel size of each renderer
+        self.renderer.pixel_size = (2, 2)
+        results = self.renderer.query_objects('line')
+        self.assertEqual(sum(len(objects) for objects in results), 0)
+        self.renderer.bbox = box(5, 5, 6, 6)
+        self.renderer.pixel_size = (0.5, 0.5)
+        results = self.renderer.query_objects('line')
+        self.assertEqual(sum(len(objects) for objects in results), 0)
+
+
+class StyleConditionsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.styles = [
+            Style('polygon', 0, {'landuse': 'forest'},
+                {'background-color': [0, 1, 0]}),
+            Style('polygon', 0, {'landuse': 'grass'},
+                {'background-color': [0, 1, 0], 'min-pixel-area': 4}),
+            Style('polygon', 0, {'landuse': 'meadow'},
+                {'background-color': [0, 1, 0], 'min-pixel-area': 4}),
+            Style('polygon', 0, {'amenity': 'school', 'building': 'yes'},
+                {'text': 'name'}),
+        ]
+        self.srids = dict(render._srids)
+
+    def tearDown(self):
+        render._srids.clear()
+        render._srids.update(self.srids)
+
+    def conditions(self, srid):
+        render._srids[OSMPolygon.__tablename__] = srid
+        return list(render.style_conditions(self.styles, OSMPolygon,
+            functools.partial(render.cull_thresholds, 'polygon')))
+
+    def test_cull_thresholds(self):
+        self.assertEqual(render.cull_thresholds('polygon', self.styles[0]),
+            (render.MIN_PIXEL_AREA, 0))
+        self.assertEqual(render.cull_thresholds('polygon', self.styles[1]),
+            (4, 0))
+        self.assertEqual(render.cull_thresholds('line', self.styles[0]),
+            (0, render.MIN_PIXEL_LENGTH))
+        self.assertEqual(render.cull_thresholds('line',
+            Style('line', 0, {'highway': 'path'}, {'min-pixel-length': 0})),
+            (0, 0))
+        self.assertEqual(render.cull_thresholds('point', self.styles[0]),
+            (0, 0))
+
+    def test_style_conditions(self):
+        groups = self.conditions(3857)
+        #: styles with the same tag and thresholds are combined
+        self.assertEqual(len(groups), 3)
+        tags = sorted((sorted(tags), sorted(columns), len(conditions))
+            for tags, columns, conditions in groups)
+        self.assertEqual(tags, [
+            (['amenity', 'building'], ['name', 'osm_id'], 3),
+            (['landuse'], [], 2),
+            (['landuse'], [], 2),
+        ])
+        for _, _, conditions in groups:
+            self.assertIn('way_area', str(conditions[-1]))
+            self.assertIn('pixel_area', str(conditions[-1]))
+
+    def test_cull_area(self):
+        #: way_area may be in other units than tables in lat/lon
+        for _, _, conditions in self.conditions(4326):
+            self.assertNotIn('way_area', str(conditions[-1]))
+            self.assertIn('ST_Area', str(conditions[-1]))
+        conditions = render.cull_conditions(OSMPolygon, (0, 0))
+        self.assertEqual(conditions, [])
+
+    def test_cull_measures(self):
+        render._srids[OSMPolygon.__tablename__] = 3857
+        (area, name, threshold), = render.cull_measures(OSMPolygon, (4, 0))
+        self.assertIn('way_area', str(area))
+        self.assertEqual((name, threshold), ('pixel_area', 4))
+        render._srids[OSMLine.__tablename__] = 4326
+        (length, name, threshold), = render.cull_measures(OSMLine, (0, 1))
+        self.assertIn('ST_Length', str(length))
+        self.assertEqual((name, threshold), ('pixel_length', 1))
+        self.assertEqual(render.cull_measures(OSMPolygon, (0, 0)), [])
+
+    def test_conditions_key(self):
+        keys = [render.conditions_key(conditions)
+            for _, _, conditions in self.conditions(3857)]
+        #: equal conditions of separately built groups share their keys
+        self.assertEqual(keys, [render.conditions_key(conditions)
+            for _, _, conditions in self.conditions(3857)])
+        self.assertEqual(len(set(keys)), 3)
+
+
+def suite():
+    loader = unittest.TestLoader()
+    return unittest.TestSuite([
+        loader.loadTestsFromTestCase(QueryObjectsTestCase),
+        loader.loadTestsFromTestCase(StyleConditionsTestCase),
+    ])
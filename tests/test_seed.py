@@ -0,0 +1,115 @@
+# coding: utf-8
+import unittest
+import tempfile
+import os
+import shutil
+import StringIO
+
+from mapython import seed
+
+
+class SeedTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.journal_path = os.path.join(self.tempdir, 'journal.sqlite')
+        self.journal = seed.TileJournal(self.journal_path)
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.tempdir)
+
+    def test_journal(self):
+        self.assertFalse(self.journal.is_done('1/0/0.png'))
+        self.journal.mark_failed('1/0/0.png', 'error')
+        self.assertFalse(self.journal.is_done('1/0/0.png'))
+        self.assertEqual(list(self.journal.iter_failed()),
+            [('1/0/0.png', 1, 'error')])
+        self.journal.mark_done('1/0/0.png')
+        self.assertTrue(self.journal.is_done('1/0/0.png'))
+        self.assertEqual(list(self.journal.iter_failed()), [])
+        #: journal is persistent
+        journal = seed.TileJournal(self.journal_path)
+        self.assertTrue(journal.is_done('1/0/0.png'))
+        journal.clear()
+        journal.close()
+        self.assertFalse(self.journal.is_done('1/0/0.png'))
+
+    def test_retry(self):
+        calls = []
+        def func():
+            calls.append(None)
+            if len(calls) < 3:
+                raise ValueError
+            return len(calls)
+        self.assertEqual(seed.retry(func, retries=2, backoff=0), 3)
+        del calls[:]
+        self.assertRaises(ValueError, seed.retry, func, retries=1, backoff=0)
+        self.assertEqual(len(calls), 2)
+
+    def test_queue(self):
+        queue = seed.TileQueue(os.path.join(self.tempdir, 'queue.sqlite'),
+            max_attempts=2)
+        self.assertEqual(queue.put([('1/0/0', {'level': 1}, 1),
+            ('1/0/1', {'level': 2}, 10)]), 2)
+        #: already published jobs are ignored
+        self.assertEqual(queue.put([('1/0/0', {'level': 1}, 1)]), 0)
+        #: most expensive job first
+        job_id, data = queue.lease('a')
+        self.assertEqual(data, {'level': 2})
+        queue.complete(job_id)
+        job_id, data = queue.lease('a', lease=-1)
+        #: expired lease is handed out again
+        self.assertEqual(queue.lease('b')[0], job_id)
+        self.assertIsNone(queue.lease('c'))
+        self.assertFalse(queue.is_finished())
+        queue.fail(job_id, 'error')
+        self.assertIsNone(queue.lease('c'))
+        self.assertEqual(queue.counts(), {'done': 1, 'failed': 1})
+        self.assertTrue(queue.is_finished())
+        queue.close()
+
+    def test_queue_versions(self):
+        queue = seed.TileQueue(os.path.join(self.tempdir, 'queue.sqlite'))
+        job = {'level': 1, 'data_version': 1}
+        self.assertEqual(queue.put([('1/0/0', job, 1)]), 1)
+        job_id, data = queue.lease('a')
+        queue.complete(job_id, 'a')
+        self.assertEqual(queue.put([('1/0/0', job, 1)]), 0)
+        #: done job is published again for a new version of the data
+        job = {'level': 1, 'data_version': 2}
+        self.assertEqual(queue.put([('1/0/0', job, 1)]), 1)
+        self.assertEqual(queue.lease('a'), (job_id, job))
+        #: leased job is published again and not completed by the worker
+        #: rendering the old version
+        job = {'level': 1, 'data_version': 3}
+        self.assertEqual(queue.put([('1/0/0', job, 1)]), 1)
+        queue.complete(job_id, 'a')
+        self.assertEqual(queue.counts(), {'pending': 1})
+        self.assertEqual(queue.lease('b'), (job_id, job))
+        queue.complete(job_id, 'a')
+        self.assertEqual(queue.counts(), {'leased': 1})
+        queue.complete(job_id, 'b')
+        self.assertEqual(queue.counts(), {'done': 1})
+        queue.close()
+
+    def test_expire(self):
+        fobj = StringIO.StringIO('# dirty tiles\n2/1/2\n\n0,0,0,0\n')
+        areas = seed.read_expire_list(fobj)
+        self.assertEqual(areas[0], (0.25, 0.5, 0.5, 0.75))
+        self.assertEqual(len(areas), 2)
+        #: parent and child tiles
+        self.assertEqual(seed.expire_metatiles(areas[:1], 1), set([(0, 1)]))
+        self.assertEqual(seed.expire_metatiles(areas[:1], 3),
+            set([(2, 4), (3, 4), (2, 5), (3, 5)]))
+        #: label buffer reaches neighbouring tiles
+        self.assertEqual(len(seed.expire_metatiles(areas[:1], 2, buffer=1)),
+            9)
+        self.assertEqual(seed.expire_metatiles(areas[:1], 3, metatile=2),
+            set([(2, 4)]))
+        #: point in the center of the map
+        self.assertEqual(seed.expire_metatiles(areas[1:], 1), set([(1, 1)]))
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(SeedTestCase)
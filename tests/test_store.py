@@ -0,0 +1,58 @@
+# coding: utf-8
+import unittest
+import tempfile
+import os
+import shutil
+
+from mapython import store
+
+
+class StoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_write(self):
+        tiles = store.TileStore(self.tempdir)
+        self.assertFalse(tiles.exists(1, 0, 0))
+        self.assertIsNone(tiles.read(1, 0, 0))
+        path = tiles.write(1, 0, 0, 'a')
+        self.assertEqual(path, os.path.join(self.tempdir, '1', '0', '0.png'))
+        self.assertTrue(tiles.exists(1, 0, 0))
+        tiles.write(1, 0, 0, 'b')
+        self.assertEqual(tiles.read(1, 0, 0), 'b')
+
+    def test_write_failure(self):
+        tiles = store.TileStore(self.tempdir)
+        tiles.write(1, 0, 0, 'a')
+        self.assertRaises(TypeError, tiles.write, 1, 0, 0, None)
+        #: the tile is unchanged and no temporary file is left
+        self.assertEqual(tiles.read(1, 0, 0), 'a')
+        self.assertEqual(os.listdir(os.path.join(self.tempdir, '1', '0')),
+            ['0.png'])
+
+    def test_dedup(self):
+        tiles = store.TileStore(self.tempdir, dedup=True)
+        tiles.write(1, 0, 0, 'sea')
+        tiles.write(1, 0, 1, 'sea')
+        tiles.write(1, 1, 0, 'land')
+        self.assertEqual(tiles.read(1, 0, 1), 'sea')
+        self.assertEqual(tiles.read(1, 1, 0), 'land')
+        #: identical tiles share their content
+        self.assertEqual(os.path.realpath(tiles.tile_path(1, 0, 0)),
+            os.path.realpath(tiles.tile_path(1, 0, 1)))
+        blobs = []
+        for _, _, files in os.walk(os.path.join(self.tempdir, 'blobs')):
+            blobs.extend(files)
+        self.assertEqual(len(blobs), 2)
+        #: replace linked tile
+        tiles.write(1, 0, 0, 'land')
+        self.assertEqual(tiles.read(1, 0, 0), 'land')
+        self.assertEqual(tiles.read(1, 0, 1), 'sea')
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(StoreTestCase)
@@ -99,6 +99,24 @@ class StyleTestCase(unittest.TestCase):
     def test_iter(self):
         self.assertEqual(len(list(self.stylesheet.iter_styles(0, 'point'))), 1)
 
+    def test_colors(self):
+        colors = list(self.stylesheet.iter_colors())
+        self.assertEqual(colors[:2], [(1, 1, 1, 0), (1, 0, 1, 0)])
+        self.assertIn((1, 1, 1, 0.88), colors)
+        self.assertEqual(len(colors), len(set(colors)))
+
+    def test_label_buffer(self):
+        self.assertEqual(self.stylesheet.label_buffer(), 69)
+        self.assertEqual(self.stylesheet.label_buffer(chars=1), 6)
+        self.assertEqual(style.StyleSheet().label_buffer(), 0)
+
+    def test_digest(self):
+        digest = self.stylesheet.digest()
+        self.assertEqual(digest,
+            style.StyleSheet(StringIO.StringIO(STYLESHEET)).digest())
+        self.stylesheet.get(0.5, 'point', {'place': 'city'})['font-size'] = 1
+        self.assertNotEqual(digest, self.stylesheet.digest())
+
 
 def suite():
     return unittest.TestLoader().loadTestsFromTestCase(StyleTestCase)